@@ -0,0 +1,12 @@
+#!/usr/bin/env sh
+
+# The two models differ only in R4, whose deeply nested rate law also depends on D in deepModel2.xml:
+# - R1 has the same law in both, with its factors in a different order and nesting
+# - R2 calls functions that call other functions, which are inlined
+# - R3 and the rule for total are nested 1500 levels deep (R3's innermost constant is written as 1 in one model and 1.0
+#   in the other)
+# so only R4 (and the arrow from D to it) should be highlighted.
+sbml-diff.py deepModel1.xml deepModel2.xml | dot -Tpdf -o deep_comparison.pdf
+sbml-diff.py --abstract deepModel1.xml deepModel2.xml | dot -Tpdf -o deep_abstract_comparison.pdf
+
+sbml-diff.py --kinetics deepModel1.xml deepModel2.xml > deep_kinetics.txt
@@ -6,6 +6,16 @@ import argparse
 from cStringIO import StringIO
 import codecs
 
+
+def report_symbolic_timeouts(sd):
+    """
+    Warn (on stderr) about any expressions for which sympy exceeded its time or memory budget.
+    """
+    for model_name, description in sd.get_symbolic_timeouts():
+        sys.stderr.write("Warning: sympy could not analyse the %s in %s within the time and memory allowed; arrow "
+                         "directions for it were determined numerically\n" % (description, model_name))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="""
     Summarise one, or compare two or more, SBML models as a network or table.
@@ -29,6 +39,8 @@ if __name__ == '__main__':
     parser.add_argument('--elide', '-e', help="List of species to elide (comma-separated). Works with -a only")
 
     parser.add_argument('--colors', '-c', help="List of colors (comma-separated)")
+    parser.add_argument('--heat', help="Color features by the number of models that contain them, rather than by "
+                        "which model contains them (useful when comparing many models)", action="store_true")
     parser.add_argument('--labels', '-l', help="Style for reaction labels (none, name, name+rate, rate)")
     parser.add_argument('--stoich', '-s', help='Also label edges with stoichiometry', action='store_true')
 
@@ -46,14 +58,44 @@ if __name__ == '__main__':
     parser.add_argument('--hide-rules', help="Do not show rules", action="store_true")
 
     parser.add_argument('--sympy', help="Determine arrow directions symbolically using sympy", action="store_true")
+    parser.add_argument('--sympy-timeout', type=float, default=sbml_diff.DEFAULT_SYMPY_TIMEOUT, help="Maximum time "
+                        "(in seconds) to spend determining each arrow direction with sympy, after which it is "
+                        "determined numerically instead (0 for no limit; default %s)" % sbml_diff.DEFAULT_SYMPY_TIMEOUT)
+    parser.add_argument('--sympy-memory', type=int, default=sbml_diff.DEFAULT_SYMPY_MEMORY, help="Maximum memory "
+                        "(in MB) to use determining each arrow direction with sympy (0 for no limit; default %s)"
+                        % sbml_diff.DEFAULT_SYMPY_MEMORY)
+    parser.add_argument('--samples', type=int, default=sbml_diff.DEFAULT_SAMPLES, help="Number of operating points at "
+                        "which each kinetic law is evaluated to determine arrow directions numerically (default %s)"
+                        % sbml_diff.DEFAULT_SAMPLES)
+
+    parser.add_argument('--cache-dir', help="Directory in which to cache parsed and analysed models, so that they are "
+                        "not parsed again when compared later. Cached models are loaded with pickle, so only use a "
+                        "directory that no untrusted user can write to")
+    parser.add_argument('--cache-size', type=int, default=100, help="Maximum size of the cache directory, in MB "
+                        "(least recently used models are removed first; default 100)")
+
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="Number of processes to use to parse and analyse "
+                        "the models (default 1)")
+
+    parser.add_argument('--stream', help="Read each model only when it is compared, and release it before reading the "
+                        "next, so that only one model is held in memory at a time (cannot be used with tables, "
+                        "--align or --cartoon). The output has the same lines, but they may be in a different order",
+                        action="store_true")
 
     parser.add_argument('--complete', help="If no changes, exit quietly. Otherwise return param table, kinetic table," +
                                            " and DOT output", action="store_true")
 
-    parser.add_argument('infile', type=argparse.FileType('r'), nargs="+", help="List of input SBML files")
+    parser.add_argument('infile', type=argparse.FileType('rb'), nargs="+", help="List of input SBML files (which may "
+                        "be compressed with gzip, bzip2 or xz, or contained in a zip or COMBINE archive). Each model "
+                        "is named after its file, without any compression extension and its usual extension (so "
+                        "model.xml.gz is named 'model'); a model in an archive is named after the archive, not the "
+                        "file inside it (so model.zip or model.omex is also named 'model')")
 
     args = parser.parse_args()
 
+    if args.stream and args.complete:
+        parser.error("--stream cannot be used with --complete, as tables require every model at once")
+
     num_files = len(args.infile)
     if args.colors:
         all_colors = args.colors.split(",")
@@ -107,21 +149,27 @@ if __name__ == '__main__':
     if args.sympy:
         use_sympy = True
 
-    all_models = []
+    cache = None
+    if args.cache_dir:
+        cache = sbml_diff.ModelCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+
     all_model_names = []
     for inFile in args.infile:
-        model_string = inFile.read()
-        all_models.append(model_string)
-
         file_name = os.path.basename(os.path.split(inFile.name)[1])
-        all_model_names.append(os.path.splitext(file_name)[0])
+        all_model_names.append(sbml_diff.get_model_name(file_name))
 
-    output_formatter = sbml_diff.GenerateDot(all_colors, num_files, reaction_label=reaction_labels,
-                                             selected_model=selected_model, show_stoichiometry=args.stoich,
-                                             rankdir=rankdir, model_names=all_model_names)
-
-    sd = sbml_diff.SBMLDiff(all_models, all_model_names, output_formatter, align=align, cartoon=cartoon,
-                            show_params=show_params, hide_rules=hide_rules, use_sympy=use_sympy)
+    # each file is decompressed as it is parsed, without reading it into a string first
+    try:
+        output_formatter = sbml_diff.GenerateDot(all_colors, num_files, reaction_label=reaction_labels,
+                                                 selected_model=selected_model, show_stoichiometry=args.stoich,
+                                                 rankdir=rankdir, model_names=all_model_names, heat_scale=args.heat)
+
+        sd = sbml_diff.SBMLDiff(args.infile, all_model_names, output_formatter, align=align, cartoon=cartoon,
+                                show_params=show_params, hide_rules=hide_rules, use_sympy=use_sympy,
+                                cache=cache, jobs=args.jobs, samples=args.samples,
+                                sympy_timeout=args.sympy_timeout, sympy_memory=args.sympy_memory, stream=args.stream)
+    except RuntimeError, e:
+        sys.exit(e.args[0])
 
     if args.complete:
 
@@ -130,6 +178,7 @@ if __name__ == '__main__':
         sd.compare_params()
         print ""
         sd.diff_models()
+        report_symbolic_timeouts(sd)
 
         if output_formatter.differences_found:
             # print results
@@ -169,6 +218,8 @@ if __name__ == '__main__':
     except RuntimeError, e:
         sys.exit(e.args[0])
 
+    report_symbolic_timeouts(sd)
+
     # Print results
     sys.stdout = old_stdout
 
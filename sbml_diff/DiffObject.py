@@ -1,7 +1,89 @@
-import collections
+from model_sets import to_mask, from_mask, lowest_model
 
 
-class DiffObject:
+class RecordType(object):
+    """
+    The names of the fields of a kind of Record (e.g. a reactant arrow), shared by every record of that kind.
+    """
+    __slots__ = ["fields", "indexes"]
+
+    def __init__(self, *fields):
+        self.fields = fields
+        self.indexes = dict((field, index) for index, field in enumerate(fields))
+
+    def make(self, *values):
+        return Record(self, values)
+
+
+class Record(object):
+    """
+    An immutable record of one feature of a model (e.g. an arrow), used as a key of DiffElement.record.
+
+    Fields are read like those of a dict (record["reactant"]). The hash is computed once, when the record is made; it is
+    the same as that of a frozen dict with the same items, so records are stored (and iterated over) in the same order.
+    """
+    __slots__ = ["record_type", "values", "hash"]
+
+    def __init__(self, record_type, values):
+        self.record_type = record_type
+        self.values = values
+        self.hash = hash(tuple(sorted(zip(record_type.fields, values))))
+
+    def __getitem__(self, field):
+        return self.values[self.record_type.indexes[field]]
+
+    def __contains__(self, field):
+        return field in self.record_type.indexes
+
+    def __iter__(self):
+        return iter(self.record_type.fields)
+
+    def __len__(self):
+        return len(self.values)
+
+    def keys(self):
+        return list(self.record_type.fields)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        if not isinstance(other, Record):
+            return NotImplemented
+        return self.hash == other.hash and self.record_type.fields == other.record_type.fields and \
+            self.values == other.values
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+SPECIES = RecordType("species_id", "is_boundary", "species_name", "elided")
+REGULATORY_ARROW = RecordType("arrow_source", "arrow_target", "arrow_direction")
+TRIGGER_SPECIES = RecordType("species", "event_hash")
+SET_SPECIES = RecordType("math_expr")
+AFFECT_VALUE_ARROW = RecordType("species", "event_hash", "arrow_direction")
+ASSIGNMENT_PARAM_ARROW = RecordType("param", "event_hash", "arrow_direction")
+TRIGGER = RecordType("math_expr")
+TRIGGER_PARAM = RecordType("param", "event_hash")
+RULE_RATE_LAW = RecordType("rate_law")
+ALGEBRAIC_ARROW = RecordType("rule_id", "species_id")
+RULE_MODIFIER_ARROW = RecordType("rule_id", "modifier", "arrow_direction")
+RULE_TARGET_ARROW = RecordType("target")
+RULE_PARAMETER_ARROW = RecordType("rule_id", "param", "arrow_direction")
+REACTION_NODE = RecordType("rate_law", "reaction_name", "converted_rate_law", "is_fast", "is_irreversible",
+                           "is_transcription")
+REACTANT_ARROW = RecordType("reaction_id", "reactant", "stoich")
+PRODUCT_ARROW = RecordType("reaction_id", "product", "stoich")
+TRANSCRIPTION_REACTION_NODE = RecordType("reaction_id", "rate_law", "reaction_name", "converted_law", "product_status")
+PARAMETER_ARROW = RecordType("reaction_id", "param", "arrow_direction")
+
+
+class DiffObject(object):
+    __slots__ = ["compartments", "events", "param_nodes"]
+
     def __init__(self):
         self.compartments = {}
         self.add_compartment("NONE")
@@ -13,7 +95,7 @@ class DiffObject:
         return self.compartments[compartment_id]
 
     def check_compartment_exists(self, compartment):
-        if compartment not in self.compartments.keys():
+        if compartment not in self.compartments:
             self.add_compartment(compartment)
         return self.compartments[compartment]
 
@@ -23,10 +105,13 @@ class DiffObject:
         return new_event
 
     def add_param_node(self, variable_id, variable_name, model_set):
-        self.param_nodes.append({"variable_id": variable_id, "variable_name": variable_name, "model_set": model_set})
+        self.param_nodes.append({"variable_id": variable_id, "variable_name": variable_name,
+                                 "model_set": to_mask(model_set)})
 
 
-class DiffCompartment:
+class DiffCompartment(object):
+    __slots__ = ["species", "regulatory_arrows", "reactions", "rules"]
+
     def __init__(self):
         self.species = {}
         self.regulatory_arrows = DiffElement()
@@ -35,18 +120,16 @@ class DiffCompartment:
 
     def add_species(self, species_id, is_boundary, species_name, elided, model_num):
 
-        if species_id not in self.species.keys():
+        if species_id not in self.species:
             self.species[species_id] = DiffElement()
 
-        self.species[species_id].add({"species_id": species_id, "is_boundary": is_boundary, "species_name": species_name,
-                          "elided": elided}, model_num)
+        self.species[species_id].add(SPECIES.make(species_id, is_boundary, species_name, elided), model_num)
 
     def add_regulatory_arrow(self, arrow_source, arrow_target, arrow_direction, model_num):
-        self.regulatory_arrows.add({"arrow_source": arrow_source, "arrow_target": arrow_target,
-                                    "arrow_direction": arrow_direction}, model_num)
+        self.regulatory_arrows.add(REGULATORY_ARROW.make(arrow_source, arrow_target, arrow_direction), model_num)
 
     def add_reaction(self, reaction_id, rate_law, reaction_name, converted_rate_law, is_fast, is_irreversible, is_transcription, model_num):
-        if reaction_id not in self.reactions.keys():
+        if reaction_id not in self.reactions:
             self.reactions[reaction_id] = DiffReaction(reaction_id)
 
         self.reactions[reaction_id].add_instance(rate_law, reaction_name, converted_rate_law, is_fast, is_irreversible, is_transcription, model_num)
@@ -58,14 +141,19 @@ class DiffCompartment:
         self.rules.append(new_rule)
         return new_rule
 
-class DiffEventAssignment:
+
+class DiffEventAssignment(object):
+    __slots__ = ["affect_value_arrows", "affect_value_param_arrows", "math_expr"]
+
     def __init__(self):
         self.affect_value_arrows = DiffElement()
         self.affect_value_param_arrows = DiffElement()
         self.math_expr = DiffElement()
 
 
-class DiffEvent:
+class DiffEvent(object):
+    __slots__ = ["event", "trigger_arrows", "assignments", "trigger_math", "trigger_params"]
+
     def __init__(self):
         self.event = {}
         self.trigger_arrows = DiffElement()
@@ -74,37 +162,39 @@ class DiffEvent:
         self.trigger_params = DiffElement()
 
     def check_target_exists(self, target):
-        if target not in self.assignments.keys():
+        if target not in self.assignments:
             self.assignments[target] = DiffEventAssignment()
 
     def set_event(self, event_hash, event_name, model_set):
-        self.event = {"event_hash": event_hash, "event_name": event_name, "model_set": model_set}
+        self.event = {"event_hash": event_hash, "event_name": event_name, "model_set": to_mask(model_set)}
 
     def add_trigger_species(self, species, event_hash, model_num):
-        self.trigger_arrows.add({"species": species, "event_hash": event_hash}, model_num)
+        self.trigger_arrows.add(TRIGGER_SPECIES.make(species, event_hash), model_num)
 
     def add_set_species(self, species_id, math_expr, model_num):
         self.check_target_exists(species_id)
-        self.assignments[species_id].math_expr.add({"math_expr": math_expr}, model_num)
+        self.assignments[species_id].math_expr.add(SET_SPECIES.make(math_expr), model_num)
 
     def add_event_affect_value_arrow(self, variable_set, species, event_hash, arrow_direction, model_num):
         self.check_target_exists(variable_set)
         self.assignments[variable_set].affect_value_arrows.add(
-                {"species": species, "event_hash": event_hash, "arrow_direction": arrow_direction}, model_num)
+                AFFECT_VALUE_ARROW.make(species, event_hash, arrow_direction), model_num)
 
     def add_assignment_param_arrow(self, variable_set, species, event_hash, arrow_direction, model_num):
         self.check_target_exists(variable_set)
         self.assignments[variable_set].affect_value_param_arrows.add(
-                {"param": species, "event_hash": event_hash, "arrow_direction": arrow_direction}, model_num)
+                ASSIGNMENT_PARAM_ARROW.make(species, event_hash, arrow_direction), model_num)
 
     def add_trigger(self, math_expr, model_num):
-        self.trigger_math.add({"math_expr": math_expr}, model_num)
+        self.trigger_math.add(TRIGGER.make(math_expr), model_num)
 
     def add_param(self, param, event_hash, model_num):
-        self.trigger_params.add({"param": param, "event_hash": event_hash}, model_num)
+        self.trigger_params.add(TRIGGER_PARAM.make(param, event_hash), model_num)
+
 
+class DiffRule(object):
+    __slots__ = ["rule_id", "algebraic_arrows", "modifier_arrows", "target_arrows", "parameter_arrows", "rate_laws"]
 
-class DiffRule:
     def __init__(self, rule_id):
         self.rule_id = rule_id
         self.algebraic_arrows = DiffElement()
@@ -113,23 +203,26 @@ class DiffRule:
         self.parameter_arrows = DiffElement()
         self.rate_laws = DiffElement()
 
-    def add_rate_law(self, model_num, converted_rate_law):
-        self.rate_laws.add({"converted_rate_law": converted_rate_law}, model_num)
+    def add_rate_law(self, model_num, rate_law_key):
+        self.rate_laws.add(RULE_RATE_LAW.make(rate_law_key), model_num)
 
     def add_algebraic_arrow(self, model_num, rule_id, species_id):
-        self.algebraic_arrows.add({"rule_id": rule_id, "species_id": species_id}, model_num)
+        self.algebraic_arrows.add(ALGEBRAIC_ARROW.make(rule_id, species_id), model_num)
 
     def add_modifier_arrow(self, model_num, rule_id, modifier, arrow_direction):
-        self.modifier_arrows.add({"rule_id": rule_id, "modifier": modifier, "arrow_direction": arrow_direction}, model_num)
+        self.modifier_arrows.add(RULE_MODIFIER_ARROW.make(rule_id, modifier, arrow_direction), model_num)
 
     def add_target_arrow(self, model_num, target):
-        self.target_arrows.add({"target": target}, model_num)
+        self.target_arrows.add(RULE_TARGET_ARROW.make(target), model_num)
 
     def add_parameter_rule(self, model_num, rule_id, param, arrow_direction):
-        self.parameter_arrows.add({"rule_id": rule_id, "param": param, "arrow_direction": arrow_direction}, model_num)
+        self.parameter_arrows.add(RULE_PARAMETER_ARROW.make(rule_id, param, arrow_direction), model_num)
 
 
-class DiffReaction:
+class DiffReaction(object):
+    __slots__ = ["reaction_id", "reaction_node", "reactant_arrows", "product_arrows", "transcription_reaction_nodes",
+                 "transcription_product_arrows", "parameter_arrows"]
+
     def __init__(self, reaction_id):
         self.reaction_id = reaction_id
         self.reaction_node = DiffElement()
@@ -140,64 +233,93 @@ class DiffReaction:
         self.parameter_arrows = {}
 
     def add_instance(self, rate_law, reaction_name, converted_rate_law, is_fast, is_irreversible, is_transcription, model_num):
-        self.reaction_node.add({"rate_law": rate_law, "reaction_name": reaction_name,
-                                "converted_rate_law": converted_rate_law, "is_fast": is_fast,
-                                "is_irreversible": is_irreversible, "is_transcription": is_transcription}, model_num)
+        self.reaction_node.add(REACTION_NODE.make(rate_law, reaction_name, converted_rate_law, is_fast, is_irreversible,
+                                                  is_transcription), model_num)
 
     def add_reactant_arrow(self, reaction_id, reactant, stoich, model_num):
-        if reactant not in self.reactant_arrows.keys():
+        if reactant not in self.reactant_arrows:
             self.reactant_arrows[reactant] = DiffElement()
-        self.reactant_arrows[reactant].add({"reaction_id": reaction_id, "reactant": reactant, "stoich": stoich}, model_num)
+        self.reactant_arrows[reactant].add(REACTANT_ARROW.make(reaction_id, reactant, stoich), model_num)
 
     def add_product_arrow(self, reaction_id, product, stoich, model_num):
-        if product not in self.product_arrows.keys():
+        if product not in self.product_arrows:
             self.product_arrows[product] = DiffElement()
 
-        self.product_arrows[product].add({"reaction_id": reaction_id, "product": product, "stoich": stoich}, model_num)
+        self.product_arrows[product].add(PRODUCT_ARROW.make(reaction_id, product, stoich), model_num)
 
     def add_transcription_reaction_node(self, reaction_id, rate_law, reaction_name, converted_law,
                                         product_status, model_num):
-        self.transcription_reaction_nodes.add({"reaction_id": reaction_id, "rate_law": rate_law,
-                 "reaction_name": reaction_name, "converted_law": converted_law, "product_status": product_status}, model_num)
+        self.transcription_reaction_nodes.add(TRANSCRIPTION_REACTION_NODE.make(reaction_id, rate_law, reaction_name,
+                                                                               converted_law, product_status), model_num)
 
     def add_transcription_product_arrow(self, reaction_id, product, stoich, model_num):
-        if product not in self.transcription_product_arrows.keys():
+        if product not in self.transcription_product_arrows:
             self.transcription_product_arrows[product] = DiffElement()
-        self.transcription_product_arrows[product].add({"reaction_id": reaction_id, "product": product, "stoich": stoich}, model_num)
+        self.transcription_product_arrows[product].add(PRODUCT_ARROW.make(reaction_id, product, stoich), model_num)
 
     def add_parameter_arrow(self, reaction_id, param, arrow_direction, model_num):
-        if param not in self.parameter_arrows.keys():
+        if param not in self.parameter_arrows:
             self.parameter_arrows[param] = DiffElement()
 
-        self.parameter_arrows[param].add({"reaction_id": reaction_id, "param": param, "arrow_direction": arrow_direction}, model_num)
+        self.parameter_arrows[param].add(PARAMETER_ARROW.make(reaction_id, param, arrow_direction), model_num)
+
 
+class DiffElement(object):
+    """
+    The variants of a feature (e.g. a reaction node) found in the models being compared.
+
+    record maps each variant (a Record) to the bitmask of the models that contain it (see model_sets).
+    """
+    __slots__ = ["record"]
 
-class DiffElement:
     def __init__(self):
         self.record = {}
 
     def add(self, data_tuple, model_num):
-        data_tuple = FrozenDict(data_tuple)
-        if data_tuple not in self.record.keys():
-            self.record[data_tuple] = set()
-        self.record[data_tuple].add(model_num)
+        if not isinstance(data_tuple, Record):
+            # a dict, giving the value of each field
+            fields = tuple(data_tuple)
+            data_tuple = RecordType(*fields).make(*[data_tuple[field] for field in fields])
+        self.record[data_tuple] = self.record.get(data_tuple, 0) | 1 << model_num
 
     def get_models(self):
-        return list(reduce(lambda x,y: x.union(self.record[y]), self.record.keys(), set()))
+        """
+        Return the bitmask of the models that contain any variant of this feature.
+        """
+        mask = 0
+        for model_mask in self.record.itervalues():
+            mask |= model_mask
+        return mask
 
     def get_data(self):
         return self.record.keys()
 
     def all_equal(self):
-        return len(self.record.values()) == 1
+        return len(self.record) == 1
 
     def compare(self):
         if self.all_equal():
-            return list(self.record.values())[0]
+            return set(from_mask(list(self.record.values())[0]))
         else:
             return "different"
 
-    def compare_attribute(self, attribute_name, different="different"):
+    def compare_attribute(self, attribute_name, different="different", key_attribute=None):
+        """
+        Return the value of an attribute if it is the same in every model, or the value of different otherwise.
+
+        If key_attribute is given, the values are considered to be the same if the values of key_attribute are (e.g.
+        two converted kineticLaws that have the same canonical form), and the value for the lowest-numbered model is
+        returned.
+        """
+        if key_attribute is not None:
+            keys = set(data_tuple[key_attribute] for data_tuple in self.record)
+            if len(keys) > 1:
+                return different
+            if not self.record:
+                return False
+            first = min(self.record, key=lambda data_tuple: lowest_model(self.record[data_tuple]))
+            return first[attribute_name]
+
         val_set = False
         val = False
         for data_tuple in self.record:
@@ -210,27 +332,11 @@ class DiffElement:
         return val
 
     def find_models(self, attribute_name, value):
-
-        model_set = set()
+        """
+        Return the bitmask of the models containing a variant in which an attribute has a given value.
+        """
+        mask = 0
         for data_tuple in self.record:
-            if attribute_name in data_tuple.keys() and data_tuple[attribute_name] == value:
-                model_set = model_set.union(self.record[data_tuple])
-        return model_set
-
-class FrozenDict(collections.Mapping):
-    """This class is from https://stackoverflow.com/posts/2705638/revisions"""
-
-    def __init__(self, *args, **kwargs):
-        self._d = dict(*args, **kwargs)
-
-    def __iter__(self):
-        return iter(self._d)
-
-    def __len__(self):
-        return len(self._d)
-
-    def __getitem__(self, key):
-        return self._d[key]
-
-    def __hash__(self):
-        return hash(tuple(sorted(self._d.iteritems())))
\ No newline at end of file
+            if attribute_name in data_tuple and data_tuple[attribute_name] == value:
+                mask |= self.record[data_tuple]
+        return mask
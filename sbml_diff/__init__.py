@@ -1 +1 @@
-__all__ = ["accessor_functions", "effect_direction", "generate_dot", "rate_laws", "sbml_diff"]
+__all__ = ["accessor_functions", "effect_direction", "generate_dot", "math_ast", "model_cache", "model_files", "model_loader", "model_sets", "model_view", "rate_laws", "sbml_diff", "shared_model"]
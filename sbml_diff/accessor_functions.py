@@ -1,4 +1,7 @@
-from effect_direction import categorise_interaction
+from lxml import etree
+from effect_direction import categorise_expression, DEFAULT_SAMPLES, SIGN_ERRORS
+from rate_laws import convert_rate_law
+from math_ast import get_math_expression
 
 
 def get_params(model):
@@ -8,7 +11,7 @@ def get_params(model):
 
     Parameters
     ----------
-    model : bs4.BeautifulSoup object produced by parsing an SBML model
+    model : IndexedModel object produced by load_model()
         
 
     Returns
@@ -20,84 +23,27 @@ def get_params(model):
     param_ids = []
     param_values = {}
 
-    if not model.select_one("listOfParameters"):
+    if "listOfParameters" not in model.lists:
         return set(), param_values
 
-    for param in model.select_one("listOfParameters").select("parameter"):
-        param_id = param.attrs["id"]
+    for param in model.parameters:
+        param_id = param.attrib["id"]
         param_ids.append(param_id)
 
         param_values[param_id] = "?"
-        if "value" in param.attrs.keys():
-            param_values[param_id] = param.attrs["value"]
+        if "value" in param.attrib.keys():
+            param_values[param_id] = param.attrib["value"]
 
     return set(param_ids), param_values
 
 
-def get_regulatory_arrow(model, compartment, reactions, species_compartments, initial_values, elided_reactions=False, use_sympy=False):
-    """
-    Find all regulatory interactions in a particular compartment of a model, and construct an array of strings
-    representing these.
-    A regulatory interaction exists if a kinetic law includes a species id that is not a reactant.
-
-    Parameters
-    ----------
-    model : bs4.BeautifulSoup object produced by parsing an SBML model
-        
-    compartment : the id of a compartment
-
-    elided_reactions : a list of reactions, for which the corresponding reactions are not drawn
-        
-
-    Returns
-    -------
-    arrows : an array, each element of which is a string representing a regulatory interaction
-
-    """
-    if not elided_reactions:
-        elided_reactions = []
-
-    species_ids = get_species(model, compartment)
-
-    arrows = []
-
-    if not reactions:
-        return arrows
-
-    for reaction_id in reactions:
-        reaction = reactions[reaction_id]
-        if reaction in elided_reactions:
-            continue
-
-        kinetic_law = reaction.select_one("kineticLaw")
-        if not kinetic_law:
-            continue
-
-        for ci in kinetic_law.select("ci"):
-
-            # Check if this is a species id (it could validly be a species/compartment/parameter/function/reaction id)
-            species_id = ci.string.strip()
-            if species_id not in species_ids:
-                continue
-
-            # if not a reactant, add regulatory arrow
-            reactant_list, product_list, compartment, rate_law, _, _ = get_reaction_details(model, reaction, species_compartments)
-            if species_id in reactant_list:
-                continue
-
-            arrow_direction = categorise_interaction(kinetic_law, species_id, initial_values, use_sympy=use_sympy)
-            arrows.append((species_id, reaction_id, arrow_direction))
-
-    return arrows
-
-
 def get_species(model, compartment_id):
     """
     Get id of all species in compartment of model.
 
     Parameters
     ----------
-    model : bs4.BeautifulSoup object produced by parsing an SBML model
+    model : IndexedModel object produced by load_model()
         
     compartment_id : the id of a compartment
         
@@ -107,23 +53,17 @@ def get_species(model, compartment_id):
     ids : array listing id for each species in model
 
     """
-    ids = []
-    species_list = model.select_one("listOfSpecies")
-    if species_list:
-        for s in species_list.select("species"):
-            if s.attrs["compartment"] == compartment_id:
-                ids.append(s.attrs["id"])
-    return ids
+    return model.species_by_compartment.get(compartment_id, [])
 
 
-def get_species_compartment(model, species_id, species_compartments):
+def get_species_compartment(model, species_id):
     """
     Get the id of the compartment containing a species.
     Report params as belonging to compartment 'NONE'
 
     Parameters
     ----------
-    model : bs4.BeautifulSoup object produced by parsing an SBML model
+    model : IndexedModel object produced by load_model()
         
     species_id : id of the species
         
@@ -134,16 +74,10 @@ def get_species_compartment(model, species_id, species_compartments):
 
     """
 
-    if not species_compartments:
-        return "NONE"
-
-    if species_id in species_compartments.keys():
-        return species_compartments[species_id]
-    else:
-        return "NONE"
+    return model.species_compartment.get(species_id, "NONE")
 
 
-def get_reaction_details(model, reaction, species_compartments):
+def get_reaction_details(model, reaction):
     """
     Get details of a single reaction.
 
@@ -151,9 +85,9 @@ def get_reaction_details(model, reaction, species_compartments):
 
     Parameters
     ----------
-    model : bs4.BeautifulSoup object produced by parsing an SBML model
+    model : IndexedModel object produced by load_model()
 
-    reaction : bs4.BeautifulSoup object of the reaction of interest
+    reaction : lxml element of the reaction of interest
 
 
     Returns
@@ -164,7 +98,7 @@ def get_reaction_details(model, reaction, species_compartments):
 
     compartment : id of compartment
 
-    rate_law : BautifulSoup object containing math element of kineticLaw
+    rate_law : lxml element containing math element of kineticLaw (None if there is no kineticLaw)
 
     reactant_stoichiometries : list of stoichiometries of reactants
 
@@ -172,69 +106,147 @@ def get_reaction_details(model, reaction, species_compartments):
 
     """
 
-    if not reaction:
-        return [], [], False, False, [], []
+    if reaction is None:
+        return [], [], False, None, [], []
 
-    reactants = reaction.select_one("listOfReactants")
+    reactants = reaction.find("listOfReactants")
     reactant_list = []
     reactant_stoichiometries = []
     compartment = ""
-    if reactants:
-        for r in reactants.select("speciesReference"):
+    if reactants is not None:
+        for r in reactants.iter("speciesReference"):
 
-            if "stoichiometry" in r.attrs:
-                stoich = r.attrs["stoichiometry"]
+            if "stoichiometry" in r.attrib:
+                stoich = r.attrib["stoichiometry"]
             else:
                 stoich = "1"
 
             reactant_stoichiometries.append(stoich)
 
-            species = r.attrs["species"]
+            species = r.attrib["species"]
             reactant_list.append(species)
 
             if not compartment:
-                compartment = get_species_compartment(model, species, species_compartments)
-            if compartment != get_species_compartment(model, species, species_compartments):
+                compartment = get_species_compartment(model, species)
+            if compartment != get_species_compartment(model, species):
                 compartment = "NONE"
 
-    products = reaction.select_one("listOfProducts")
+    products = reaction.find("listOfProducts")
     product_list = []
     product_stoichiometries = []
-    if products:
-        for r in products.select("speciesReference"):
+    if products is not None:
+        for r in products.iter("speciesReference"):
 
-            if "stoichiometry" in r.attrs:
-                stoich = r.attrs["stoichiometry"]
+            if "stoichiometry" in r.attrib:
+                stoich = r.attrib["stoichiometry"]
             else:
                 stoich = "1"
 
             product_stoichiometries.append(stoich)
 
-            species = r.attrs["species"]
+            species = r.attrib["species"]
             product_list.append(species)
 
             # if reaction has no reactants, try to categorise by products instead
             if not compartment:
-                compartment = get_species_compartment(model, species, species_compartments)
-            if compartment != get_species_compartment(model, species, species_compartments):
+                compartment = get_species_compartment(model, species)
+            if compartment != get_species_compartment(model, species):
                 compartment = "NONE"
 
-    kinetic_law = reaction.select_one("kineticLaw")
-    if kinetic_law:
-        rate_law = kinetic_law.select_one("math")
+    kinetic_law = reaction.find("kineticLaw")
+    if kinetic_law is not None:
+        rate_law = kinetic_law.find("math")
     else:
-        rate_law = ""
+        rate_law = None
 
     return reactant_list, product_list, compartment, rate_law, reactant_stoichiometries, product_stoichiometries
 
 
+class ReactionAnalysis:
+    """
+    The details of a reaction that are needed to compare or abstract it, found by get_reaction_analysis().
+    """
+
+    def __init__(self, model, reaction):
+        self.reaction = reaction
+
+        self.reactants, self.products, self.compartment, self.rate_law, self.reactant_stoichiometries, \
+            self.product_stoichiometries = get_reaction_details(model, reaction)
+
+        # the id in each ci element of the rate law (in document order, including repeats), and the set of these ids
+        self.symbol_occurrences = []
+        self.rate_law_key = ""
+        if self.rate_law is not None:
+            self.symbol_occurrences = get_symbol_occurrences(self.rate_law)
+            self.rate_law_key = get_rate_law_key(self.rate_law, model)
+        self.symbols = set(self.symbol_occurrences)
+
+    def __getstate__(self):
+        # lxml elements cannot be pickled, so the reaction and its math are found again in the unpickled model (see
+        # IndexedModel.__setstate__())
+        state = self.__dict__.copy()
+        del state["reaction"]
+        del state["rate_law"]
+        return state
+
+    def attach(self, reaction):
+        """
+        Set the reaction element (and the math of its kineticLaw) described by an unpickled ReactionAnalysis.
+        """
+        self.reaction = reaction
+        kinetic_law = reaction.find("kineticLaw")
+        if kinetic_law is not None:
+            self.rate_law = kinetic_law.find("math")
+        else:
+            self.rate_law = None
+
+    def get_sign(self, model, symbol, use_sympy=False, samples=DEFAULT_SAMPLES):
+        """
+        Return the sign of the interaction between a symbol and the rate of this reaction (as determined by
+        categorise_interaction()). Signs are recorded only in model.interaction_signs (see get_interaction_sign()).
+        """
+        return get_interaction_sign(model, self.rate_law.getparent(), symbol, use_sympy=use_sympy, samples=samples)
+
+
+def get_symbol_occurrences(math):
+    """
+    Return the id in each ci element of a math element, in document order (including repeats, and those inside elements
+    that cannot be converted, such as piecewise).
+    """
+    # every element is kept referenced until the ci elements have been found: when lxml frees the proxy for an element
+    # it searches upwards for an ancestor that still has one, which is slow in deeply nested math
+    elements = list(math.iter())
+    return [element.text.strip() for element in elements if element.tag == "ci"]
+
+
+def get_reaction_analysis(model, reaction_id):
+    """
+    Get the details of a reaction, analysing it only the first time it is requested for this model.
+
+    Parameters
+    ----------
+    model : IndexedModel object produced by load_model()
+
+    reaction_id : id of the reaction
+
+
+    Returns
+    -------
+    a ReactionAnalysis object
+
+    """
+    if reaction_id not in model.reaction_analysis:
+        model.reaction_analysis[reaction_id] = ReactionAnalysis(model, model.reactions_by_id[reaction_id])
+    return model.reaction_analysis[reaction_id]
+
+
 def get_reactions(model):
     """
     Get list containing id for every reaction in model.
 
     Parameters
     ----------
-    model : bs4.BeautifulSoup object produced by parsing an SBML model
+    model : IndexedModel object produced by load_model()
         
 
     Returns
@@ -243,23 +255,18 @@ def get_reactions(model):
 
     """
     reactions = []
-
-    reaction_list = model.select_one("listOfReactions")
-    if not reaction_list:
-        return reactions
-
-    for r in reaction_list.select("reaction"):
-        reactions.append(r.attrs["id"])
+    for r in model.reactions:
+        reactions.append(r.attrib["id"])
     return reactions
 
 
-def get_rule_details(model, target_id, species_compartments):
+def get_rule_details(model, target_id):
     """
     Given the id of a species affected by a rule, find details of that rule.
 
     Parameters
     ----------
-    model : bs4.BeautifulSoup object produced by parsing an SBML model
+    model : IndexedModel object produced by load_model()
         
     target_id : the id of the species being affected
         
@@ -272,35 +279,29 @@ def get_rule_details(model, target_id, species_compartments):
 
     compartment : the id of the compartment containing the target
 
-    rate_law : BeautifulSoup object containing the math element for the rule
+    rate_law : lxml element containing the math element for the rule
 
     """
-    rule = model.select_one("listOfRules").find(variable=target_id)
-
-    species_ids = []
-    species_list = model.select_one("listOfSpecies")
-    if species_list:
-        for s in species_list.select("species"):
-            species_ids.append(s.attrs["id"])
+    rule = model.rules_by_variable.get(target_id)
 
-    if not rule:
-        return [], False, False
+    if rule is None:
+        return [], False, None
 
-    target = rule.attrs["variable"]
+    target = rule.attrib["variable"]
 
     # get modifier details
     modifiers = []
-    for ci in rule.select("ci"):
+    for ci in rule.iter("ci"):
 
         # Check if this is a species id (it could validly be a species/compartment/parameter/function/reaction id)
-        species_id = ci.string.strip()
-        if species_id not in species_ids:
+        species_id = ci.text.strip()
+        if species_id not in model.species_by_id:
             continue
 
         modifiers.append(species_id)
 
-    compartment = get_species_compartment(model, target, species_compartments).strip()
-    rate_law = rule.select_one("math")
+    compartment = get_species_compartment(model, target).strip()
+    rate_law = rule.find("math")
     return modifiers, compartment, rate_law
 
 
@@ -311,7 +312,7 @@ def get_variables_set_by_rules(model):
 
     Parameters
     ----------
-    model : bs4.BeautifulSoup object produced by parsing an SBML model
+    model : IndexedModel object produced by load_model()
         
 
     Returns
@@ -320,15 +321,12 @@ def get_variables_set_by_rules(model):
 
     """
     species = []
-    rule_list = model.select_one("listOfRules")
-
-    if not rule_list:
-        return []
-
-    for r in rule_list.select("assignmentRule"):
-        species.append(r.attrs["variable"])
-    for r in rule_list.select("rateRule"):
-        species.append(r.attrs["variable"])
+    for r in model.rules:
+        if r.tag == "assignmentRule":
+            species.append(r.attrib["variable"])
+    for r in model.rules:
+        if r.tag == "rateRule":
+            species.append(r.attrib["variable"])
     return species
 
 
@@ -338,7 +336,7 @@ def get_species_name(model, species_id):
 
     Parameters
     ----------
-    model : bs4.BeautifulSoup object produced by parsing an SBML model
+    model : IndexedModel object produced by load_model()
         
     species_id : id of the species
         
@@ -348,9 +346,9 @@ def get_species_name(model, species_id):
     name of the species, if set (otherwise returns the id)
 
     """
-    s = model.select_one("listOfSpecies").find(id=species_id)
-    if "name" in s.attrs.keys() and s.attrs["name"]:
-        return s.attrs["name"]
+    s = model.species_by_id[species_id]
+    if "name" in s.attrib.keys() and s.attrib["name"]:
+        return s.attrib["name"]
     else:
         return species_id
 
@@ -361,7 +359,7 @@ def get_reaction_name(model, reaction_id):
 
     Parameters
     ----------
-    model : bs4.BeautifulSoup object produced by parsing an SBML model
+    model : IndexedModel object produced by load_model()
         
     reaction_id : id of the reaction
         
@@ -371,8 +369,297 @@ def get_reaction_name(model, reaction_id):
     name of the reaction, if set (otherwise returns the id)
 
     """
-    r = model.select_one("listOfReactions").find(id=reaction_id)
-    if "name" in r.attrs.keys() and r.attrs["name"]:
-        return r.attrs["name"]
-    else:
-        return reaction_id
+    return model.reaction_names[reaction_id]
+
+
+def get_param_name(model, param_id):
+    """
+    Return the name of the parameter (or other entity) with a given id.
+
+    Parameters
+    ----------
+    model : IndexedModel object produced by load_model()
+
+    param_id : id of the parameter
+
+
+    Returns
+    -------
+    name of the parameter, if set (otherwise returns the id)
+
+    """
+    param = model.get_element(param_id)
+    if param is not None and "name" in param.attrib:
+        return param.attrib["name"]
+    return param_id
+
+
+def get_converted_rate_law(model, math):
+    """
+    Return the human-readable form of a math element, converting it only if the same expression has not already been
+    converted for this model.
+
+    Parameters
+    ----------
+    model : IndexedModel object produced by load_model()
+
+    math : lxml element corresponding to a math element (or None)
+
+
+    Returns
+    -------
+    string representing the expression (empty if math is None)
+
+    """
+    if math is None:
+        return ""
+
+    key = get_math_source(model, math)
+    if key not in model.converted_rate_laws:
+        model.converted_rate_laws[key] = convert_rate_law(get_model_expression(model, math)[1])
+    return model.converted_rate_laws[key]
+
+
+def get_model_expression(model, math):
+    """
+    Return the serialised form of a math element of a model, and its MathExpression, serialising the element only the
+    first time it is requested.
+
+    Parameters
+    ----------
+    model : IndexedModel object produced by load_model()
+
+    math : lxml element corresponding to a math element
+
+
+    Returns
+    -------
+    a tuple (source, MathExpression object)
+
+    """
+    source, expression = model.math_expressions.get(math, (None, None))
+    if expression is None:
+        source = get_math_source(model, math)
+        expression = get_math_expression(math, source)
+        model.math_expressions[math] = (source, expression)
+    return source, expression
+
+
+def get_math_source(model, math):
+    """
+    Return the serialised form of a math element of a model, serialising it only the first time it is requested (as
+    get_model_expression() does, but without parsing the element).
+    """
+    entry = model.math_expressions.get(math)
+    if entry is None:
+        entry = (etree.tostring(math, with_tail=False), None)
+        model.math_expressions[math] = entry
+    return entry[0]
+
+
+def get_rate_law_key(math, model=None):
+    """
+    Return a key identifying a math expression, which is equal for expressions that differ only in the order of
+    commutative operations or the way numbers are written (see math_ast.get_canonical_key()).
+
+    Parameters
+    ----------
+    math : lxml element representing a math element (or None)
+
+    model : IndexedModel object containing the math element (if given, the element is serialised only once, and the key
+        is recorded in model.rate_law_keys)
+
+    Returns
+    -------
+    string ("" if math is None)
+
+    """
+    if math is None:
+        return ""
+    if model is not None:
+        source = get_math_source(model, math)
+        if source not in model.rate_law_keys:
+            model.rate_law_keys[source] = get_model_expression(model, math)[1].get_canonical_key()
+        return model.rate_law_keys[source]
+    return get_math_expression(math).get_canonical_key()
+
+
+def get_interaction_sign(model, kinetic_law, species_id, use_sympy=False, samples=DEFAULT_SAMPLES):
+    """
+    Return the result of categorise_interaction() for a kineticLaw (or rule, or eventAssignment) and a species,
+    reusing the result if it has already been determined for this model.
+
+    Parameters
+    ----------
+    model : IndexedModel object produced by load_model()
+
+    kinetic_law : lxml element containing the math element to be analysed
+
+    species_id : the species id
+
+    use_sympy : Boolean indicating whether to determine the sign symbolically
+
+    samples : number of operating points at which to compare the expression, if the sign is determined numerically
+
+
+    Returns
+    -------
+    string representing the sign of the interaction
+
+    If the sign could not be determined symbolically within the budget set by set_symbolic_budget(), it is determined
+    numerically, and the expression is listed in model.symbolic_timeouts.
+
+    """
+    math = kinetic_law.find("math")
+    source = get_math_source(model, math)
+    key = (source, species_id, bool(use_sympy), samples)
+    if key not in model.interaction_signs:
+        # as categorise_interaction(), but using the expression already found for the math element
+        expression = get_model_expression(model, math)[1]
+        sign = None
+        timed_out = []
+        if len(math):
+            sign = categorise_expression(expression, species_id, model.initial_values, use_sympy=use_sympy,
+                                         samples=samples, timed_out_laws=timed_out)
+        model.interaction_signs[key] = sign
+
+        if timed_out:
+            description = describe_expression(kinetic_law)
+            if description not in model.symbolic_timeouts:
+                model.symbolic_timeouts.append(description)
+    return model.interaction_signs[key]
+
+
+def describe_expression(element):
+    """
+    Return a short description of the kineticLaw, rule or eventAssignment containing a math element, for use in messages.
+    """
+    if element.tag == "kineticLaw":
+        reaction = element.getparent()
+        if reaction is not None and reaction.get("id"):
+            return describe_reaction(reaction.get("id"))
+    elif element.tag == "eventAssignment":
+        event = element.getparent()
+        if event is not None:
+            event = event.getparent()
+        if event is not None and event.get("id"):
+            return "assignment to %s in event %s" % (element.get("variable"), event.get("id"))
+    elif element.get("variable"):
+        return describe_rule(element.tag, element.get("variable"))
+    return element.tag
+
+
+def describe_reaction(reaction_id):
+    """
+    Return the description (see describe_expression()) of the kineticLaw of a reaction.
+    """
+    return "reaction %s" % reaction_id
+
+
+def describe_rule(tag, variable):
+    """
+    Return the description (see describe_expression()) of a rule, given its tag and the variable it sets.
+    """
+    return "%s for %s" % (tag, variable)
+
+
+def analyse_model(model, use_sympy=False, samples=DEFAULT_SAMPLES):
+    """
+    Convert every kineticLaw, rule, event trigger and event assignment of a model, determine the sign of the
+    interaction between each expression and each of the symbols it contains, and find the ReactionAnalysis of each
+    reaction and the canonical key of each rule, so that the results can be cached (or returned from a worker process)
+    with the model, and the math need not be parsed again when it is compared.
+
+    Parameters
+    ----------
+    model : IndexedModel object produced by load_model(), in which functions have been inlined
+
+    use_sympy : Boolean indicating whether to determine signs symbolically
+
+    samples : number of operating points at which to compare each expression, if signs are determined numerically
+
+    """
+    expressions = []
+    for reaction in model.reactions:
+        kinetic_law = reaction.find("kineticLaw")
+        if kinetic_law is not None:
+            expressions.append(kinetic_law)
+    expressions.extend(model.rules)
+    for event in model.events:
+        trigger = event.find("trigger")
+        if trigger is not None:
+            get_converted_rate_law(model, trigger.find("math"))
+        expressions.extend(event.iter("eventAssignment"))
+
+    for expression in expressions:
+        analyse_expression(model, expression, use_sympy, samples)
+
+    for reaction_id in model.reactions_by_id:
+        get_reaction_analysis(model, reaction_id)
+    for rule in model.rules:
+        get_rate_law_key(rule.find("math"), model)
+    model.analysed_with = (bool(use_sympy), samples)
+
+
+def analyse_expression(model, expression, use_sympy=False, samples=DEFAULT_SAMPLES):
+    """
+    Convert the math of a kineticLaw, rule or eventAssignment, and determine the sign of the interaction between it and
+    each of the symbols it contains (as analyse_model() does for every expression in a model).
+
+    Parameters
+    ----------
+    model : IndexedModel object produced by load_model(), in which functions have been inlined
+
+    expression : lxml element containing the math element to be analysed
+
+    use_sympy : Boolean indicating whether to determine signs symbolically
+
+    samples : number of operating points at which to compare the expression, if signs are determined numerically
+
+    Returns
+    -------
+    a tuple (source, converted_law, signs, timeouts), which can be passed to store_expression_analysis(): the serialised
+    math element, its converted form, a list of (symbol, sign) pairs, and a list of the descriptions added to
+    model.symbolic_timeouts for it (or None, if there is no math element)
+
+    """
+    math = expression.find("math")
+    if math is None:
+        return None
+    converted_law = get_converted_rate_law(model, math)
+    source, math_expression = get_model_expression(model, math)
+
+    signs = []
+    for symbol in math_expression.symbols:
+        try:
+            signs.append((symbol, get_interaction_sign(model, expression, symbol, use_sympy=use_sympy,
+                                                       samples=samples)))
+        except SIGN_ERRORS:
+            # the sign is not recorded, so the comparison that needs it will raise the error again and report it
+            pass
+
+    timeouts = []
+    description = describe_expression(expression)
+    if description in model.symbolic_timeouts:
+        timeouts.append(description)
+
+    return source, converted_law, signs, timeouts
+
+
+def store_expression_analysis(model, analysis, use_sympy=False, samples=DEFAULT_SAMPLES):
+    """
+    Record the result of analyse_expression() (which may have been called in another process) in a model, so that the
+    expression is not analysed again. Results already recorded are kept. The converted law may be None, if it was not
+    needed.
+    """
+    if analysis is None:
+        return
+    source, converted_law, signs, timeouts = analysis
+
+    if converted_law is not None:
+        model.converted_rate_laws.setdefault(source, converted_law)
+    for symbol, sign in signs:
+        model.interaction_signs.setdefault((source, symbol, bool(use_sympy), samples), sign)
+    for description in timeouts:
+        if description not in model.symbolic_timeouts:
+            model.symbolic_timeouts.append(description)
@@ -1,18 +1,54 @@
-from bs4 import NavigableString, Tag
-from rate_laws import convert_rate_law
-import math  # needed for check_sign_numerically()
+from rate_laws import convert_rate_law, compile_rate_law
+from math_ast import get_math_expression
+from lxml import etree
+from multiprocessing import Pipe
+import atexit
+import numpy
+import os
+import signal
 
+# Default number of operating points at which check_sign_numerically() compares the value of an expression
+DEFAULT_SAMPLES = 10
 
-def categorise_interaction(kinetic_law, species_id, initial_values, use_sympy=False):
+# Default limits on the time (in seconds) and memory (in MB) used by check_sign_algebraically() for each expression
+DEFAULT_SYMPY_TIMEOUT = 30
+DEFAULT_SYMPY_MEMORY = 1024
+
+
+class SymbolicTimeout(Exception):
+    """
+    Raised by check_sign_algebraically() if the sign of an expression could not be determined within the time and memory
+    set by set_symbolic_budget().
+    """
+    pass
+
+
+# The errors that categorise_expression() raises for an expression whose sign cannot be determined: TypeError if it
+# contains MathML that cannot be converted (see rate_laws.convert_rate_law()), and ValueError or RuntimeError if sympy
+# fails to convert or differentiate it (errors in the symbolic worker are re-raised as RuntimeError)
+SIGN_ERRORS = (TypeError, ValueError, RuntimeError)
+
+
+def categorise_interaction(kinetic_law, species_id, initial_values, use_sympy=False, samples=DEFAULT_SAMPLES,
+                           timed_out_laws=None):
     """
     Given a kineticLaw and the name of a species, determine whether the expression is a monotonic_increasing,
-    monotonic_decreasing, or constant with respect to the concentration of that species.
+    monotonic_decreasing, constant or mixed with respect to the concentration of that species.
 
     Parameters
     ----------
-    kinetic_law : bs4.element.Tag corresponding to a kineticLaw
+    kinetic_law : lxml element corresponding to a kineticLaw
         
     species_id : the species id
+
+    initial_values : dict giving the initial value of each species/parameter (as strings)
+
+    use_sympy : Boolean indicating whether to determine the sign symbolically
+
+    samples : number of operating points at which to compare the expression, if the sign is determined numerically
+
+    timed_out_laws : list to which kinetic_law is appended if its sign could not be determined symbolically within the
+        budget set by set_symbolic_budget() (in which case the sign is determined numerically instead)
         
 
     Returns
@@ -20,96 +56,508 @@ def categorise_interaction(kinetic_law, species_id, initial_values, use_sympy=Fa
     string representing the sign of the interaction
 
     """
-    for math_expr in kinetic_law.select_one("math"):
-        if isinstance(math_expr, NavigableString):
-            continue
+    for math_expr in kinetic_law.find("math"):
+        timed_out = []
+        sign = categorise_expression(math_expr, species_id, initial_values, use_sympy, samples, timed_out)
+        if timed_out and timed_out_laws is not None:
+            timed_out_laws.append(kinetic_law)
+        return sign
 
-        # identify all parameters and concentrations in the rate law
-        symbols = []
 
-        if isinstance(math_expr, Tag) and math_expr.name == "ci":
-            symbols.append(math_expr.text.strip())
-        else:
-            for ci in math_expr.findAll("ci"):
-                symbols.append(ci.text.strip())
-        symbols = set(symbols)
+def categorise_expression(math, species_id, initial_values, use_sympy=False, samples=DEFAULT_SAMPLES,
+                          timed_out_laws=None):
+    """
+    Determine the sign of the interaction between a math expression and a species, as categorise_interaction() does for
+    the expression in a kineticLaw.
 
-        if use_sympy:
-            return check_sign_algebraically(math_expr, symbols, species_id, initial_values)
-        else:
-            return check_sign_numerically(math_expr, symbols, species_id, initial_values)
+    Parameters
+    ----------
+    math : lxml element corresponding to the contents of a math element, or the MathExpression for it
+
+    timed_out_laws : list to which math is appended if the sign could not be determined symbolically within the budget
+
+    (the remaining parameters and the result are as for categorise_interaction())
+
+    Raises
+    ------
+    one of SIGN_ERRORS, if the sign cannot be determined
+
+    """
+    # identify all parameters and concentrations in the rate law
+    symbols = set(get_math_expression(math).symbols)
+
+    if use_sympy:
+        try:
+            return check_sign_algebraically(math, symbols, species_id, initial_values)
+        except SymbolicTimeout:
+            if timed_out_laws is not None:
+                timed_out_laws.append(math)
+    return check_sign_numerically(math, symbols, species_id, initial_values, samples)
 
 
 def check_sign_algebraically(expr, param_names, species_id, initial_values):
+    """
+    Given a MathML expression and the name of a species, determine symbolically (using sympy) whether the expression is
+    monotonic_increasing or monotonic_decreasing with respect to the concentration of that species.
+
+    Each expression is converted to a sympy expression only once (by get_symbolic_rate_law()), and the sign of its
+    derivative with respect to each species is found only once.
+
+    If a budget has been set by set_symbolic_budget(), this is done in a worker process, which is stopped if the
+    expression takes too long or uses too much memory.
+
+    Parameters
+    ----------
+    expr : lxml element corresponding to the contents of a math element (or the MathExpression for it)
+
+    param_names : list of the names of all parameters
+
+    species_id : the species we are interested in
+
+
+    Returns
+    -------
+    string representing the sign of the interaction ("?" if this cannot be determined)
+
+    Raises
+    ------
+    SymbolicTimeout, if the budget is exceeded
+
+    """
+    if symbolic_worker is not None:
+        return symbolic_worker.get_sign(expr, species_id)
+    return get_symbolic_rate_law(expr).get_sign(species_id)
+
+
+class SymbolicRateLaw:
+    """
+    A math expression converted to a sympy expression, in which every identifier is a positive symbol and common
+    subexpressions are shared (see eliminate_common_subexpressions()), together with the signs of its derivatives that
+    have been found so far.
+    """
+
+    def __init__(self, math):
+        """
+
+        Parameters
+        ----------
+        math : lxml element representing a math expression
+
+        """
+        import sympy
+
+        # each identifier is replaced by a sympy Symbol, passed to a function constructed from the converted expression
+        expression = get_math_expression(math)
+        names = expression.symbols
+        symbol_names = expression.get_indexed_symbol_names()
+
+        self.expression = None
+        converted = convert_rate_law(math, output_type="sympy", symbol_names=symbol_names)
+        if converted and converted != "piecewise":
+            namespace = {"sympy": sympy, "t": get_symbol("t"), "N_A": get_symbol("N_A")}
+            function = eval("lambda v: %s" % converted, namespace)
+            law = sympy.sympify(function([get_symbol(name) for name in names]))
+            self.expression = eliminate_common_subexpressions(law)
+
+        self.signs = {}
+
+    def get_sign(self, species_id):
+        """
+        Return the sign of the derivative of the expression with respect to a species, as "monotonic_increasing",
+        "monotonic_decreasing" or "?".
+        """
+        if species_id not in self.signs:
+            self.signs[species_id] = self.find_sign(species_id)
+        return self.signs[species_id]
+
+    def find_sign(self, species_id):
+        import sympy
+
+        if self.expression is None:
+            return "?"
 
+        derivative = sympy.simplify(self.expression.diff(get_symbol(species_id)))
+        if derivative.is_positive:
+            return "monotonic_increasing"
+        elif derivative.is_negative:
+            return "monotonic_decreasing"
+        else:
+            return "?"
+
+
+def eliminate_common_subexpressions(expression):
+    """
+    Rebuild a sympy expression so that every occurrence of a repeated subexpression is the same object: the
+    subexpressions found by sympy.cse() are substituted back into the reduced expression, innermost first. Sympy caches
+    the results of differentiating and simplifying an object, so the shared subexpressions are then processed once for
+    each species, however often they occur in the law.
+    """
     import sympy
+
+    replacements, reduced = sympy.cse(expression)
+    expression = reduced[0]
+    for symbol, value in reversed(replacements):
+        expression = expression.xreplace({symbol: value})
+    return expression
+
+
+def get_symbol(name):
+    """
+    Return the sympy Symbol representing an identifier (which, like every parameter and concentration, is positive).
+    """
     from sympy import Symbol
+    return Symbol(name, positive=True)
 
-    # create variables for each param and species
-    for parameter_name in param_names:
-        exec("%s = Symbol('%s', positive=True)" % (parameter_name, parameter_name))
 
-    # create variables for time and avogadro's constant: N_A
-    exec("t = Symbol('t', positive=True)")
-    exec("N_A = Symbol('N_A', positive=True)")
+def get_symbolic_rate_law(math):
+    """
+    Return the SymbolicRateLaw for a math expression, converting it only if no equivalent math element (one with the
+    same MathExpression) has been converted before.
+    """
+    expression = get_math_expression(math)
+    if expression.symbolic is None:
+        expression.symbolic = SymbolicRateLaw(math)
+    return expression.symbolic
+
+
+class SymbolicWorker:
+    """
+    A child process in which check_sign_algebraically() determines signs, so that it can be killed if a single
+    expression takes too long or uses too much memory.
+
+    The process is forked when first needed and reused for every expression (so it keeps its own cache of
+    SymbolicRateLaw objects); after it has been killed, a new process is started for the next expression.
+    """
+
+    def __init__(self, timeout, memory):
+        """
+
+        Parameters
+        ----------
+        timeout : maximum time (in seconds) to spend on a single sign, or None for no limit
+        memory : maximum memory (in MB) that the process may use in addition to that of its parent, or None for no limit
+
+        """
+        self.timeout = timeout
+        self.memory = memory
+        self.pid = None
+        self.connection = None
+        self.parent_pid = None
 
-    exec("query_var = %s" % species_id)
+        # serialised math of the expressions that have exceeded the budget
+        self.timed_out = set()
 
-    converted_rate_law = convert_rate_law(expr, output_type="sympy")
-    if converted_rate_law == "piecewise":
-        return "?"
+    def start(self):
+        parent_connection, child_connection = Pipe()
 
-    exec("rate = %s" % converted_rate_law)
-    if sympy.simplify(rate.diff(query_var)).is_positive:
-        return "monotonic_increasing"
-    elif sympy.simplify(rate.diff(query_var)).is_negative:
-        return "monotonic_decreasing"
-    else:
-        return "?"
+        # os.fork() is used directly, as the multiprocessing module does not allow a pool worker to start a process
+        pid = os.fork()
+        if pid == 0:
+            parent_connection.close()
+            status = 0
+            try:
+                serve_symbolic_worker(child_connection, self.memory)
+            except BaseException:
+                status = 1
+            os._exit(status)
 
-def check_sign_numerically(expr, param_names, species_id, initial_values):
+        child_connection.close()
+        self.pid = pid
+        self.connection = parent_connection
+        self.parent_pid = os.getpid()
+
+    def stop(self):
+        if self.pid is None or self.parent_pid != os.getpid():
+            self.pid = None
+            return
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        self.connection.close()
+        self.pid = None
+        self.connection = None
+
+    def get_sign(self, math, species_id):
+        """
+        Return the result of SymbolicRateLaw.get_sign() for a math expression and species, or raise SymbolicTimeout if
+        it could not be found within the budget (or if the expression has already exceeded the budget for another
+        species).
+        """
+        key = get_math_expression(math).source
+        if key in self.timed_out:
+            raise SymbolicTimeout()
+
+        # a worker started before this process was forked (e.g. by a Pool) belongs to the original process
+        if self.pid is not None and self.parent_pid != os.getpid():
+            self.pid = None
+        if self.pid is None:
+            self.start()
+
+        result = None
+        try:
+            self.connection.send((key, species_id))
+            if self.connection.poll(self.timeout):
+                result = self.connection.recv()
+        except (EOFError, IOError):
+            # the worker was killed (e.g. for exceeding its memory limit)
+            pass
+
+        if result is None:
+            self.stop()
+            self.timed_out.add(key)
+            raise SymbolicTimeout()
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def load_sympy():
+    """
+    Import sympy, and mpmath (which it imports lazily), so that processes forked afterwards do not each import them.
+    """
+    import sympy
+    sympy.Symbol("x").evalf()
+
+
+def serve_symbolic_worker(connection, memory):
+    """
+    Determine signs for a SymbolicWorker: receive a serialised math expression and a species id, and send back the sign
+    (or the exception raised, or None if the memory limit was reached), until the parent closes the connection.
+    """
+    # import sympy before the memory limit applies
+    load_sympy()
+
+    if memory:
+        try:
+            import resource
+            limit = get_address_space_size() + memory * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError):
+            pass
+
+    # the expression for each serialised math element received, kept so that its SymbolicRateLaw is reused
+    expressions = {}
+
+    while True:
+        try:
+            key, species_id = connection.recv()
+        except EOFError:
+            return
+
+        if key not in expressions:
+            # the serialised math declares the MathML namespace, which is not used by convert_rate_law()
+            math = etree.fromstring(key)
+            for element in math.iter():
+                element.tag = etree.QName(element).localname
+            expressions[key] = get_math_expression(math)
+
+        try:
+            result = get_symbolic_rate_law(expressions[key]).get_sign(species_id)
+        except MemoryError:
+            result = None
+        except Exception, e:
+            result = RuntimeError(str(e))
+        connection.send(result)
+
+
+def get_address_space_size():
+    """
+    Return the size (in bytes) of the virtual address space of the current process, or 0 if this cannot be found.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+
+
+# The SymbolicWorker used by check_sign_algebraically(), if a budget has been set
+symbolic_worker = None
+
+
+def set_symbolic_budget(timeout=DEFAULT_SYMPY_TIMEOUT, memory=DEFAULT_SYMPY_MEMORY):
+    """
+    Limit the time and memory that check_sign_algebraically() may spend on each expression. Expressions that exceed the
+    limit are analysed numerically instead (see categorise_interaction()).
+
+    Parameters
+    ----------
+    timeout : maximum time (in seconds) to spend on each sign, or None (or 0) for no limit
+    memory : maximum memory (in MB) to use in addition to that already used by sbml-diff, or None (or 0) for no limit
+
+    """
+    global symbolic_worker
+    if symbolic_worker is not None:
+        symbolic_worker.stop()
+        symbolic_worker = None
+
+    if not hasattr(os, "fork") or not (timeout or memory):
+        return
+    symbolic_worker = SymbolicWorker(timeout or None, memory or None)
+
+
+def get_symbolic_budget():
+    """
+    Return the (timeout, memory) set by set_symbolic_budget(), or (None, None) if there is no limit.
+    """
+    if symbolic_worker is None:
+        return None, None
+    return symbolic_worker.timeout, symbolic_worker.memory
+
+
+@atexit.register
+def stop_symbolic_worker():
+    if symbolic_worker is not None:
+        symbolic_worker.stop()
+
+
+def check_sign_numerically(expr, param_names, species_id, initial_values, samples=DEFAULT_SAMPLES):
     """
     Given a MathML expression, list of all parameter/species names, and the name of a species, determine whether the
-    expression is a monotonic_increasing, monotonic_decreasing, or constant with respect to the concentration of that
-    species.
+    expression is a monotonic_increasing, monotonic_decreasing, constant or mixed with respect to the concentration of
+    that species.
+
+    The expression is compiled once (by compile_rate_law()), then evaluated at a batch of sampled operating points in a
+    single NumPy call. At the first point, every other parameter and species concentration takes its initial value (or 1,
+    if this is not known); at the remaining points, each of these is scaled by a random factor between 0.1 and 10. At
+    each point, the value of the expression when the concentration of interest is 1 (scaled by the same kind of factor)
+    is compared to its value when the concentration is 100 times smaller.
+
+    The signs for every symbol in the expression are found at once, and stored with the compiled expression, so that
+    later calls for other species in the same expression need not evaluate it again.
 
-    This is done by setting all parameters and the concentrations of other species to 1, then comparing the value of the
-    expression when the concentration of interest is 1 or 0.
-    This approach will fail to report that a kineticLaw is mixed (rather than monotonic) if:
-    - the sign of its gradient depends on value of one of the parameters (eg x^a/x^b)
-    - the sign of its gradient depends on the concentration of the corresponding species
+    This approach will fail to report that a kineticLaw is mixed (rather than monotonic) if its gradient changes sign only
+    outside the region sampled.
 
 
     Parameters
     ----------
-    expr : bs4.element.Tag object corresponding to the contents of a math element
+    expr : lxml element corresponding to the contents of a math element (or the MathExpression for it)
         
     param_names : list of the names of all parameters
         
     species_id : list of the species we are interested in
-        
+
+    initial_values : dict giving the initial value of each species/parameter (as strings)
+
+    samples : number of operating points at which to compare the value of the expression
+
 
     Returns
     -------
+    string representing the sign of the interaction ("?" if this cannot be determined)
 
     """
 
-    expr1 = convert_rate_law(expr, initial_values, non_default_variables=[species_id], non_default_values='1', output_type="executable")
-    expr2 = convert_rate_law(expr, initial_values, non_default_variables=[species_id], non_default_values='0.01', output_type="executable")
-
-    if not expr1 or not expr2:
+    compiled = compile_rate_law(expr)
+    if compiled.function is None:
         return '?'
 
-    param_names.remove(species_id)
+    base_values = tuple(get_symbol_values(compiled, initial_values))
+    key = (base_values, samples)
+    if key not in compiled.signs:
+        compiled.signs[key] = classify_all_symbols(compiled, base_values, samples)
 
+    return compiled.signs[key].get(species_id, "constant")
+
+
+def classify_all_symbols(compiled, base_values, samples):
+    """
+    Determine the sign of the interaction between a compiled expression and each of its symbols, using finite
+    differences at a batch of sampled points (as described for check_sign_numerically()).
+
+    Parameters
+    ----------
+    compiled : CompiledRateLaw object
+
+    base_values : list of the initial value of each symbol in compiled.symbols
+
+    samples : number of operating points
+
+
+    Returns
+    -------
+    dict giving the sign of the interaction with each symbol
+
+    """
+    num_symbols = len(compiled.symbols)
+    samples = max(samples, 1)
+
+    # factors[i, j] scales the i'th symbol at the j'th point; the first point is unscaled
+    random_state = numpy.random.RandomState(0)
+    factors = numpy.ones((num_symbols, samples))
+    factors[:, 1:] = 10 ** random_state.uniform(-1, 1, (num_symbols, samples - 1))
+    points = numpy.array(base_values, dtype=float).reshape((num_symbols, 1)) * factors
+
+    # For each symbol, one block of points in which that symbol is high, and one in which it is low
+    blocks = []
+    for index in range(num_symbols):
+        high = points.copy()
+        high[index, :] = factors[index, :]
+        low = points.copy()
+        low[index, :] = 0.01 * factors[index, :]
+        blocks.extend([high, low])
+
+    if not blocks:
+        return {}
+
+    rates = compiled.evaluate_points(numpy.hstack(blocks)).reshape((num_symbols, 2, samples))
+
+    signs = {}
+    for index, symbol in enumerate(compiled.symbols):
+        with numpy.errstate(invalid="ignore"):
+            # e.g. inf - inf; points where the change is not finite are ignored
+            rate_change = rates[index, 0, :] - rates[index, 1, :]
+        rate_change = rate_change[numpy.isfinite(rate_change)]
+
+        if len(rate_change) == 0:
+            signs[symbol] = "?"
+        elif (rate_change > 0).any() and (rate_change < 0).any():
+            signs[symbol] = "mixed"
+        elif (rate_change > 0).any():
+            signs[symbol] = "monotonic_increasing"
+        elif (rate_change < 0).any():
+            signs[symbol] = "monotonic_decreasing"
+        else:
+            signs[symbol] = "constant"
+
+    return signs
+
+
+def get_symbol_values(compiled, initial_values):
+    """
+    Construct the list of the initial values of the symbols in a CompiledRateLaw. Symbols whose initial value is not
+    known take the value 1.0.
+
+    Parameters
+    ----------
+    compiled : CompiledRateLaw object
+
+    initial_values : dict giving the initial value of each species/parameter (as strings)
+
+
+    Returns
+    -------
+    list containing the value of each symbol in compiled.symbols
+
+    """
+    values = []
+    for symbol in compiled.symbols:
+        if symbol in initial_values:
+            values.append(parse_value(initial_values[symbol]))
+        else:
+            values.append(1.0)
+    return values
+
+
+def parse_value(value):
+    """
+    Convert the value of an SBML attribute to a number (NaN if it is not a number).
+    """
     try:
-        rate_change = eval(expr1) - eval(expr2)
-    except (ZeroDivisionError, ValueError, OverflowError):
-        return "?"
-
-    if rate_change > 0:
-        return "monotonic_increasing"
-    elif rate_change == 0:
-        return "constant"
-    else:
-        return "monotonic_decreasing"
+        return float(value)
+    except ValueError:
+        return float("nan")
@@ -1,13 +1,22 @@
+from model_sets import to_mask, full_mask, classify, popcount, lowest_model, contains_model, NO_MODELS, ONE_MODEL, \
+    ALL_MODELS
+
+# Sequential scheme used by the heat scale, from features in few models to features in most (the darker colors of YlOrRd
+# from http://colorbrewer2.org)
+HEAT_COLORS = ["#FED976", "#FEB24C", "#FD8D3C", "#FC4E2A", "#E31A1C", "#BD0026", "#800026"]
+
+
 class GenerateDot:
     """This class actually generates the DOT output.
     
-    It has no dependency on BeautifulSoup, and works with strings, rather than BeautifulSoup objects.
+    It has no dependency on lxml, and works with strings, rather than lxml elements.
 
-    The print_ functions accept an argument model_set, which specifies which models contain the corresponding feature.
+    The print_ functions accept an argument model_set, which specifies which models contain the corresponding feature,
+    as a bitmask (see model_sets) or a list of model numbers.
     """
 
     def __init__(self, colors, num_models, reaction_label="", selected_model="", show_stoichiometry=False, rankdir="TB",
-                 model_names=False):
+                 model_names=False, heat_scale=False):
         """
 
         Parameters
@@ -17,6 +26,9 @@ class GenerateDot:
         reaction_label : option specifying how reaction nodes are labelled ("none"/"name"/"rate"/"name+rate")
         selected_model : if this is specified, any feature that is not in this model is given style 'invis'
         show_stoichiometry : if true, arrow between species and reaction nodes are labelled with stoichiometric coefficient
+        heat_scale : if true, features that are not in every model are colored according to the number of models that
+            contain them (from HEAT_COLORS), rather than by which model contains them; this is more useful than a color
+            per model when many models are compared
 
         """
         self.colors = colors
@@ -26,10 +38,14 @@ class GenerateDot:
         # http://geog.uoregon.edu/datagraphics/color_scales.htm#Categorical%20Color%20Schemes
         default_colors = ["#FFBF7F", "#FF7F00", "#FFFF99", "#FFFF32", "#B2FF8C", "#32FF00",
                           "#A5EDFF", "#19B2FF", "#CCBFFF", "#654CFF", "#FF99BF", "#E51932"]
-        if len(self.colors) < self.num_models:
-            spare_colors = set(default_colors).difference(self.colors)
+        if len(self.colors) < self.num_models and not heat_scale:
+            spare_colors = [color for color in default_colors if color not in self.colors]
             extra_colors = self.num_models - len(self.colors)
-            self.colors.extend(spare_colors[1:extra_colors])
+            self.colors.extend(spare_colors[:extra_colors])
+            if len(self.colors) < self.num_models:
+                raise RuntimeError("There are too few colors to distinguish %s models; use a heat scale instead"
+                                   % self.num_models)
+        self.heat_scale = heat_scale
 
         self.selected_model = ""
         if selected_model != "":
@@ -44,6 +60,14 @@ class GenerateDot:
         self.rankdir = rankdir
         self.differences_found = False
 
+        # the bitmask containing every model, and the color and style already determined for each bitmask
+        self.all_models = full_mask(num_models)
+        self.mask_colors = {}
+        self.mask_styles = {}
+
+        # whether an arrow for a mixed interaction has been drawn, in which case print_footer() explains its arrowhead
+        self.mixed_arrows_drawn = False
+
     def generate_dot(self, diff_object):
         self.print_header()
 
@@ -81,21 +105,19 @@ class GenerateDot:
                 if r.compare_attribute("is_transcription") == True:
                     product_status = {}
                     for product in reaction.transcription_product_arrows:
-                        if product not in product_status.keys():
-                            product_status[product] = set()
-
                         product_arrows = reaction.transcription_product_arrows[product]
-                        for r1 in product_arrows.record.keys():
+                        for r1 in product_arrows.record:
                             model_set = product_arrows.record[r1]
-                        product_status[product] = product_status[product].union(model_set)
+                        product_status[product] = product_status.get(product, 0) | model_set
 
-                    self.print_transcription_reaction_node(r.get_models(), reaction.reaction_id, r.compare_attribute("rate_law"), r.compare_attribute("reaction_name"), r.compare_attribute("converted_rate_law"), product_status)
+                    self.print_transcription_reaction_node(r.get_models(), reaction.reaction_id, r.compare_attribute("rate_law"), r.compare_attribute("reaction_name"), r.compare_attribute("converted_rate_law", key_attribute="rate_law"), product_status)
                 else:
                     fast_model_set = r.find_models("is_fast", True)
                     irreversible_model_set = r.find_models("is_irreversible", True)
 
                     self.print_reaction_node(r.get_models(), reaction.reaction_id, r.compare_attribute("rate_law"),
-                                             r.compare_attribute("reaction_name"), r.compare_attribute("converted_rate_law"),
+                                             r.compare_attribute("reaction_name"),
+                                             r.compare_attribute("converted_rate_law", key_attribute="rate_law"),
                                              fast_model_set, irreversible_model_set)
 
                 # reactant arrows
@@ -226,6 +248,10 @@ class GenerateDot:
             arrowhead = "vee"
         elif effect_direction == "monotonic_decreasing":
             arrowhead = "tee"
+        elif effect_direction == "mixed":
+            # the interaction increases the rate at some operating points, and decreases it at others
+            arrowhead = "odiamond"
+            self.mixed_arrows_drawn = True
         else:
             arrowhead = "none"
         return arrowhead
@@ -238,7 +264,7 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
         ignore_difference : indicates that this function call does not imply the existence of differences between models
 
         Returns
@@ -246,21 +272,38 @@ class GenerateDot:
         string specifying color
 
         """
-        if self.num_models != len(model_set) and not ignore_difference:
+        mask = to_mask(model_set)
+        if mask != self.all_models and not ignore_difference:
             self.differences_found = True
 
+        if mask not in self.mask_colors:
+            self.mask_colors[mask] = self.get_mask_color(mask)
+        return self.mask_colors[mask]
+
+    def get_mask_color(self, mask):
+        """
+        Return the color for a bitmask of models (see assign_color).
+        """
+        category = classify(mask, self.num_models)
+
         if self.num_models == 1:
             return "black"
-        # one
-        elif len(model_set) == 1 and self.num_models > 1:
-            model_index = list(model_set)[0]
-            return self.colors[model_index]
-        # all
-        elif len(model_set) == self.num_models:
+        elif category == ALL_MODELS:
             return "grey"
+        elif category == NO_MODELS:
+            return None
+        elif self.heat_scale:
+            return HEAT_COLORS[self.get_heat_index(popcount(mask))]
+        elif category == ONE_MODEL:
+            return self.colors[lowest_model(mask)]
         # some
-        elif 0 < len(model_set) < self.num_models:
-            return "black"
+        return "black"
+
+    def get_heat_index(self, count):
+        """
+        Return the index in HEAT_COLORS of the color for a feature found in count models (but not in all of them).
+        """
+        return (count - 1) * len(HEAT_COLORS) // (self.num_models - 1)
 
     def check_style(self, model_set, base_style=''):
         """
@@ -269,7 +312,7 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
             
         base_style : other style attributes that must be applied (e.g. dashed, or a fillcolor)
              (Default value = '')
@@ -279,14 +322,21 @@ class GenerateDot:
         a string of the form ', style="something"'
 
         """
+        mask = to_mask(model_set)
+        key = (mask, base_style)
+        if key in self.mask_styles:
+            return self.mask_styles[key]
+
         style = ', style="%s"' % base_style
 
         base_style = "," + base_style
-        if self.selected_model == "" or self.selected_model in model_set:
-            if len(model_set) < self.num_models:
+        if self.selected_model == "" or contains_model(mask, self.selected_model):
+            if classify(mask, self.num_models) != ALL_MODELS:
                 style = ', style="bold%s"' % base_style
         else:
             style = ', style="invis%s"' % base_style
+
+        self.mask_styles[key] = style
         return style
 
     def print_reactant_arrow(self, model_set, reaction_id, reactant, stoich):
@@ -295,7 +345,7 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
             
         reaction_id : id of the reaction
             
@@ -328,7 +378,7 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
             
         reaction_id : id of the reaction
             
@@ -403,7 +453,7 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
 
         reaction_id : id of the reaction
 
@@ -432,19 +482,19 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
             
         reaction_id : id of the reaction
             
-        rate_law : bs4.element.Tag specifying the kineticLaw
+        rate_law : canonical key of the kineticLaw, from get_rate_law_key() (or "different")
             
         reaction_name : name of the reaction
             
         converted_law : human-readable string representation of the kineticLaw
 
-        fast_model_set : list of indexes for models in which this reaction is fast
+        fast_model_set : models in which this reaction is fast
 
-        irreversible_model_set : list of indexes for models in which this reaction is irreversible
+        irreversible_model_set : models in which this reaction is irreversible
 
 
         """
@@ -476,14 +526,48 @@ class GenerateDot:
         print "\n\n"
         print "digraph comparison {"
         print "rankdir = %s;" % self.rankdir
+        self.mixed_arrows_drawn = False
 
     def print_footer(self):
         """ Print footer needed for valid DOT file  """
+        if self.heat_scale:
+            self.print_heat_scale_footer()
+            return
+
         file_strings = []
         for i in range(0, len(self.model_names)):
             file_strings.append("<font color='%s'>%s</font>" % (self.assign_color([i], ignore_difference=True), self.model_names[i]))
 
-        print 'label=<Files: %s>;' % ', '.join(file_strings)
+        print 'label=<Files: %s%s>;' % (', '.join(file_strings), self.get_arrowhead_key())
+        print "}"
+
+    def get_arrowhead_key(self):
+        """
+        Return the part of the graph label that explains the arrowhead used for mixed interactions, if any were drawn
+        (activation and repression are drawn with the usual "vee" and "tee" arrowheads, and are not explained).
+        """
+        if not self.mixed_arrows_drawn:
+            return ""
+        return "<br/>Open diamond arrowheads: mixed interactions, which increase the rate at some operating points " \
+               "and decrease it at others"
+
+    def print_heat_scale_footer(self):
+        """ Print footer needed for valid DOT file, with a key to the heat scale """
+        counts = {}
+        for count in range(1, self.num_models):
+            counts.setdefault(self.get_heat_index(count), []).append(count)
+
+        key_strings = []
+        for index in sorted(counts):
+            low, high = counts[index][0], counts[index][-1]
+            count_range = str(low)
+            if high != low:
+                count_range = "%s-%s" % (low, high)
+            key_strings.append("<font color='%s'>%s</font>" % (HEAT_COLORS[index], count_range))
+        key_strings.append("<font color='grey'>%s</font>" % self.num_models)
+
+        print 'label=<Number of files (of %s) containing each feature: %s%s>;' % (self.num_models, ', '.join(key_strings),
+                                                                              self.get_arrowhead_key())
         print "}"
 
     def print_compartment_header(self, compartment_id):
@@ -510,7 +594,7 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
             
         species_id : id of a species
             
@@ -536,12 +620,12 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
             
         arrow_main : the DOT edge_stmt for the edge (eg. 'A -> B')
             
-        arrow_direction : string representing kind of interaction - 'monotonic_increasing' (activation) or
-        'monotonic_decreasing' (repression)
+        arrow_direction : string representing kind of interaction - 'monotonic_increasing' (activation),
+        'monotonic_decreasing' (repression) or 'mixed' (both, at different operating points)
         """
         color = self.assign_color(model_set)
         style = self.check_style(model_set, 'dashed')
@@ -554,14 +638,14 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
             
         rule_id : id of the rule
             
         modifier : id of the species affecting the rule
 
-        arrow_direction : string representing kind of interaction - 'monotonic_increasing' (activation) or
-        'monotonic_decreasing' (repression)
+        arrow_direction : string representing kind of interaction - 'monotonic_increasing' (activation),
+        'monotonic_decreasing' (repression) or 'mixed' (both, at different operating points)
         """
         color = self.assign_color(model_set)
         style = self.check_style(model_set, 'dashed')
@@ -582,7 +666,7 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
 
         target : id of the species affected by the rule
         """
@@ -596,7 +680,7 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
 
         target : id of the species affected by the rule
         """
@@ -610,7 +694,7 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
             
         rule_id : id of the rule
             
@@ -646,7 +730,7 @@ class GenerateDot:
 
         Parameters
         ----------
-        model_set : list of model numbers containing the feature
+        model_set : models containing the feature
             
         modifier : id of species affecting the target
             
@@ -656,7 +740,7 @@ class GenerateDot:
         "decrease-degredation", "increase-production")
         """
 
-        if len(model_set) == 0:
+        if not to_mask(model_set):
             return
 
         base_style = ''
@@ -717,8 +801,8 @@ class GenerateDot:
         Parameters
         ----------
         old_label : the label for the reaction (name or id, perhaps with rate expression)
-        irreversible_model_set : list of indexes for models in which this reaction is irreversible
-        fast_model_set : list of indexes for models in which this reaction is fast
+        irreversible_model_set : models in which this reaction is irreversible
+        fast_model_set : models in which this reaction is fast
 
         Returns
         -------
@@ -726,12 +810,12 @@ class GenerateDot:
         """
 
         reversible_string = ''
-        if len(irreversible_model_set) > 0:
+        if to_mask(irreversible_model_set):
             reversible_color = self.assign_color(irreversible_model_set)
             reversible_string = "<font color='%s'>IR</font>" % reversible_color
 
         fast_string = ''
-        if len(fast_model_set) > 0:
+        if to_mask(fast_model_set):
             fast_color = self.assign_color(fast_model_set)
             fast_string = "<font color='%s'>F</font>" % fast_color
 
@@ -0,0 +1,392 @@
+from lxml import etree
+import hashlib
+import weakref
+
+
+class MathNode(object):
+    """
+    A node of the tree produced by parse_math().
+
+    Nodes are hash-consed: make_node() returns the existing node if an identical one is still in use, so a
+    subexpression that occurs in several laws (or several models) is represented by a single node, and two nodes are
+    equal only if they are the same object. Nodes must therefore never be modified (except to record their digest).
+
+    tag : "cn", "ci", "constant", "apply", or "unsupported" (for elements that cannot be converted)
+    value : for "cn", the type attribute (or None); for "ci", the identifier; for "constant", the name of the constant
+        ("pi", "infinity", "e", "t" or "N_A"); for "apply", the operator; for "unsupported", the tag of the element
+    args : for "cn", its text (stripped, if it has no type) followed by the text after each <sep/>; for "apply", the
+        nodes for each argument; for "unsupported", the serialised element
+    digest : the structural hash computed by get_canonical_key() (or None, if it has not been computed)
+    """
+    __slots__ = ["tag", "value", "args", "digest", "__weakref__"]
+
+    def __init__(self, tag, value, args):
+        self.tag = tag
+        self.value = value
+        self.args = args
+        self.digest = None
+
+
+# Every node made by make_node() that is still in use, indexed by its tag, value and arguments (which, being nodes
+# themselves, are hashed and compared by identity, so looking up a node takes time proportional to its number of
+# arguments, not its size). A node is removed when nothing else refers to it (e.g. when the models containing it have
+# been released), so the table does not grow with the number of models compared by a long-running process.
+nodes = weakref.WeakValueDictionary()
+
+
+def make_node(tag, value, args=()):
+    """
+    Return the MathNode with the given contents, creating it only if no identical node is in use.
+    """
+    key = (tag, value, args)
+    node = nodes.get(key)
+    if node is None:
+        node = MathNode(tag, value, args)
+        nodes[key] = node
+    return node
+
+
+# Tags that contain a single expression, and are replaced by the node for that expression
+WRAPPER_TAGS = ["math", "logbase", "degree"]
+
+# Operators whose arguments are sorted by get_canonical_key(), and those of them for which nested applications are
+# also flattened (so that a + (b + c) and (c + b) + a are equivalent)
+COMMUTATIVE_OPERATORS = ["plus", "times", "and", "or", "eq"]
+ASSOCIATIVE_OPERATORS = ["plus", "times", "and", "or"]
+
+
+def intern_name(name):
+    """
+    Return an interned copy of an identifier, so that every occurrence of a symbol shares a single string.
+    """
+    if isinstance(name, str):
+        return intern(name)
+    return name
+
+
+def parse_math(element):
+    """
+    Convert a MathML element into a tree of MathNode objects.
+
+    An explicit stack is used rather than recursion, so that expressions of any depth can be parsed.
+
+    Parameters
+    ----------
+    element : lxml element representing a math element, or any MathML element within one
+
+    Returns
+    -------
+    a MathNode
+
+    """
+    # For each apply element whose arguments are being parsed: the element, its operator, the argument elements not yet
+    # parsed (last first), and the nodes for those that have been parsed.
+    # Keeping the element referenced matters: when lxml frees the proxy for an element, it searches upwards for an
+    # ancestor that still has one, so walking a deep tree without them takes time quadratic in its depth.
+    stack = []
+
+    while True:
+        element = unwrap(element)
+
+        node = None
+        if element.tag == "apply":
+            operator, args = split_apply(element)
+            args.reverse()
+            stack.append((element, operator, args, []))
+        else:
+            node = parse_leaf(element)
+
+        # complete every apply whose arguments have all been parsed, until one with arguments remaining is found
+        while stack:
+            _, operator, remaining, parsed = stack[-1]
+            if node is not None:
+                parsed.append(node)
+            if remaining:
+                element = remaining.pop()
+                break
+            stack.pop()
+            node = make_node("apply", operator, tuple(parsed))
+        else:
+            return node
+
+
+def unwrap(element):
+    """
+    Return the element contained by a math, logbase or degree element (or by a chain of them), or the element itself if
+    it is not one of these. An empty wrapper is returned unchanged.
+    """
+    while element.tag in WRAPPER_TAGS:
+        child = None
+        for child in element:
+            break
+        if child is None:
+            return element
+        element = child
+    return element
+
+
+def split_apply(element):
+    """
+    Return the operator of an apply element, and a list of its argument elements.
+    """
+    # First child is operator; next are arguments
+    operator = None
+    args = []
+    for child in element:
+        if not operator:
+            operator = child.tag
+            if child.tag == "csymbol" and child.text.strip() == "delay":
+                operator = "delay"
+        else:
+            args.append(child)
+    return operator, args
+
+
+def parse_leaf(element):
+    """
+    Return the MathNode for a MathML element other than apply (or a wrapper).
+    """
+    tag = element.tag
+
+    if tag == "cn":
+        if "type" in element.attrib:
+            parts = [element.text]
+            for child in element:
+                parts.append(child.tail)
+            return make_node("cn", element.attrib["type"], tuple(parts))
+        return make_node("cn", None, (element.text.strip(),))
+
+    if tag == "ci":
+        return make_node("ci", intern_name(element.text.strip()))
+
+    if tag in ["pi", "infinity"]:
+        return make_node("constant", tag)
+    if tag == "exponentiale":
+        return make_node("constant", "e")
+
+    if tag == "csymbol":
+        if "time" in element.attrib['definitionURL']:
+            return make_node("constant", "t")
+        if "avogadro" in element.attrib['definitionURL']:
+            return make_node("constant", "N_A")
+
+    return make_node("unsupported", tag, (etree.tostring(element, with_tail=False),))
+
+
+def iter_nodes(tree):
+    """
+    Iterate over every node of a tree of MathNode objects, in document order, without recursion.
+    """
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        if node.tag == "apply":
+            stack.extend(reversed(node.args))
+
+
+def get_canonical_key(tree):
+    """
+    Return a structural hash of an expression, which is the same for expressions that differ only in the order of the
+    arguments of commutative operators, the nesting of associative operators, or the way numbers are written (so
+    k * A * B has the same hash as B * (A * k), and 2 the same as 2.0).
+
+    The hash of each node is computed from those of its arguments, without recursion.
+
+    Parameters
+    ----------
+    tree : a MathNode
+
+    Returns
+    -------
+    string containing a hex digest, or None if the expression contains an element that cannot be converted
+
+    """
+    # the digest of each node is kept in the node, so that subexpressions shared between laws are hashed only once
+    stack = [(tree, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if node.digest is not None:
+            continue
+
+        if node.tag == "unsupported" or (node.tag == "apply" and node.value is None):
+            return None
+
+        if node.tag != "apply":
+            node.digest = hashlib.sha1(get_leaf_token(node)).digest()
+            continue
+
+        operands = get_operands(node)
+        if not expanded:
+            stack.append((node, True))
+            stack.extend((operand, False) for operand in operands)
+            continue
+
+        operand_digests = [operand.digest for operand in operands]
+        if node.value in COMMUTATIVE_OPERATORS:
+            operand_digests.sort()
+        node.digest = hashlib.sha1("%s(%s)" % (node.value, "".join(operand_digests))).digest()
+
+    return tree.digest.encode("hex")
+
+
+def get_operands(node):
+    """
+    Return the arguments of an apply node, replacing any argument that applies the same associative operator by its own
+    arguments.
+    """
+    if node.value not in ASSOCIATIVE_OPERATORS:
+        return node.args
+
+    operands = []
+    stack = list(reversed(node.args))
+    while stack:
+        arg = stack.pop()
+        if arg.tag == "apply" and arg.value == node.value:
+            stack.extend(reversed(arg.args))
+        else:
+            operands.append(arg)
+    return operands
+
+
+def get_leaf_token(node):
+    """
+    Return a string identifying a MathNode other than an apply, in which numbers are represented by their value.
+    """
+    if node.tag == "cn":
+        value = get_number(node)
+        if value is not None:
+            return "cn %r" % value
+        return "cn %r %r" % (node.value, node.args)
+
+    name = node.value
+    if isinstance(name, unicode):
+        name = name.encode("utf-8")
+    return "%s %s" % (node.tag, name)
+
+
+def get_number(node):
+    """
+    Return the value of a cn node as a float, or None if it cannot be read.
+    """
+    parts = node.args
+    try:
+        if node.value in [None, "real", "integer"]:
+            return float(parts[0])
+        elif node.value == "e-notation":
+            return float(parts[0]) * 10 ** float(parts[1])
+        elif node.value == "rational":
+            return float(parts[0]) / float(parts[1])
+    except (TypeError, ValueError, IndexError, ZeroDivisionError, OverflowError):
+        pass
+    return None
+
+
+class MathExpression:
+    """
+    A math element that has been parsed into a tree of MathNode objects, together with the results of converting and
+    analysing it. Every math element that parses to the same tree (in any model) shares a single MathExpression.
+    """
+
+    def __init__(self, math, source=None, tree=None, piecewise=None):
+        """
+
+        Parameters
+        ----------
+        math : lxml element representing a math expression (or None, if source, tree and piecewise are all given, e.g.
+            when the expression is rebuilt from a shared_model.SharedModels object)
+        source : the serialised math element (if it has already been serialised)
+        tree : the result of parse_math() for the math element (if it has already been parsed)
+        piecewise : Boolean indicating whether the math element contains a piecewise element (if this is already known)
+
+        """
+        if source is None:
+            source = etree.tostring(math, with_tail=False)
+        self.source = source
+
+        if tree is None:
+            tree = parse_math(math)
+        self.tree = tree
+
+        if piecewise is None:
+            piecewise = math.tag == 'piecewise' or math.find('.//piecewise') is not None
+        self.piecewise = piecewise
+
+        # each identifier in the expression, in the order in which they first occur
+        self.symbols = []
+        seen = set()
+        for node in iter_nodes(self.tree):
+            if node.tag == "ci" and node.value not in seen:
+                seen.add(node.value)
+                self.symbols.append(node.value)
+
+        # the result of convert_rate_law() for each output_type and symbol_names
+        self.conversions = {}
+
+        # set by get_canonical_key()
+        self.canonical_key = None
+
+        # set by rate_laws.compile_rate_law() and effect_direction.get_symbolic_rate_law()
+        self.compiled = None
+        self.symbolic = None
+
+    def get_canonical_key(self):
+        """
+        Return a key that is equal for equivalent expressions (see get_canonical_key()). Piecewise expressions, and any
+        others that cannot be converted, are identified by their MathML instead.
+        """
+        if self.canonical_key is None:
+            key = None
+            if not self.piecewise:
+                key = get_canonical_key(self.tree)
+            if key is None:
+                key = "mathml " + hashlib.sha1(self.source).hexdigest()
+            self.canonical_key = key
+        return self.canonical_key
+
+    def get_indexed_symbol_names(self):
+        """
+        Return a dict that replaces each identifier with an element of a list v (e.g. "v[0]"), in the order given by
+        self.symbols, for use as the symbol_names argument of convert_rate_law().
+        """
+        symbol_names = {}
+        for index, symbol in enumerate(self.symbols):
+            symbol_names[symbol] = "v[%s]" % index
+        return symbol_names
+
+
+# MathExpression objects that are still in use, indexed by the serialised math they were parsed from, and by their
+# tree. Each model keeps the expressions for its own math elements (see accessor_functions.get_model_expression()), so
+# an expression, and everything found for it (its conversions, compiled and symbolic forms, and the nodes of its tree),
+# is released along with the last model that contains it.
+math_expressions = weakref.WeakValueDictionary()
+expressions_by_tree = weakref.WeakValueDictionary()
+
+
+def get_math_expression(math, source=None):
+    """
+    Return the MathExpression for a math element. The element is parsed only if the same serialised math is not already
+    in use, and a new MathExpression is created only if no other math element in use has the same tree (e.g. if it
+    differs only in whitespace).
+
+    The caller must keep a reference to the expression for as long as it wants it to be reused.
+
+    A MathExpression may be given instead of a math element, in which case it is returned unchanged. If the element has
+    already been serialised, source may be given, so that it is not serialised again.
+    """
+    if isinstance(math, MathExpression):
+        return math
+
+    key = source
+    if key is None:
+        key = etree.tostring(math, with_tail=False)
+    expression = math_expressions.get(key)
+    if expression is None:
+        tree = parse_math(math)
+        expression = expressions_by_tree.get(tree)
+        if expression is None:
+            expression = MathExpression(math, key, tree)
+            expressions_by_tree[tree] = expression
+        math_expressions[key] = expression
+    return expression
+
@@ -1,56 +1,68 @@
+from lxml import etree
 import sys
-from collections import OrderedDict
 
+# Attribute of SBMLModel listing each kind of element that can be aligned
+ELEMENT_LISTS = {"species": "species", "reaction": "reactions"}
 
-def get_identifiers(obj):
+
+def get_identifiers(annotation):
     """
-    Given a BeautifulSoup object, find all of the annotations of type "is"
-    (rather than e.g. "isDerivedFrom", or "isHomologTo")
+    Given an annotation element, find all of the annotations of type "is"
+    (rather than e.g. "isDerivedFrom", or "isHomologTo"), as a frozenset (so that it can be used as a dict key)
     """
     identifiers = set()
 
-    if not obj.find("annotation"):
-        return identifiers
-
-    for annotation in obj.find("annotation").find_all("is"):
-        for i in annotation.find_all("li"):
-            if "resource" not in i.attrs:
-                continue
-            resource = i.attrs["resource"]
-            identifiers.add(resource)
-    return identifiers
+    for qualifier in annotation.iter("is"):
+        for i in qualifier.iter("li"):
+            for attribute_name in i.attrib:
+                # the attribute is rdf:resource
+                if etree.QName(attribute_name).localname == "resource":
+                    identifiers.add(i.attrib[attribute_name])
+    return frozenset(identifiers)
 
 
 def align_element(models, element_type):
+    """
+    Find elements of one type that should be renamed, because an element with the same set of MIRIAM identifiers but a
+    different id has already been seen (in the same model, or an earlier one).
+
+    Parameters
+    ----------
+    models : list of IndexedModel objects
+    element_type : "species" or "reaction"
 
-    all_identifiers = OrderedDict()
+    Returns
+    -------
+    elements : list of tuples (model_num, old_id, new_id)
+
+    """
+    # the identifiers of each id, and the inverted index from a set of identifiers to the first id that had it
+    all_identifiers = {}
+    canonical_ids = {}
     elements = []
 
-    # Construct a list of identifiers for every id in the species
-    for model in models:
-        for tag in model.select(element_type):
-            identifiers = get_identifiers(tag)
-            tag_id = tag["id"]
+    for model_num, model in enumerate(models):
+        for tag in getattr(model, ELEMENT_LISTS[element_type]):
+            tag_id = tag.attrib["id"]
+            identifiers = model.identifiers.get(tag_id, frozenset())
 
             if not identifiers:
                 continue
 
-            if tag_id in all_identifiers.keys() and all_identifiers[tag_id] != identifiers:
+            if tag_id in all_identifiers and all_identifiers[tag_id] != identifiers:
                 sys.stderr.write("Cannot match using MIRIAM identifiers: %s id %s has two or more sets of annotations\n"
                                  % (element_type, tag_id))
-                print "Set one: \n", get_identifiers(all_identifiers[tag_id])
-                print "Set two: \n", identifiers
+                print "Set one: \n", set(all_identifiers[tag_id])
+                print "Set two: \n", set(identifiers)
                 sys.exit()
 
-            identifier_values = all_identifiers.values()
-            if identifiers in identifier_values:
-                rename_to = all_identifiers.keys()[identifier_values.index(identifiers)]
-                if rename_to != tag_id:
-                    elements.append((model, tag_id, rename_to))
+            rename_to = canonical_ids.setdefault(identifiers, tag_id)
+            if rename_to != tag_id:
+                elements.append((model_num, tag_id, rename_to))
 
             all_identifiers[tag_id] = identifiers
 
-    if len(all_identifiers.keys()) == 0:
+    if not all_identifiers:
         sys.stderr.write("Cannot fully match using MIRIAM identifiers: no %s in any model has any identifier\n" % element_type)
 
     return elements
@@ -82,37 +94,21 @@ def align_models(models):
     For example, in BIOMD0000000612.xml, there are several distinct 'species' (Cyy_A, Ocy_I, Ocy_I_PTY) whose only
     annotation is that they are osteocytes ("urn:miriam:cl:CL%3A0000137"); merging based on this would be a disaster.
 
+    The models themselves are not modified: instead, a table mapping old ids to new ids is returned for each model, which
+    can be applied using IndexedModel.translate_ids().
+
     Parameters
     ----------
-    models
+    models : list of IndexedModel objects
 
     Returns
     -------
+    id_maps : list containing, for each model, a dict mapping the id of each renamed species or reaction to its new id
 
     """
-    species_to_rename = align_element(models, "species")
-    for model, old_id, new_id in species_to_rename:
-        # replace species ids in species definitions
-        for species in model.find_all('species'):
-            if species["id"] == old_id:
-                species["id"] = new_id
-
-        # replace species names in formula
-        for ci in model.find_all("ci"):
-            if ci.string.strip() == old_id:
-                ci.string.replace_with(new_id)
-
-        # replace speciesReference (reactant/product lists)
-        for ref in model.find_all('speciesReference'):
-            if ref["species"] == old_id:
-                ref["species"] = new_id
-        # replace modifierSpeciesReference (modifierSpecies lists)
-        for ref in model.find_all('modifierSpeciesReference'):
-            if ref["species"] == old_id:
-                ref["species"] = new_id
-
-    reactions_to_rename = align_element(models, "reaction")
-    for model, old_id, new_id in reactions_to_rename:
-        for species in model.find_all('reaction'):
-            if species["id"] == old_id:
-                species["id"] = new_id
+    id_maps = [{} for _ in models]
+    for element_type in ["species", "reaction"]:
+        for model_num, old_id, new_id in align_element(models, element_type):
+            id_maps[model_num][old_id] = new_id
+
+    return id_maps
@@ -0,0 +1,200 @@
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+from effect_direction import DEFAULT_SAMPLES, get_symbolic_budget
+
+# Included in every cache key, so that models analysed by a different version of sbml-diff are never reused.
+# Keep in step with the version in setup.py.
+VERSION = "1.0"
+
+# The modules that define the pickled classes (IndexedModel, ReactionAnalysis) or compute the results stored in them;
+# their sources are also hashed into every key (see get_code_version()), so that entries are not reused after any of
+# them changes, even if VERSION has not been updated
+PICKLED_MODULES = ["model_loader.py", "accessor_functions.py", "math_ast.py", "rate_laws.py", "effect_direction.py",
+                   "miriam.py", "model_cache.py"]
+
+CACHE_SUFFIX = ".pickle"
+
+CHUNK_SIZE = 64 * 1024
+
+
+def get_code_version():
+    """
+    Return a hex digest of VERSION and the sources of PICKLED_MODULES.
+
+    If a source file cannot be read (e.g. only compiled files are installed), its compiled form is hashed instead.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256(VERSION)
+    for module_name in PICKLED_MODULES:
+        base_name = os.path.join(directory, os.path.splitext(module_name)[0])
+        for path in [base_name + ".py", base_name + ".pyc", base_name + ".pyo"]:
+            try:
+                with open(path, "rb") as source_file:
+                    digest.update("\0%s\0" % module_name)
+                    digest.update(source_file.read())
+                break
+            except IOError:
+                continue
+    return digest.hexdigest()
+
+
+CODE_VERSION = get_code_version()
+
+
+class ModelCache:
+    """
+    A directory of parsed and analysed models, indexed by the SHA-256 hash of the SBML document together with the
+    sbml-diff version (see get_code_version()) and the options that affect the analysis.
+
+    Each entry is a pickled IndexedModel, in which functions have been inlined and the converted rate laws and
+    interaction signs have already been computed. Models are pickled in a flattened form (see
+    IndexedModel.__getstate__()), so loading an entry does not parse any XML. When the total size of the entries
+    exceeds max_size, the least recently used entries are removed.
+
+    Entries are loaded with pickle, which can run arbitrary code, so the cache directory must be trusted: anyone who can
+    write to it can run code as any user who reads from it. Do not share a cache directory with untrusted users.
+    """
+
+    def __init__(self, directory, max_size=100 * 1024 * 1024):
+        """
+
+        Parameters
+        ----------
+        directory : path of the cache directory (created if it does not exist)
+        max_size : maximum total size of the cache, in bytes
+
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_key(self, model_string, use_sympy=False, samples=DEFAULT_SAMPLES):
+        """
+        Return the key identifying a model in the cache.
+
+        Parameters
+        ----------
+        model_string : an SBML model, as a string or file-like object (which is read to the end)
+        use_sympy : Boolean indicating whether interaction signs are determined symbolically (within the budget set by
+            set_symbolic_budget())
+        samples : number of operating points used to determine interaction signs numerically
+
+        Returns
+        -------
+        key : string containing a hex digest
+
+        """
+        if isinstance(model_string, unicode):
+            model_string = model_string.encode("utf-8")
+
+        digest = hashlib.sha256()
+        if isinstance(model_string, str):
+            digest.update(model_string)
+        else:
+            for chunk in iter(lambda: model_string.read(CHUNK_SIZE), ""):
+                digest.update(chunk)
+        digest.update("\0sbml-diff %s\0use_sympy=%s\0samples=%s" % (CODE_VERSION, bool(use_sympy), samples))
+        if use_sympy:
+            # signs that took too long to find symbolically were found numerically instead
+            digest.update("\0sympy_budget=%s,%s" % get_symbolic_budget())
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def load(self, key):
+        """
+        Return the model stored under a key, or None if there is no usable entry. An entry that cannot be loaded (e.g.
+        because it is truncated, or was written by a different version of sbml-diff) is removed.
+
+        Parameters
+        ----------
+        key : a key produced by get_key()
+
+        Returns
+        -------
+        an IndexedModel object (or None)
+
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as cache_file:
+                model = pickle.load(cache_file)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # unpickling a damaged or stale entry can raise almost anything
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        # record the use, for LRU eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return model
+
+    def store(self, key, model):
+        """
+        Add a model to the cache, then evict other entries if the cache is too large. The new entry is kept even if it
+        is larger than max_size by itself.
+
+        Parameters
+        ----------
+        key : a key produced by get_key()
+        model : an IndexedModel object
+
+        """
+        # write to a temporary file, then rename, so that a partially-written entry is never read
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as cache_file:
+                pickle.dump(model, cache_file, pickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, self.get_path(key))
+        except (IOError, OSError):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        self.evict(keep=self.get_path(key))
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the total size of the cache is no more than max_size (or until
+        only the entry at the path keep is left).
+        """
+        entries = []
+        total_size = 0
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(CACHE_SUFFIX):
+                continue
+
+            path = os.path.join(self.directory, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, path, stat.st_size))
+            total_size += stat.st_size
+
+        entries.sort()
+        for _, path, size in entries:
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
@@ -0,0 +1,257 @@
+import bz2
+import zipfile
+import zlib
+from io import BytesIO
+from lxml import etree
+
+GZIP_MAGIC = "\x1f\x8b"
+BZ2_MAGIC = "BZh"
+XZ_MAGIC = "\xfd7zXZ\x00"
+ZIP_MAGIC = "PK\x03\x04"
+
+# Extensions removed from a file name to give the name of the model it contains
+COMPRESSED_EXTENSIONS = [".gz", ".bz2", ".xz", ".zip", ".omex"]
+
+CHUNK_SIZE = 64 * 1024
+
+# Decompressors that cannot limit the size of their output (bz2 and lzma on Python 2) are given compressed data in pieces
+# of this size, so that each call decompresses at most a few blocks
+FEED_SIZE = 1024
+
+
+class StreamReader:
+    """
+    A minimal file-like object, which returns some bytes that have already been read from a stream, then the remainder
+    of that stream, optionally passing everything through a decompressor (such as a zlib.decompressobj or
+    bz2.BZ2Decompressor).
+
+    Data is decompressed a chunk at a time, as it is read. zlib (gzip) is asked for at most CHUNK_SIZE bytes of output
+    per call, so memory use does not depend on how compressible the input is. Other decompressors cannot limit their
+    output, so they are given FEED_SIZE bytes of input per call, which limits the output of each call to what those
+    bytes encode (for bzip2, a few blocks).
+    """
+
+    def __init__(self, source, prefix="", decompressor=None):
+        self.source = source
+        self.prefix = prefix
+        self.decompressor = decompressor
+
+        # the decompressed chunk being read, and the position reached in it
+        self.buffer = ""
+        self.offset = 0
+
+        # compressed data not yet passed to the decompressor, and the position reached in it
+        self.pending = ""
+        self.pending_offset = 0
+
+        self.finished = False
+
+    def read_raw(self):
+        if self.prefix:
+            data = self.prefix
+            self.prefix = ""
+            return data
+        return self.source.read(CHUNK_SIZE)
+
+    def read_chunk(self):
+        """
+        Return the next (non-empty) chunk of decompressed data, or "" at the end of the stream.
+        """
+        while not self.finished:
+            if self.decompressor is None:
+                data = self.read_raw()
+                if not data:
+                    self.finished = True
+                return data
+
+            if self.pending_offset >= len(self.pending):
+                self.pending = self.read_raw()
+                self.pending_offset = 0
+                if not self.pending:
+                    self.finished = True
+                    if hasattr(self.decompressor, "flush"):
+                        return self.decompressor.flush()
+                    return ""
+
+            try:
+                if hasattr(self.decompressor, "unconsumed_tail"):
+                    # zlib keeps any input it could not decompress within max_length in unconsumed_tail
+                    data = self.decompressor.decompress(self.pending, CHUNK_SIZE)
+                    self.pending = self.decompressor.unconsumed_tail
+                else:
+                    end = self.pending_offset + FEED_SIZE
+                    data = self.decompressor.decompress(self.pending[self.pending_offset:end])
+                    self.pending_offset = end
+            except EOFError:
+                # bz2 and lzma decompressors refuse data after the end of the stream
+                self.finished = True
+                return ""
+
+            if data:
+                return data
+        return ""
+
+    def read(self, size=-1):
+        parts = []
+        remaining = size
+        while size < 0 or remaining > 0:
+            if self.offset >= len(self.buffer):
+                self.buffer = self.read_chunk()
+                self.offset = 0
+                if not self.buffer:
+                    break
+
+            end = len(self.buffer)
+            if size >= 0:
+                end = min(end, self.offset + remaining)
+                remaining -= end - self.offset
+
+            if self.offset == 0 and end == len(self.buffer):
+                parts.append(self.buffer)
+            else:
+                parts.append(self.buffer[self.offset:end])
+            self.offset = end
+        return "".join(parts)
+
+
+def make_seekable(source):
+    """
+    Return a file-like object that supports seek(), containing the same bytes as source.
+
+    Parameters
+    ----------
+    source : a string, or a file-like object
+
+    Returns
+    -------
+    source itself, if it is a seekable file-like object; otherwise a BytesIO containing its contents
+
+    """
+    if isinstance(source, unicode):
+        source = source.encode("utf-8")
+    if isinstance(source, str):
+        return BytesIO(source)
+
+    try:
+        source.seek(source.tell())
+        return source
+    except (AttributeError, IOError):
+        return BytesIO(source.read())
+
+
+def get_model_name(file_name):
+    """
+    Return the name of the model in a file, by removing any compression extension (e.g. '.gz') from the file name,
+    followed by its usual extension (e.g. '.xml').
+    """
+    for extension in COMPRESSED_EXTENSIONS:
+        if file_name.lower().endswith(extension):
+            file_name = file_name[:-len(extension)]
+            break
+
+    if "." in file_name:
+        file_name = file_name[:file_name.rindex(".")]
+    return file_name
+
+
+def open_model(source):
+    """
+    Open an SBML model, which may be compressed with gzip, bzip2 or xz, or contained in a zip or COMBINE (OMEX) archive.
+
+    The format is identified from the first few bytes, rather than the file name. The decompressed model is not read
+    into memory: it is streamed to the parser as it is read.
+
+    Parameters
+    ----------
+    source : an SBML model (or compressed model, or archive), as a string or file-like object
+
+    Returns
+    -------
+    a file-like object, from which the SBML model can be read
+
+    """
+    if isinstance(source, basestring):
+        source = make_seekable(source)
+
+    header = source.read(len(XZ_MAGIC))
+
+    if header.startswith(GZIP_MAGIC):
+        # the offset tells zlib to expect a gzip header and trailer
+        return StreamReader(source, header, zlib.decompressobj(16 + zlib.MAX_WBITS))
+
+    if header.startswith(BZ2_MAGIC):
+        return StreamReader(source, header, bz2.BZ2Decompressor())
+
+    if header.startswith(XZ_MAGIC):
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise RuntimeError("Reading xz-compressed models requires the lzma module (on Python 2, install "
+                                   "backports.lzma, e.g. with pip install sbml-diff[xz])")
+        return StreamReader(source, header, lzma.LZMADecompressor())
+
+    if header.startswith(ZIP_MAGIC):
+        # zipfile needs to seek to the central directory at the end of the archive
+        try:
+            source.seek(0)
+        except (AttributeError, IOError):
+            source = BytesIO(header + source.read())
+        return open_archive(source)
+
+    return StreamReader(source, header)
+
+
+def open_archive(source):
+    """
+    Open the SBML model in a zip or COMBINE archive.
+
+    For a COMBINE archive, this is the SBML file marked as the master file in the manifest (or the only SBML file listed
+    in it). For any other zip file, it is the only member with a .xml or .sbml extension.
+
+    Parameters
+    ----------
+    source : a seekable file-like object containing the archive
+
+    Returns
+    -------
+    a file-like object, from which the SBML model can be read
+
+    """
+    try:
+        archive = zipfile.ZipFile(source)
+    except zipfile.BadZipfile:
+        raise RuntimeError("Could not read zip archive")
+
+    members = archive.namelist()
+
+    if "manifest.xml" in members:
+        manifest = etree.parse(archive.open("manifest.xml"))
+
+        models = []
+        master = None
+        for content in manifest.iter("{*}content"):
+            location = content.get("location", "")
+            if location.startswith("./"):
+                location = location[2:]
+
+            if "sbml" not in content.get("format", "") or location not in members:
+                continue
+
+            models.append(location)
+            if content.get("master") in ["1", "true"]:
+                master = location
+
+    else:
+        models = [m for m in members if m.lower().endswith(".xml") or m.lower().endswith(".sbml")]
+        master = None
+
+    if master is None:
+        if len(models) != 1:
+            raise RuntimeError("An archive must contain exactly one SBML model, or mark one model as the master file "
+                               "(found %s)" % len(models))
+        master = models[0]
+
+    return archive.open(master)
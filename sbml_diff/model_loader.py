@@ -0,0 +1,435 @@
+from lxml import etree
+from io import BytesIO
+import copy
+from miriam import get_identifiers
+from math_ast import intern_name
+from accessor_functions import get_math_source
+
+# For each list that sbml-diff reads, the tags of the elements it contains
+ENTITY_TAGS = {"listOfCompartments": ["compartment"],
+               "listOfSpecies": ["species"],
+               "listOfParameters": ["parameter"],
+               "listOfReactions": ["reaction"],
+               "listOfRules": ["assignmentRule", "rateRule", "algebraicRule"],
+               "listOfEvents": ["event"],
+               "listOfFunctionDefinitions": ["functionDefinition"]}
+
+# The attribute of SBMLModel corresponding to each list
+ENTITY_LISTS = {"listOfCompartments": "compartments",
+                "listOfSpecies": "species",
+                "listOfParameters": "parameters",
+                "listOfReactions": "reactions",
+                "listOfRules": "rules",
+                "listOfEvents": "events",
+                "listOfFunctionDefinitions": "function_definitions"}
+
+# Attributes of IndexedModel constructed by build_index(), which are not pickled (reaction_analysis is reset by
+# build_index(), but is pickled separately)
+INDEXES = ["compartments_by_id", "species_by_id", "species_by_compartment", "species_compartment", "parameters_by_id",
+           "reactions_by_id", "reaction_names", "rules_by_variable", "events_by_id", "elements_by_id", "initial_values",
+           "math_expressions"]
+
+
+class SBMLModel:
+    """
+    The parts of an SBML document that are used by sbml-diff, as read by load_model().
+
+    Each entity (species, reaction, rule etc.) is an lxml element. The namespace is stripped from every tag (so a MathML
+    identifier has tag 'ci', rather than '{http://www.w3.org/1998/Math/MathML}ci'), and notes and annotations are
+    removed after the MIRIAM identifiers have been extracted from them.
+    """
+
+    def __init__(self):
+        self.namespace = None
+        self.lists = set()
+
+        self.compartments = []
+        self.species = []
+        self.parameters = []
+        self.reactions = []
+        self.rules = []
+        self.events = []
+        self.function_definitions = []
+
+        # MIRIAM identifiers of type "is", indexed by the id of the annotated element
+        self.identifiers = {}
+
+        # set by inline_all_functions()
+        self.functions_inlined = False
+
+    def get_entities(self):
+        """
+        Return a list containing every entity in the model.
+        """
+        return self.compartments + self.species + self.parameters + self.reactions + self.rules + self.events + \
+            self.function_definitions
+
+
+class IndexedModel(SBMLModel):
+    """
+    An SBMLModel, together with indexes that allow species, reactions, parameters, rules, events and compartments to be
+    looked up without searching the model.
+
+    The indexes are constructed by build_index(), which must be called again if the ids of any elements are changed.
+
+    The results of converting and analysing math elements are also recorded here (keyed by the serialised math), so that
+    they can be cached along with the model.
+    """
+
+    def __init__(self):
+        SBMLModel.__init__(self)
+        self.converted_rate_laws = {}
+        self.interaction_signs = {}
+
+        # the canonical key of each math expression (see get_rate_law_key())
+        self.rate_law_keys = {}
+
+        # descriptions of the expressions whose interaction signs could not be determined symbolically within the budget
+        self.symbolic_timeouts = []
+
+        # the use_sympy and samples settings with which every expression was analysed by analyse_model() (or None)
+        self.analysed_with = None
+        self.build_index()
+
+    def __getstate__(self):
+        # lxml elements cannot be pickled, so each entity is flattened into a tuple of records (see pack_element()).
+        # Math elements are stored once per model (however many entities contain the same math), along with their
+        # serialised form, so that the XML need not be parsed when the model is unpickled. The indexes are rebuilt from
+        # the entities instead of being pickled, so that they are constructed in the same order as those of the
+        # original model, and so are iterated in the same order.
+        state = self.__dict__.copy()
+        for index in INDEXES:
+            state.pop(index)
+
+        math_table = {}
+        state["math_sources"] = []
+        state["math_records"] = []
+        for attribute in ENTITY_LISTS.values():
+            state[attribute] = [pack_element(entity, self, math_table, state["math_sources"], state["math_records"])
+                                for entity in state[attribute]]
+        return state
+
+    def __setstate__(self, state):
+        math_sources = state.pop("math_sources")
+        math_records = state.pop("math_records")
+
+        math_expressions = {}
+        for attribute in ENTITY_LISTS.values():
+            state[attribute] = [unpack_element(records, math_sources, math_records, math_expressions)
+                                for records in state[attribute]]
+
+        reaction_analysis = state.pop("reaction_analysis")
+        self.__dict__.update(state)
+        self.build_index()
+        self.math_expressions = math_expressions
+
+        # the ReactionAnalysis objects found before the model was pickled (e.g. by analyse_model() in a worker process)
+        for reaction_id, analysis in reaction_analysis.items():
+            analysis.attach(self.reactions_by_id[reaction_id])
+        self.reaction_analysis = reaction_analysis
+
+    def build_index(self):
+        self.compartments_by_id = {}
+        self.species_by_id = {}
+        self.species_by_compartment = {}
+        self.species_compartment = {}
+        self.parameters_by_id = {}
+        self.reactions_by_id = {}
+        self.reaction_names = {}
+        self.rules_by_variable = {}
+        self.events_by_id = {}
+        self.elements_by_id = {}
+        self.initial_values = {}
+
+        # ReactionAnalysis objects, added by get_reaction_analysis()
+        self.reaction_analysis = {}
+
+        # the serialised form and MathExpression (or None, if it has not been parsed) of each math element, added by
+        # get_math_source() and get_model_expression(); the elements are kept referenced here, so lxml returns the same
+        # proxy object for them whenever they are found again
+        self.math_expressions = {}
+
+        for entity in self.get_entities():
+            if "id" in entity.attrib:
+                self.elements_by_id.setdefault(entity.attrib["id"], entity)
+
+        for compartment in self.compartments:
+            if "id" in compartment.attrib:
+                self.compartments_by_id[compartment.attrib["id"]] = compartment
+
+        for species in self.species:
+            species_id = species.attrib["id"]
+            compartment = species.attrib["compartment"]
+
+            self.species_by_id[species_id] = species
+            self.species_by_compartment.setdefault(compartment, []).append(species_id)
+            self.species_compartment[species_id] = compartment
+
+            if "initialConcentration" in species.attrib:
+                self.initial_values[species_id] = species.attrib["initialConcentration"]
+
+        for param in self.parameters:
+            if "id" in param.attrib:
+                self.parameters_by_id[param.attrib["id"]] = param
+
+        for reaction in self.reactions:
+            reaction_id = reaction.attrib["id"]
+            self.reactions_by_id[reaction_id] = reaction
+
+            if "name" in reaction.attrib and reaction.attrib["name"]:
+                self.reaction_names[reaction_id] = reaction.attrib["name"]
+            else:
+                self.reaction_names[reaction_id] = reaction_id
+
+        # initial values of parameters, including those local to a kineticLaw
+        params = list(self.parameters)
+        for reaction in self.reactions:
+            params.extend(reaction.iter("parameter"))
+        for param in params:
+            if "id" in param.attrib and "value" in param.attrib:
+                self.initial_values[param.attrib["id"]] = param.attrib["value"]
+
+        for rule in self.rules:
+            if "variable" in rule.attrib:
+                self.rules_by_variable.setdefault(rule.attrib["variable"], rule)
+
+        for event in self.events:
+            if "id" in event.attrib:
+                self.events_by_id[event.attrib["id"]] = event
+
+    def translate_ids(self, id_map):
+        """
+        Return a copy of this model in which species and reactions have been renamed (as by align_models()).
+
+        The model itself is not changed. Entities that do not mention a renamed id are shared with the copy, and only
+        those that do are copied and renamed, so this requires a single pass over the model.
+
+        Parameters
+        ----------
+        id_map : dict mapping the old id of each renamed species or reaction to its new id
+
+        Returns
+        -------
+        an IndexedModel object
+
+        """
+        if not id_map:
+            return self
+
+        model = IndexedModel()
+        model.__dict__.update(self.__dict__)
+
+        # the copy keeps the results found for this model, but records its own in separate containers, as the results
+        # for renamed expressions do not belong to this model
+        model.converted_rate_laws = dict(self.converted_rate_laws)
+        model.interaction_signs = dict(self.interaction_signs)
+        model.rate_law_keys = dict(self.rate_law_keys)
+        model.symbolic_timeouts = list(self.symbolic_timeouts)
+
+        # the renamed expressions have not been analysed
+        model.analysed_with = None
+
+        for list_name in ENTITY_LISTS:
+            attribute = ENTITY_LISTS[list_name]
+            setattr(model, attribute, [translate_entity(entity, id_map) for entity in getattr(self, attribute)])
+
+        model.identifiers = {}
+        for element_id in self.identifiers:
+            model.identifiers[id_map.get(element_id, element_id)] = self.identifiers[element_id]
+
+        model.build_index()
+        return model
+
+    def get_element(self, element_id):
+        """
+        Return the entity with a given id (or None, if there is no such entity).
+        """
+        return self.elements_by_id.get(element_id)
+
+
+def pack_element(element, model, math_table, math_sources, math_records):
+    """
+    Flatten an entity into a tuple of records, one for each element in document order, from which unpack_element() can
+    rebuild it without parsing any XML.
+
+    Each record is a tuple (index of the parent record, or -1 for the entity itself; tag; tuple of (name, value)
+    attribute pairs; text; tail). A math element is instead recorded as (parent, None, index in math_records, None,
+    tail): the records for each distinct math element of the model (identified by its serialised form, see
+    accessor_functions.get_math_source()) are added to math_records only once, and its serialised form to
+    math_sources. Tags and attribute names are interned, so that pickle stores each only once.
+
+    An explicit stack is used rather than recursion, so that math of any depth can be packed.
+    """
+    records = []
+    stack = [(element, -1)]
+    while stack:
+        element, parent = stack.pop()
+
+        if element.tag == "math" and parent >= 0:
+            source = get_math_source(model, element)
+            if source not in math_table:
+                math_table[source] = len(math_records)
+                math_sources.append(source)
+                math_records.append(pack_element(element, model, math_table, math_sources, math_records))
+            records.append((parent, None, math_table[source], None, element.tail))
+            continue
+
+        if parent < 0:
+            tail = None
+        else:
+            tail = element.tail
+        attributes = tuple((intern_name(name), value) for name, value in element.attrib.items())
+        records.append((parent, intern_name(element.tag), attributes, element.text, tail))
+
+        index = len(records) - 1
+        stack.extend((child, index) for child in reversed(element))
+    return tuple(records)
+
+
+def unpack_element(records, math_sources, math_records, math_expressions):
+    """
+    Rebuild an entity from the records produced by pack_element(). Each math element rebuilt is added to
+    math_expressions (the IndexedModel attribute) along with its serialised form, so that it is never serialised again.
+    """
+    elements = []
+    for parent, tag, attributes, text, tail in records:
+        if tag is None:
+            element = unpack_element(math_records[attributes], math_sources, math_records, math_expressions)
+            math_expressions[element] = (math_sources[attributes], None)
+            elements[parent].append(element)
+        else:
+            if parent < 0:
+                element = etree.Element(tag)
+            else:
+                element = etree.SubElement(elements[parent], tag)
+
+            # set one at a time, so that the attributes keep their order
+            for name, value in attributes:
+                element.set(name, value)
+            element.text = text
+        element.tail = tail
+        elements.append(element)
+    return elements[0]
+
+
+def translate_entity(entity, id_map):
+    """
+    Return an entity in which the ids in id_map have been replaced: the id of the entity itself, the species of each
+    species reference, and each identifier in its math. If the entity contains none of these ids, it is returned
+    unchanged; otherwise, a modified copy is returned.
+    """
+    def needs_translation(element):
+        if element.tag == "ci":
+            return (element.text or "").strip() in id_map
+        if element.tag in ["speciesReference", "modifierSpeciesReference"]:
+            return element.get("species") in id_map
+        return False
+
+    renamed = entity.tag in ["species", "reaction"] and entity.get("id") in id_map
+    if not renamed and not any(needs_translation(element) for element in entity.iter()):
+        return entity
+
+    entity = copy.deepcopy(entity)
+    if renamed:
+        entity.set("id", id_map[entity.get("id")])
+
+    for element in entity.iter():
+        if not needs_translation(element):
+            continue
+        if element.tag == "ci":
+            element.text = id_map[element.text.strip()]
+        else:
+            element.set("species", id_map[element.get("species")])
+
+    return entity
+
+
+def load_model(source):
+    """
+    Read an SBML model in a single pass, using lxml's iterparse.
+
+    Only the contents of the lists of compartments, species, parameters, reactions, rules, events and function
+    definitions are retained; every other element is cleared as soon as it has been parsed.
+
+    Parameters
+    ----------
+    source : an SBML model, as a string or file-like object
+
+    Returns
+    -------
+    an IndexedModel object
+
+    """
+    if isinstance(source, unicode):
+        source = source.encode("utf-8")
+    if isinstance(source, str):
+        source = BytesIO(source)
+
+    model = IndexedModel()
+    entity_lists = {}
+    for list_name in ENTITY_LISTS:
+        entity_lists[list_name] = getattr(model, ENTITY_LISTS[list_name])
+
+    # For each element enclosing the current element: its name, whether it is a list of entities, whether it is an
+    # entity, and the number of entities found before it started.
+    # Lists are recognised wherever they occur (except inside an entity, as a kineticLaw may contain a listOfParameters),
+    # so that models are read in the same way as by a recovering parser even if elements are not properly nested.
+    path = []
+    open_lists = []
+    num_entities = 0
+    entity_depth = 0
+
+    try:
+        for event, element in etree.iterparse(source, events=("start", "end"), recover=True, huge_tree=True,
+                                              remove_comments=True, remove_pis=True):
+            if event == "start":
+                name = etree.QName(element.tag).localname
+
+                if not path and name == "sbml":
+                    model.namespace = etree.QName(element.tag).namespace
+
+                list_name = None
+                if open_lists:
+                    list_name = open_lists[-1]
+
+                is_list = name in ENTITY_TAGS and entity_depth == 0
+                is_entity = not is_list and list_name is not None and name in ENTITY_TAGS[list_name]
+
+                if is_list:
+                    model.lists.add(name)
+                    open_lists.append(name)
+                elif is_entity:
+                    entity_lists[list_name].append(element)
+                    num_entities += 1
+                    entity_depth += 1
+
+                path.append((name, is_list, is_entity, num_entities))
+                continue
+
+            name, is_list, is_entity, entities_before = path.pop()
+            element.tag = name
+
+            if is_list:
+                open_lists.pop()
+            elif is_entity:
+                entity_depth -= 1
+
+            if name == "annotation":
+                parent = element.getparent()
+                if parent is not None and parent.get("id"):
+                    model.identifiers[parent.get("id")] = get_identifiers(element)
+                element.clear()
+
+            elif name == "notes":
+                element.clear()
+
+            # discard anything that is not part of an entity, and does not contain one
+            elif entity_depth == 0 and not is_entity and not is_list and entities_before == num_entities:
+                element.clear()
+
+    except etree.XMLSyntaxError:
+        # Leave it to SBMLDiff.check_model_supported() to reject files that are not SBML
+        pass
+
+    model.build_index()
+    return model
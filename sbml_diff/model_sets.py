@@ -0,0 +1,87 @@
+"""
+Sets of model numbers, represented as integer bitmasks: model k is in the set if bit k is set.
+
+Taking the union of two sets, or testing whether a model is in one, takes a single integer operation, and classifying a
+set as containing all, one or some of the models requires only a popcount, however many models are being compared.
+"""
+
+# Classifications returned by classify()
+NO_MODELS = "none"
+ONE_MODEL = "one"
+SOME_MODELS = "some"
+ALL_MODELS = "all"
+
+
+def to_mask(model_set):
+    """
+    Return the bitmask for a set of model numbers.
+
+    Parameters
+    ----------
+    model_set : a bitmask (which is returned unchanged), or an iterable of model numbers
+
+    Returns
+    -------
+    integer
+
+    """
+    if isinstance(model_set, (int, long)):
+        return model_set
+
+    mask = 0
+    for model_num in model_set:
+        mask |= 1 << model_num
+    return mask
+
+
+def from_mask(mask):
+    """
+    Return a list of the model numbers in a bitmask, in ascending order.
+    """
+    models = []
+    model_num = 0
+    while mask:
+        if mask & 1:
+            models.append(model_num)
+        mask >>= 1
+        model_num += 1
+    return models
+
+
+def full_mask(num_models):
+    """
+    Return the bitmask containing models 0 to num_models - 1.
+    """
+    return (1 << num_models) - 1
+
+
+def popcount(mask):
+    """
+    Return the number of models in a bitmask.
+    """
+    return bin(mask).count("1")
+
+
+def lowest_model(mask):
+    """
+    Return the lowest model number in a bitmask (or -1, if it is empty).
+    """
+    return (mask & -mask).bit_length() - 1
+
+
+def contains_model(mask, model_num):
+    return bool(mask >> model_num & 1)
+
+
+def classify(mask, num_models):
+    """
+    Return whether a bitmask contains none, one, some (i.e. more than one but not all) or all of num_models models.
+    """
+    count = popcount(mask)
+    if count == 0:
+        return NO_MODELS
+    if count >= num_models:
+        return ALL_MODELS
+    if count == 1:
+        return ONE_MODEL
+    return SOME_MODELS
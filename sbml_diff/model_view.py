@@ -0,0 +1,246 @@
+from accessor_functions import get_reaction_analysis, get_species, get_species_name, get_species_compartment, \
+    get_converted_rate_law, get_rate_law_key, get_interaction_sign, get_symbol_occurrences, describe_reaction, \
+    describe_rule
+from effect_direction import DEFAULT_SAMPLES
+
+
+class ReactionDetails(object):
+    """
+    The details of a reaction in one model that are needed to compare it, as returned by the get_reaction() method of a
+    ModelView (or shared_model.SharedModelView).
+
+    rate_law identifies the math of the kineticLaw (or is None, if there is none) to the get_sign(),
+    get_converted_law() and get_rate_law_key() methods of the view that returned the details.
+    """
+    __slots__ = ["reaction_id", "name", "compartment", "reactants", "products", "reactant_stoichiometries",
+                 "product_stoichiometries", "rate_law", "symbol_occurrences", "symbols", "is_fast", "is_irreversible",
+                 "sbo_term", "description"]
+
+    def __init__(self, reaction_id, name, compartment, reactants, products, reactant_stoichiometries,
+                 product_stoichiometries, rate_law, symbol_occurrences, is_fast, is_irreversible, sbo_term):
+        self.reaction_id = reaction_id
+        self.name = name
+        self.compartment = compartment
+        self.reactants = reactants
+        self.products = products
+        self.reactant_stoichiometries = reactant_stoichiometries
+        self.product_stoichiometries = product_stoichiometries
+        self.rate_law = rate_law
+        self.symbol_occurrences = symbol_occurrences
+        self.symbols = set(symbol_occurrences)
+        self.is_fast = is_fast
+        self.is_irreversible = is_irreversible
+        self.sbo_term = sbo_term
+        self.description = describe_reaction(reaction_id)
+
+
+class RuleDetails(object):
+    """
+    The details of the (rate or assignment) rule setting a variable in one model that are needed to compare it, as
+    returned by the get_rule() method of a ModelView (or shared_model.SharedModelView).
+
+    rate_law identifies the math of the rule (or is None, if it has none), as for ReactionDetails.
+    """
+    __slots__ = ["tag", "variable", "compartment", "rate_law", "symbol_occurrences", "description"]
+
+    def __init__(self, tag, variable, compartment, rate_law, symbol_occurrences):
+        self.tag = tag
+        self.variable = variable
+        self.compartment = compartment
+        self.rate_law = rate_law
+        self.symbol_occurrences = symbol_occurrences
+        self.description = describe_rule(tag, variable)
+
+
+class ModelView:
+    """
+    The parts of a model that are read when comparing its reactions, rules and compartments (by SBMLDiff.get_unit_diff()),
+    and the signs of the interactions in them.
+
+    shared_model.SharedModelView provides the same methods for the copy of a model read by the workers of
+    SBMLDiff.diff_in_parallel(), so that the comparison is made by the same code whether or not it runs in a worker.
+    """
+
+    def __init__(self, model, use_sympy=False, samples=DEFAULT_SAMPLES):
+        """
+
+        Parameters
+        ----------
+        model : IndexedModel object produced by load_model(), in which functions have been inlined
+
+        use_sympy : Boolean indicating whether to determine signs symbolically
+
+        samples : number of operating points at which to compare each expression, if signs are determined numerically
+
+        """
+        self.model = model
+        self.use_sympy = use_sympy
+        self.samples = samples
+
+        # set by get_declared_species()
+        self.declared_species = None
+
+    def get_reaction_ids(self):
+        return list(self.model.reactions_by_id)
+
+    def get_reaction(self, reaction_id):
+        """
+        Return the ReactionDetails of a reaction (or None, if the model has no reaction with this id).
+        """
+        if reaction_id not in self.model.reactions_by_id:
+            return None
+        analysis = get_reaction_analysis(self.model, reaction_id)
+        reaction = analysis.reaction
+
+        return ReactionDetails(reaction_id, self.model.reaction_names[reaction_id], analysis.compartment,
+                               analysis.reactants, analysis.products, analysis.reactant_stoichiometries,
+                               analysis.product_stoichiometries, analysis.rate_law, analysis.symbol_occurrences,
+                               reaction.get("fast") in ['1', 'true'], reaction.get("reversible") in ['0', 'false'],
+                               reaction.get("sboTerm"))
+
+    def get_rule(self, variable):
+        """
+        Return the RuleDetails of the rule setting a variable (or None, if the model has no such rule).
+        """
+        rule = self.model.rules_by_variable.get(variable)
+        if rule is None:
+            return None
+
+        rate_law = rule.find("math")
+        symbol_occurrences = []
+        if rate_law is not None:
+            symbol_occurrences = get_symbol_occurrences(rate_law)
+        compartment = get_species_compartment(self.model, variable).strip()
+        return RuleDetails(rule.tag, variable, compartment, rate_law, symbol_occurrences)
+
+    def get_species(self, compartment_id):
+        return get_species(self.model, compartment_id)
+
+    def get_declared_species(self):
+        """
+        Return the set of species in the compartments declared by the model.
+        """
+        if self.declared_species is None:
+            self.declared_species = set()
+            for compartment_id in self.model.compartments_by_id:
+                self.declared_species.update(get_species(self.model, compartment_id))
+        return self.declared_species
+
+    def is_species(self, species_id):
+        return species_id in self.model.species_by_id
+
+    def get_species_name(self, species_id):
+        return get_species_name(self.model, species_id)
+
+    def get_boundary_condition(self, species_id):
+        """
+        Return the boundaryCondition attribute of a species ("" if it is not set).
+        """
+        return self.model.species_by_id[species_id].get("boundaryCondition", "")
+
+    def get_sign(self, details, symbol):
+        """
+        Return the sign of the interaction between a symbol and the math of a reaction or rule (see
+        get_interaction_sign()).
+        """
+        return get_interaction_sign(self.model, details.rate_law.getparent(), symbol, use_sympy=self.use_sympy,
+                                    samples=self.samples)
+
+    def get_converted_law(self, details):
+        return get_converted_rate_law(self.model, details.rate_law)
+
+    def get_rate_law_key(self, details):
+        return get_rate_law_key(details.rate_law, self.model)
+
+
+def get_regulatory_arrows(view, compartment_id, elided_reactions=()):
+    """
+    Find all regulatory interactions in a particular compartment of a model.
+    A regulatory interaction exists if a kinetic law includes a species id that is not a reactant.
+
+    Parameters
+    ----------
+    view : ModelView (or shared_model.SharedModelView) of the model
+
+    compartment_id : the id of a compartment
+
+    elided_reactions : the ids of reactions that are not drawn
+
+
+    Returns
+    -------
+    list of (species id, reaction id, arrow direction) tuples
+
+    """
+    species_ids = set(view.get_species(compartment_id))
+
+    arrows = []
+    for reaction_id in view.get_reaction_ids():
+        if reaction_id in elided_reactions:
+            continue
+        details = view.get_reaction(reaction_id)
+
+        for species_id in details.symbol_occurrences:
+
+            # Check if this is a species id (it could validly be a species/compartment/parameter/function/reaction id)
+            if species_id not in species_ids:
+                continue
+
+            # if not a reactant, add regulatory arrow
+            if species_id in details.reactants:
+                continue
+
+            arrows.append((species_id, reaction_id, view.get_sign(details, species_id)))
+
+    return arrows
+
+
+def find_abstract_interactions(view, details, species):
+    """
+    Find the interactions between species due to a single reaction (see SBMLDiff.abstract_model()).
+
+    Parameters
+    ----------
+    view : ModelView (or shared_model.SharedModelView) of the model
+
+    details : ReactionDetails of the reaction
+
+    species : set of the species being abstracted
+
+    Returns
+    -------
+    list of (modifier, species affected, effect type) tuples
+
+    """
+    interactions = []
+
+    # Identify all species that appear in kineticLaw
+    modifiers = details.symbols.intersection(species)
+
+    for modifier in modifiers:
+        for reactant in details.reactants:
+
+            # Any species increases the rate of its own degredation, so ignore this
+            if reactant == modifier:
+                continue
+
+            if reactant not in species:
+                continue
+
+            effect = view.get_sign(details, modifier)
+            if effect == "monotonic_increasing":
+                interactions.append((modifier, reactant, "increase-degredation"))
+            elif effect == "monotonic_decreasing":
+                interactions.append((modifier, reactant, "decrease-degredation"))
+
+        for product in details.products:
+            if product not in species:
+                continue
+
+            effect = view.get_sign(details, modifier)
+            if effect == "monotonic_increasing":
+                interactions.append((modifier, product, "increase-production"))
+            elif effect == "monotonic_decreasing":
+                interactions.append((modifier, product, "decrease-production"))
+
+    return interactions
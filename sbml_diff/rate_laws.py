@@ -1,15 +1,23 @@
-from bs4 import BeautifulSoup, NavigableString
 import copy
+import math as math_module
+import re
 import sys
+import numpy
+from lxml import etree
+from math_ast import get_math_expression
 
 
-def convert_rate_law(math, initial_values=False, non_default_variables=False, non_default_values=1, output_type=""):
+def convert_rate_law(math, initial_values=False, non_default_variables=False, non_default_values=1, output_type="",
+                     symbol_names=None):
     """
     A wrapper for convert_rate_law_inner that returns only the converted expression.
 
+    Each math element is parsed only once (by math_ast.get_math_expression()), and the string produced for each
+    output_type is reused.
+
     Parameters
     ----------
-    math : BeautifulSoup object representing a rateLaw (a bs4.element.Tag)
+    math : lxml element representing a rateLaw
 
     non_default_variables : if specified, the name of any species whose id is not in this list is replaced by 1.0
          (Default value = False)
@@ -17,6 +25,9 @@ def convert_rate_law(math, initial_values=False, non_default_variables=False, no
     output_type : if "executable", return a less human-readable string that can be eval'ed in Python; if "sympy"
         generate string that uses sympy functions (rather than math functions)
 
+    symbol_names : if specified, a dict giving the string that replaces each identifier (used instead of
+        non_default_variables)
+
     Returns
     -------
     string representation of the kineticLaw
@@ -25,33 +36,29 @@ def convert_rate_law(math, initial_values=False, non_default_variables=False, no
     if not initial_values:
         initial_values = {}
 
-    if not math:
+    if math is None or isinstance(math, basestring):
         return ""
 
-    if math.select_one('piecewise') or math.name == 'piecewise':
+    expression = get_math_expression(math)
+
+    if expression.piecewise:
         sys.stderr.write("Encountered a piecewise function\n")
         if output_type in ["executable", "sympy"]:
             return "piecewise"
         return ""
 
-    return convert_rate_law_inner(math, initial_values, non_default_variables, non_default_values, output_type)[1]
-
-
-def add_parens(term_elementary, terms):
-    """
-    If any elements in the first argument is false, wrap the corresponding elements of the second argument in parentheses.
+    # the result depends on initial_values only if non_default_variables is given, so is not reused
+    if non_default_variables and not symbol_names:
+        return convert_rate_law_inner(expression.tree, initial_values, non_default_variables, non_default_values,
+                                      output_type)[1]
 
-    Parameters
-    ----------
-    term_elementary : boolean - if this is false, wrap terms in parentheses
-        
-    terms : string
-
-    """
-    for ind, is_elementary in enumerate(term_elementary):
-        if not is_elementary:
-            terms[ind] = "(%s)" % terms[ind]
-    return terms
+    key = (output_type, None)
+    if symbol_names:
+        key = (output_type, tuple(sorted(symbol_names.items())))
+    if key not in expression.conversions:
+        expression.conversions[key] = convert_rate_law_inner(expression.tree, initial_values, output_type=output_type,
+                                                             symbol_names=symbol_names)[1]
+    return expression.conversions[key]
 
 
 def convert_function(output_type, function_name):
@@ -63,7 +70,7 @@ def convert_function(output_type, function_name):
                           "t": "1", "N_A": "1"}
 
     sympy_replacement = {'exp': 'sympy.exp', 'ln': 'sympy.log', 'log': 'sympy.log10', 'ceiling': 'sympy.ceiling',
-                         'floor': 'sympy.floor', 'factorial': 'sympy.factorial', 'pi': 'sympy.pi', 'e': 'sympy.mpmath.e',
+                         'floor': 'sympy.floor', 'factorial': 'sympy.factorial', 'pi': 'sympy.pi', 'e': 'sympy.E',
                          'infinity': 'float("Inf")', "sqrt": "sympy.sqrt", "abs": "abs", "cos": "sympy.cos",
                          "sin": "sympy.sin", "tan": "sympy.tan", "sinh": "sympy.sinh", "cosh": "sympy.cosh",
                          "tanh": "sympy.tanh", "arcsin": "sympy.asin", "arccos": "sympy.acos", "arctan": "sympy.atan",
@@ -78,15 +85,19 @@ def convert_function(output_type, function_name):
         return sympy_replacement[function_name]
 
 
-def convert_rate_law_inner(expression, initial_values, non_default_variables=False, non_default_values=1, output_type=""):
+def convert_rate_law_inner(node, initial_values, non_default_variables=False, non_default_values=1, output_type="",
+                           symbol_names=None):
     """
-    Recursively convert a MathML expression to a string.
+    Convert a MathML expression (as parsed by math_ast.parse_math()) to a string.
     Limitations: we do not handle piecewise functions or user-defined functions.
 
+    The tree is walked using an explicit stack (so expressions of any depth can be converted), and the output is
+    collected in a single list of fragments that is joined once.
+
     Parameters
     ----------
-    expression :
-        
+    node : MathNode representing the expression
+
     non_default_variables : if specified, the name of any species whose id is not in this list is replaced by 1.0
          (Default value = False)
 
@@ -95,173 +106,373 @@ def convert_rate_law_inner(expression, initial_values, non_default_variables=Fal
 
     Returns
     -------
-    string representation of the kineticLaw
+    tuple containing a Boolean indicating whether the expression is elementary (so never needs parentheses) and the
+    string representation of the expression
+
+    Raises
+    ------
+    TypeError, if the expression contains an element or operator that cannot be converted
 
     """
+    output = []
 
-    elementary = False
+    # fragments of output still to be produced (last first): strings, or nodes still to be converted
+    stack = [node]
+    while stack:
+        item = stack.pop()
 
-    generate_code = (output_type in ["executable", "sympy"])
+        if isinstance(item, basestring):
+            output.append(item)
+
+        elif item.tag == "apply":
+            fragments = convert_apply(item, output_type)
+            fragments.reverse()
+            stack.extend(fragments)
 
-    if expression.name == "cn":
-
-        if "type" in expression.attrs.keys():
-            children = []
-            term = ""
-            for child in expression.children:
-                children.append(child)
-
-            if expression.attrs["type"] == "e-notation":
-                term = "%s * 10^(%s)" % (children[0], children[2])
-                if generate_code:
-                    term = "%s * 10**(%s)" % (children[0], children[2])
-            elif expression.attrs["type"] in ["real", "integer"]:
-                term = children[0]
-            elif expression.attrs["type"] == "rational":
-                term = "%s/%s" % (children[0], children[2])
         else:
-            term = expression.string.strip()
+            output.append("%s" % convert_leaf(item, initial_values, non_default_variables, non_default_values,
+                                              output_type, symbol_names))
+
+    return node.tag != "apply", "".join(output)
+
+
+def convert_leaf(node, initial_values, non_default_variables, non_default_values, output_type, symbol_names):
+    """
+    Convert a MathNode other than an apply to a string (see convert_rate_law_inner()).
+    """
+    generate_code = (output_type in ["executable", "sympy"])
+
+    if node.tag == "cn":
+
+        if node.value is None:
+            return node.args[0]
 
-        elementary = True
+        # text before and after the <sep/> element
+        parts = node.args
 
-        return elementary, term
+        if node.value == "e-notation":
+            if generate_code:
+                return "%s * 10**(%s)" % (parts[0], parts[1])
+            return "%s * 10^(%s)" % (parts[0], parts[1])
+        elif node.value in ["real", "integer"]:
+            return parts[0]
+        elif node.value == "rational":
+            return "%s/%s" % (parts[0], parts[1])
+        return ""
 
-    elif expression.name == "ci":
-        elementary = True
-        term = expression.string.strip()
+    if node.tag == "ci":
+        term = node.value
 
-        if non_default_variables:
+        if symbol_names:
+            term = symbol_names[term]
+        elif non_default_variables:
             if term in non_default_variables:
                 term = non_default_values
-            elif term in initial_values.keys():
+            elif term in initial_values:
                 term = initial_values[term]
             else:
                 term = '1.0'
 
-        return elementary, term
+        return term
 
-    if expression.name in ["pi", "infinity"]:
-        return True, convert_function(output_type, expression.name)
-    if expression.name == "exponentiale":
-        return True, convert_function(output_type, "e")
+    if node.tag == "constant":
+        return convert_function(output_type, node.value)
 
-    # math may contain either an <apply> or a <cn>
-    if expression.name == "math":
-        for child in expression.children:
-            if not isinstance(child, NavigableString):
-                return convert_rate_law_inner(child, initial_values, non_default_variables, non_default_values, output_type)
+    raise TypeError("Cannot convert MathML element '%s'" % node.value)
 
-    if expression.name == "csymbol":
-        if "time" in expression.attrs['definitionURL']:
-            return True, convert_function(output_type, "t")
 
-        if "avogadro" in expression.attrs['definitionURL']:
-            return True, convert_function(output_type, "N_A")
+def convert_apply(node, output_type):
+    """
+    Return the output for an apply node, as a list in which each element is either a string or a MathNode (to be
+    converted in its place).
+    """
+    operator = node.value
+    args = node.args
+    generate_code = (output_type in ["executable", "sympy"])
 
-    # First child is operator; next are arguments
-    if expression.name == "apply":
-        operator = None
-        args = []
-        for child in expression.children:
-            if not operator:
-                operator = child.name
-                if child.name == "csymbol" and child.string.strip() == "delay":
-                    operator = "delay"
-            else:
-                if isinstance(child, NavigableString):
-                    continue
-                args.append(child)
-
-        children_converted = []
-        children_elementary = []
-        for arg in args:
-            child_elementary, child_converted = convert_rate_law_inner(arg, initial_values, non_default_variables, non_default_values, output_type)
-            children_converted.append(child_converted)
-            children_elementary.append(child_elementary)
-
-        if operator == "plus":
-            return elementary, " + ".join(children_converted)
-        elif operator == "minus":
-            return elementary, " - ".join(children_converted)
-        elif operator == "times":
-            children_converted = add_parens(children_elementary, children_converted)
-            return elementary, " * ".join(children_converted)
-        elif operator == "divide":
-            children_converted = add_parens(children_elementary, children_converted)
-            return elementary, "%s / %s" % (children_converted[0], children_converted[1])
-        elif operator == "power":
-            children_converted = add_parens(children_elementary, children_converted)
-            if generate_code:
-                return elementary, "%s ** %s " % (children_converted[0], children_converted[1])
-            return elementary, "%s ^ %s " % (children_converted[0], children_converted[1])
-        elif operator == "gt":
-            children_converted = add_parens(children_elementary, children_converted)
-            return elementary, "%s > %s " % (children_converted[0], children_converted[1])
-        elif operator == "geq":
-            children_converted = add_parens(children_elementary, children_converted)
-            return elementary, "%s >= %s " % (children_converted[0], children_converted[1])
-        elif operator == "eq":
-            children_converted = add_parens(children_elementary, children_converted)
-            if generate_code:
-                return elementary, "%s == %s " % (children_converted[0], children_converted[1])
-            return elementary, "%s = %s " % (children_converted[0], children_converted[1])
-        elif operator == "lt":
-            children_converted = add_parens(children_elementary, children_converted)
-            return elementary, "%s < %s " % (children_converted[0], children_converted[1])
-        elif operator == "leq":
-            children_converted = add_parens(children_elementary, children_converted)
-            return elementary, "%s <= %s " % (children_converted[0], children_converted[1])
-        elif operator == "or":
-            children_converted = add_parens(children_elementary, children_converted)
-            return elementary, "%s or %s " % (children_converted[0], children_converted[1])
-        elif operator == "and":
-            children_converted = add_parens(children_elementary, children_converted)
-            return elementary, "%s and %s " % (children_converted[0], children_converted[1])
-        elif operator == "delay":
-            if output_type in ["executable", "sympy"]:
-                return elementary, children_converted[0]
-            return elementary, "delay(%s, %s)" % (children_converted[0], children_converted[1])
-        elif operator in ["exp", "ln", "floor", "ceiling", "factorial", "abs", "cos", "sin", "tan", "sinh", "cosh",
-                          "tanh", "arcsin", "arccos", "arctan"]:
-            return elementary, "%s(%s)" % (convert_function(output_type, operator), children_converted[0])
-        elif operator == "log":
-            if len(children_converted) == 1:
-                return elementary, "%s(%s)" % (convert_function(output_type, "log"), children_converted[0])
+    def join(separator, children):
+        fragments = []
+        for ind, child in enumerate(children):
+            if ind > 0:
+                fragments.append(separator)
+            fragments.extend(child)
+        return fragments
+
+    def plain(ind):
+        return [args[ind]]
+
+    def with_parens(ind):
+        # wrap arguments that are not elementary in parentheses
+        if args[ind].tag == "apply":
+            return ["(", args[ind], ")"]
+        return [args[ind]]
+
+    binary_operators = {"gt": ">", "geq": ">=", "lt": "<", "leq": "<=", "or": "or", "and": "and"}
+    if generate_code:
+        binary_operators.update({"power": "**", "eq": "=="})
+    else:
+        binary_operators.update({"power": "^", "eq": "="})
+
+    if operator == "plus":
+        return join(" + ", [plain(ind) for ind in range(len(args))])
+    elif operator == "minus":
+        return join(" - ", [plain(ind) for ind in range(len(args))])
+    elif operator == "times":
+        return join(" * ", [with_parens(ind) for ind in range(len(args))])
+    elif operator == "divide":
+        return with_parens(0) + [" / "] + with_parens(1)
+    elif operator in binary_operators:
+        return with_parens(0) + [" %s " % binary_operators[operator]] + with_parens(1) + [" "]
+    elif operator == "delay":
+        if generate_code:
+            return plain(0)
+        return ["delay("] + plain(0) + [", "] + plain(1) + [")"]
+    elif operator in ["exp", "ln", "floor", "ceiling", "factorial", "abs", "cos", "sin", "tan", "sinh", "cosh",
+                      "tanh", "arcsin", "arccos", "arctan"]:
+        return ["%s(" % convert_function(output_type, operator)] + plain(0) + [")"]
+    elif operator == "log":
+        if len(args) == 1:
+            return ["%s(" % convert_function(output_type, "log")] + plain(0) + [")"]
+        elif output_type == "executable":
+            # NB. second argument to math.log is base [opposite to mathML]
+            return ["math.log("] + plain(1) + [", "] + plain(0) + [")"]
+        elif output_type == "sympy":
+            return ["sympy.log("] + plain(1) + [", "] + plain(0) + [")"]
+        return ["log_"] + plain(0) + ["("] + plain(1) + [")"]
+    elif operator == "root":
+        # default to sqrt()
+        if len(args) == 1:
+            return ["%s(" % convert_function(output_type, "sqrt")] + plain(0) + [")"]
+
+        # otherwise root(n,a) = pow(a, 1/n)
+        if len(args) == 2:
+            if output_type == "executable":
+                return ["pow("] + plain(1) + [", 1/"] + plain(0) + [")"]
+            return ["%s(" % convert_function(output_type, "root")] + plain(0) + [", "] + plain(1) + [")"]
+
+    raise TypeError("Cannot convert MathML operator '%s'" % operator)
+
+
+# Python's parser overflows its stack (printing "s_push: parser stack overflow") on code with more than about 90 levels
+# of nested parentheses. Code nested more deeply than MAX_COMPILE_DEPTH is split by split_nested_code() into statements
+# whose parentheses are nested at most SPLIT_DEPTH deep.
+MAX_COMPILE_DEPTH = 60
+SPLIT_DEPTH = 30
+
+PAREN_PATTERN = re.compile(r"[(),]")
+
+
+def get_nesting_depth(code):
+    """
+    Return the maximum depth to which parentheses are nested in some code.
+    """
+    if code.count("(") <= MAX_COMPILE_DEPTH:
+        return code.count("(")
+
+    depth = 0
+    max_depth = 0
+    for match in PAREN_PATTERN.finditer(code):
+        if match.group() == "(":
+            depth += 1
+            max_depth = max(max_depth, depth)
+        elif match.group() == ")":
+            depth -= 1
+    return max_depth
+
+
+def split_nested_code(code):
+    """
+    Split an expression produced by convert_rate_law() into a list of assignments to temporary variables and a final
+    expression using them, so that no statement has parentheses nested more than SPLIT_DEPTH deep.
+
+    Each parenthesised group whose contents are nested SPLIT_DEPTH deep is evaluated first, and assigned to a variable
+    that replaces it; a group containing the arguments of a call (e.g. "math.log(x, b)") is assigned as a tuple, and
+    passed to the call as "(*t)".
+
+    Returns
+    -------
+    a tuple (assignments, expression)
+
+    """
+    assignments = []
+
+    # for each group that is open: the fragments of its contents, how deeply they are nested, and whether they contain
+    # a comma outside any inner group
+    groups = [([], 0, False)]
+    position = 0
+    for match in PAREN_PATTERN.finditer(code):
+        fragments, height, has_comma = groups[-1]
+        fragments.append(code[position:match.start()])
+        position = match.end()
+
+        token = match.group()
+        if token == ",":
+            fragments.append(token)
+            groups[-1] = (fragments, height, True)
+        elif token == "(":
+            groups.append(([], 0, False))
+        else:
+            groups.pop()
+            contents = "".join(fragments)
+            height += 1
+            if height >= SPLIT_DEPTH:
+                name = "t%s" % len(assignments)
+                assignments.append("%s = (%s)" % (name, contents))
+                if has_comma:
+                    replacement = "(*%s)" % name
+                else:
+                    replacement = "(%s)" % name
+                height = 1
             else:
-                if output_type == "executable":
-                    # NB. second argument to math.log is base [opposite to mathML]
-                    return elementary, "math.log(%s, %s)" % (children_converted[1], children_converted[0])
-                elif output_type == "sympy":
-                    return elementary, "sympy.log(%s, %s)" % (children_converted[1], children_converted[0])
+                replacement = "(%s)" % contents
 
-                return elementary, "%s_%s(%s)" % ("log", children_converted[0], children_converted[1])
+            outer_fragments, outer_height, outer_comma = groups[-1]
+            outer_fragments.append(replacement)
+            groups[-1] = (outer_fragments, max(outer_height, height), outer_comma)
 
-        elif operator == "root":
+    fragments = groups[0][0]
+    fragments.append(code[position:])
+    return assignments, "".join(fragments)
 
-            # default to sqrt()
-            if len(children_converted) == 1:
-                return elementary, "%s(%s)" % (convert_function(output_type, "sqrt"), children_converted[0])
 
-            # otherwise root(n,a) = pow(a, 1/n)
-            if len(children_converted) == 2:
-                if output_type == "executable":
-                    return elementary, "pow(%s, 1/%s)" % (children_converted[1], children_converted[0])
-                return elementary, "%s(%s, %s)" % (convert_function(output_type, "root"), children_converted[0], children_converted[1])
+def compile_code(code, namespace):
+    """
+    Return a function of a list v that evaluates an expression produced by convert_rate_law(), splitting deeply nested
+    expressions (see split_nested_code()) so that they can be parsed.
+    """
+    if get_nesting_depth(code) <= MAX_COMPILE_DEPTH:
+        return eval("lambda v: %s" % code, namespace)
 
-    elif expression.name == "logbase":
+    assignments, expression = split_nested_code(code)
+    lines = ["def function(v):"]
+    lines.extend("    %s" % assignment for assignment in assignments)
+    lines.append("    return %s" % expression)
 
-        for child in expression.children:
-            if isinstance(child, NavigableString):
-                continue
+    local_names = {}
+    exec "\n".join(lines) in namespace, local_names
+    return local_names["function"]
 
-            child_elementary, child_converted = convert_rate_law_inner(child, initial_values, non_default_variables, non_default_values, output_type)
-            return child_elementary, child_converted
 
-    if expression.name == "degree":
-        # degree tag used with root
-        for child in expression.children:
-            if not isinstance(child, NavigableString):
-                return convert_rate_law_inner(child, initial_values, non_default_variables, non_default_values, output_type)
+class CompiledRateLaw:
+    """
+    A math expression, compiled into a Python function that takes a list containing the value of each of its symbols.
+    """
+
+    def __init__(self, math):
+        """
+
+        Parameters
+        ----------
+        math : lxml element representing a math expression
+
+        """
+        # each identifier is replaced by an element of the list passed to the function
+        expression = get_math_expression(math)
+        self.symbols = list(expression.symbols)
+        symbol_names = expression.get_indexed_symbol_names()
+
+        self.function = None
+        self.vector_function = None
+        converted = convert_rate_law(math, output_type="executable", symbol_names=symbol_names)
+        if converted and converted != "piecewise":
+            try:
+                self.function = compile_code(converted, {"math": math_module})
+
+                # the same code, calling NumPy functions, evaluates the expression at many points at once
+                self.vector_function = compile_code(converted, {"math": NumpyFunctions})
+            except (SyntaxError, MemoryError, RuntimeError):
+                # e.g. the compiler ran out of stack; leave the expression uncompiled
+                self.function = None
+                self.vector_function = None
+
+        # the signs found by effect_direction.check_sign_numerically(), for each set of initial values
+        self.signs = {}
+
+    def evaluate(self, values):
+        """
+        Evaluate the expression.
+
+        Parameters
+        ----------
+        values : list containing the value of each symbol, in the order given by self.symbols
+
+        Returns
+        -------
+        value of the expression
+
+        """
+        return self.function(values)
+
+    def evaluate_points(self, values):
+        """
+        Evaluate the expression at several points at once.
+
+        Parameters
+        ----------
+        values : 2D NumPy array, in which values[i, j] is the value of the i'th symbol at the j'th point
+
+        Returns
+        -------
+        1D NumPy array containing the value of the expression at each point (NaN where it is undefined)
+
+        """
+        num_points = values.shape[1]
+
+        with numpy.errstate(all="ignore"):
+            try:
+                result = numpy.asarray(self.vector_function(values), dtype=float)
+                return result * numpy.ones(num_points)
+            except (ValueError, TypeError, ZeroDivisionError, OverflowError):
+                # e.g. 'and' or 'or' applied to arrays: evaluate each point separately
+                pass
+
+            result = numpy.empty(num_points)
+            for point in range(num_points):
+                try:
+                    result[point] = self.function(list(values[:, point]))
+                except (ValueError, TypeError, ZeroDivisionError, OverflowError):
+                    result[point] = numpy.nan
+            return result
+
+
+class NumpyFunctions:
+    """
+    Replacements for the functions of the math module used by executable expressions, which act on NumPy arrays.
+    """
+    exp = staticmethod(numpy.exp)
+    log10 = staticmethod(numpy.log10)
+    ceil = staticmethod(numpy.ceil)
+    floor = staticmethod(numpy.floor)
+    factorial = staticmethod(numpy.vectorize(lambda x: math_module.gamma(x + 1), otypes=[float]))
+    sqrt = staticmethod(numpy.sqrt)
+    cos = staticmethod(numpy.cos)
+    sin = staticmethod(numpy.sin)
+    tan = staticmethod(numpy.tan)
+    sinh = staticmethod(numpy.sinh)
+    cosh = staticmethod(numpy.cosh)
+    tanh = staticmethod(numpy.tanh)
+    asin = staticmethod(numpy.arcsin)
+    acos = staticmethod(numpy.arccos)
+    atan = staticmethod(numpy.arctan)
+    pi = numpy.pi
+    e = numpy.e
+
+    @staticmethod
+    def log(x, base=None):
+        if base is None:
+            return numpy.log(x)
+        return numpy.log(x) / numpy.log(base)
+
+
+def compile_rate_law(math):
+    """
+    Return the CompiledRateLaw for a math expression, compiling it only if no equivalent math element (one with the
+    same MathExpression) has been compiled before.
+    """
+    expression = get_math_expression(math)
+    if expression.compiled is None:
+        expression.compiled = CompiledRateLaw(math)
+    return expression.compiled
 
 
 def inline_all_functions(model):
@@ -271,9 +482,14 @@ def inline_all_functions(model):
     This is a safe to perform: the SBML L3V1 Core Specification states:
     "With the restrictions as they are, function definitions could, if desired, be implemented as textual substitutions"
 
+    Each math element is walked once, bottom-up, so the arguments of a call have already been inlined when the call is
+    replaced. Function definitions that call other functions are themselves inlined the first time they are used, and
+    the result is reused for every later call. Because a nested call is resolved before the arguments of the outer call
+    are substituted, the bound variables of the outer function are replaced inside the inlined inner call too.
+
     Parameters
     ----------
-    model : bs4.BeautifulSoup object produced by parsing an SBML model
+    model : SBMLModel object produced by load_model()
 
     Returns
     -------
@@ -283,85 +499,133 @@ def inline_all_functions(model):
     # Get function definitions
     function_definition = {}
 
-    function_definitions = model.select_one('listOfFunctionDefinitions')
-
-    if not function_definitions:
+    if model.functions_inlined or not model.function_definitions:
+        model.functions_inlined = True
         return model
 
-    for function in function_definitions.select("functionDefinition"):
+    for function in model.function_definitions:
 
-        function_id = function.attrs["id"]
-        math = copy.copy(function.select_one("math").select_one("lambda"))
+        function_id = function.attrib["id"]
+        math = copy.deepcopy(function.find("math").find("lambda"))
 
         # get list of arguments to this function
         args = []
-        for bvar in math.select('bvar'):
-            args.append(bvar.select_one('ci').text.strip())
+        for bvar in math.findall('bvar'):
+            args.append(bvar.find('ci').text.strip())
 
         # now remove the bvars the get the body of the function
-        for bvar in math.select("bvar"):
-            bvar.replace_with('')
+        for bvar in math.findall("bvar"):
+            math.remove(bvar)
 
         inner = ""
-        for child in math.contents:
-            if not isinstance(child, NavigableString):
-                inner = child
-                break
+        for child in math:
+            inner = child
+            break
 
-        function_definition[function_id] = {"math": inner, "arguments": args}
+        function_definition[function_id] = {"math": inner, "arguments": args, "resolved": False}
 
     # Replace function calls with inlined definitions
-    replaced = True
-    while replaced:
-        replaced = False
-
-        for math in model.select("math"):
-            for apply_element in math.select('apply'):
-                # get list of tag children
-                children = []
-                for child in apply_element.contents:
-                    if not isinstance(child, NavigableString):
-                        children.append(child)
-
-                name = children[0].text.strip()
-                if name in function_definition.keys():
-                    inlined = inline_function_call(function_definition[name], children[1:])
-                    apply_element.replace_with(inlined)
-                    replaced = True
-                    break
+    for entity in model.get_entities():
+        for math in entity.iter('math'):
+            inline_calls(math, function_definition)
+
+    # any serialised math recorded for the model is now out of date
+    if hasattr(model, "math_expressions"):
+        model.math_expressions = {}
+
+    model.functions_inlined = True
     return model
 
 
+def inline_calls(parent, function_definition):
+    """
+    Replace every call to a user-defined function below an element with the corresponding definition, in a single
+    bottom-up pass.
+
+    Parameters
+    ----------
+    parent : lxml element (which is not itself replaced)
+    function_definition : dict of functions, as constructed by inline_all_functions()
+    """
+    # in reverse document order, every apply element is visited after those it contains
+    for apply_element in reversed(list(parent.iter('apply'))):
+        if apply_element is parent:
+            continue
+
+        # get list of tag children
+        children = list(apply_element)
+        if not children:
+            continue
+
+        name = (children[0].text or "").strip()
+        if name in function_definition:
+            inlined = inline_function_call(get_resolved_function(name, function_definition), children[1:])
+            inlined.tail = apply_element.tail
+            apply_element.getparent().replace(apply_element, inlined)
+
+
+def get_resolved_function(name, function_definition):
+    """
+    Return a user-defined function, after inlining any calls to other functions in its body (which is done only once
+    for each function).
+    """
+    func = function_definition[name]
+    if func["resolved"] == "resolving":
+        raise RuntimeError("Function definition %s calls itself" % name)
+
+    if not func["resolved"] and func["math"] is not None and not isinstance(func["math"], basestring):
+        func["resolved"] = "resolving"
+
+        wrapper = etree.Element("math")
+        wrapper.append(func["math"])
+        inline_calls(wrapper, function_definition)
+        func["math"] = wrapper[0]
+        wrapper.remove(func["math"])
+
+    func["resolved"] = True
+    return func
+
+
 def inline_function_call(func, arguments):
     """
 
     Parameters
     ----------
     func : dict representing user defined function
-    arguments : BeautifulSoup object representing the expressions used as arguments to the function
+    arguments : lxml elements representing the expressions used as arguments to the function (which are moved into
+        the returned element, so should not be used afterwards)
 
     Returns
     -------
-    BeautifulSoup object representing the supplied expressions substituted into the function definition
+    lxml element representing the supplied expressions substituted into the function definition
     """
     math = func["math"]
     args = func["arguments"]
 
-    math = copy.copy(math)
+    # the body of the function may be just one of its arguments
+    if math.tag == "ci" and math.text.strip() in args:
+        return arguments[args.index(math.text.strip())]
+
+    math = copy.deepcopy(math)
 
     # for each arg, get list of ci elements
     cis = {}
-    for ci in math.select("ci"):
+    for ci in math.iter("ci"):
         variable_name = ci.text.strip()
         if variable_name in args:
-            if variable_name not in cis.keys():
+            if variable_name not in cis:
                 cis[variable_name] = []
             cis[variable_name].append(ci)
 
-    # now replace each element in this list
+    # now replace each element in this list (the last use of each argument can take the argument itself)
     for i in range(len(args)):
-        if args[i] in cis.keys():
-            for ci in cis[args[i]]:
-                ci.replace_with(copy.copy(arguments[i]))
+        if args[i] in cis and i < len(arguments):
+            uses = cis[args[i]]
+            for use_num, ci in enumerate(uses):
+                replacement = arguments[i]
+                if use_num < len(uses) - 1:
+                    replacement = copy.deepcopy(arguments[i])
+                replacement.tail = ci.tail
+                ci.getparent().replace(ci, replacement)
 
     return math
@@ -1,34 +1,140 @@
-from bs4 import BeautifulSoup
+from lxml import etree
+from model_loader import load_model, IndexedModel
+from model_cache import ModelCache
+from model_files import open_model, make_seekable, get_model_name
 from accessor_functions import *
 from generate_dot import *
 from DiffObject import DiffObject
+from model_sets import to_mask
+from shared_model import SharedModels
+from model_view import ModelView, get_regulatory_arrows, find_abstract_interactions
 from rate_laws import *
 from miriam import align_models
+from effect_direction import DEFAULT_SAMPLES, DEFAULT_SYMPY_TIMEOUT, DEFAULT_SYMPY_MEMORY, set_symbolic_budget, load_sympy
 from tabulate import tabulate
+from multiprocessing import Pool, cpu_count
+import os
 import sys
 import re
 
 
+def read_model(model_string, cache=None, use_sympy=False, analyse=False, samples=DEFAULT_SAMPLES):
+    """
+    Parse a model, or read it from the cache if it has been parsed before.
+
+    On a cache miss, the functions in the model are inlined and its rate laws analysed before it is stored, so that
+    none of this work is repeated when the same model is compared again.
+
+    Parameters
+    ----------
+    model_string : an SBML model (which may be compressed or archived), as a string or file-like object, or an
+        IndexedModel that has already been read (e.g. the parsed_models of another SBMLDiff object)
+    cache : ModelCache object (or None)
+    use_sympy : Boolean indicating whether interaction signs are determined symbolically
+    analyse : Boolean indicating whether to inline functions and analyse rate laws even if the model is not cached
+
+    Returns
+    -------
+    an IndexedModel object
+
+    """
+    if isinstance(model_string, IndexedModel):
+        return model_string
+
+    key = None
+    model = None
+
+    if cache is None:
+        model = load_model(open_model(model_string))
+    else:
+        # the model is read twice on a cache miss: once to find its key, and again to parse it
+        model_string = make_seekable(model_string)
+        key = cache.get_key(open_model(model_string), use_sympy, samples)
+        model = cache.load(key)
+        if model is not None:
+            return model
+
+        model_string.seek(0)
+        model = load_model(open_model(model_string))
+
+    if model.namespace and (analyse or cache is not None):
+        inline_all_functions(model)
+        analyse_model(model, use_sympy, samples)
+
+        if cache is not None:
+            cache.store(key, model)
+    return model
+
+
+# The SBMLDiff object whose models are compared by diff_unit_in_worker(). This is set before the pool of workers is
+# created, so that each worker inherits the shared copy of the models (see shared_model) when it is forked, rather than
+# receiving them pickled.
+parallel_diff = None
+
+
+def diff_unit_in_worker(unit):
+    """
+    Compare a unit of work for SBMLDiff.diff_in_parallel() in a worker process (see SharedModels.diff_unit()).
+    """
+    return parallel_diff.shared_models.diff_unit(unit, parallel_diff)
+
+
+def read_model_in_worker(args):
+    """
+    Call read_model() in a worker process, inlining the functions of the model and analysing it (as if it were being
+    added to the cache). The model is passed as a path if it is a file (so that it is read by the worker), and returned
+    to the parent process, with its ReactionAnalysis objects, converted rate laws, canonical keys and interaction signs,
+    in the compact form produced by pickling (see IndexedModel.__getstate__()).
+    """
+    path, model_string, cache, use_sympy, samples = args
+    if path:
+        with open(path, "rb") as model_file:
+            return read_model(model_file, cache, use_sympy, analyse=True, samples=samples)
+    return read_model(model_string, cache, use_sympy, analyse=True, samples=samples)
+
+
 class SBMLDiff:
 
-    def __init__(self, model_strings, model_names, generate_dot, align=False, cartoon=False, show_params=True, hide_rules=False, use_sympy=""):
+    def __init__(self, model_strings, model_names, generate_dot, align=False, cartoon=False, show_params=True, hide_rules=False, use_sympy="",
+                 cache=None, jobs=1, samples=DEFAULT_SAMPLES, sympy_timeout=DEFAULT_SYMPY_TIMEOUT,
+                 sympy_memory=DEFAULT_SYMPY_MEMORY, stream=False):
         """
 
         Parameters
         ----------
-        model_strings : a list, in which each element is an SBML model as a string
+        model_strings : a list (or other iterable), in which each element is an SBML model as a string or file-like
+            object. Models may be compressed (gzip, bzip2 or xz), or contained in a zip or COMBINE archive. Each model
+            is parsed exactly once, and the strings are not retained, so they can be released once parsing is complete.
+            IndexedModel objects that have already been read (such as the parsed_models of another SBMLDiff) may be
+            given instead
         model_names : names of each model (used as headings for the columns in table)
         generate_dot : instance of the GenerateDot class
         align : Boolean indicating whether to try to match using MIRIAM annotations as well as reaction/species id
         cartoon : Boolean indicating whether to draw transcription as a SBOLv promoter/CSD glyph, and hide degredation
+        cache : ModelCache object, from which previously analysed models are read instead of being parsed again
+            (or None)
+        jobs : number of worker processes to use. The models are parsed in separate processes (see
+            read_models_in_parallel()), and their reactions, rules and compartments are compared in separate processes
+            (see diff_in_parallel())
+        samples : number of operating points at which each kinetic law is evaluated to determine arrow directions
+            numerically
+        sympy_timeout : if use_sympy is set, the maximum time (in seconds) to spend determining each arrow direction
+            symbolically, after which it is determined numerically instead (None or 0 for no limit)
+        sympy_memory : if use_sympy is set, the maximum memory (in MB) to use determining each arrow direction
+            symbolically (None or 0 for no limit)
+        stream : Boolean indicating whether to read each model only when it is compared, and release it before the next
+            is read, so that only one model is held in memory at a time. Only diff_models() and diff_abstract_models()
+            can be used in this mode, which cannot be combined with align or cartoon; the models are read in the calling
+            process (so jobs is ignored), and model_strings must be an iterable that can be read from only once.
+            The output contains the same lines as it would otherwise, but nodes and edges may be listed in a different
+            order (they are found model by model, rather than feature by feature across all the models)
 
         Returns
         -------
-        models : list of models (each a bs4.BeautifulSoup object produced by parsing an SBML model)
+        models : list of models (each an IndexedModel object produced by load_model())
 
         """
 
-        self.model_strings = model_strings
         self.model_names = model_names
         self.generate_dot = generate_dot
         self.align = align
@@ -36,92 +142,386 @@ class SBMLDiff:
         self.show_params = show_params
         self.hide_rules = hide_rules
         self.use_sympy = use_sympy
+        self.samples = samples
+        self.cache = cache
+        self.jobs = jobs
+
+        # the warnings given by get_pool_size()
+        self.pool_size_warnings = set()
+
+        if self.use_sympy:
+            set_symbolic_budget(sympy_timeout, sympy_memory)
 
         self.diff_object = DiffObject()
 
-        self.models = map(lambda x: BeautifulSoup(x, 'xml'), self.model_strings)
+        self.stream = stream
+        if self.stream:
+            if self.align or self.cartoon:
+                raise RuntimeError("Models cannot be aligned or drawn as cartoons when they are compared one at a time")
+
+            # the models are read by load_models(), and only the one being compared is kept
+            self.model_strings = model_strings
+            self.parsed_models = []
+            self.model_count = 0
+            self.loaded_model = None
+            self.streamed_timeouts = []
+
+        # every comparison shares these parsed models
+        elif jobs > 1:
+            self.parsed_models = self.read_models_in_parallel(model_strings)
+        else:
+            self.parsed_models = [read_model(m, self.cache, self.use_sympy, samples=self.samples) for m in model_strings]
+        self.models = self.parsed_models
+        self.models_prepared = False
+        if not self.stream:
+            self.model_count = len(self.models)
 
-        # Avoid need to search for reactions by id
-        self.reactions = []
-        for model in self.models:
-            mr = {}
-            reaction_list = model.select_one("listOfReactions")
-            if reaction_list:
-                for reaction in reaction_list.select("reaction"):
-                    reaction_id = reaction.attrs["id"]
-                    mr[reaction_id] = reaction
-            self.reactions.append(mr)
-
-        # avoid need to keep finding reactant compartments
-        self.species_compartment = []
-        self.initial_value = []
-        for model in self.models:
-            tmp = {}
-            tmp_concentrations = {}
+        if self.cartoon:
+            self.elided_list = []
+            self.elided_reactions = []
+            self.downstream_species = []
+            self.find_downstream_species()
+
+        self.modified_params = {}
+        self.modified_param_names = {}
+
+        # DiffRule and DiffEvent objects, indexed by rule or event, so that models compared separately (see
+        # load_models()) add to the same objects
+        self.rule_diffs = {}
+        self.algebraic_rule_diffs = {}
+        self.event_diffs = {}
+
+        # the SharedModels copy of the models read by the workers of diff_in_parallel(), while they are running
+        self.shared_models = None
+
+        # the partial results found by diff_in_parallel() that have not yet been merged, indexed by unit of work
+        self.partial_results = {}
+
+    def read_models_in_parallel(self, model_strings):
+        """
+        Parse models, inline their functions and analyse them (see analyse_model()), using a pool of worker processes,
+        one model per worker (see get_pool_size()), so that their math is not parsed again when they are compared. A
+        single model is parsed in this process, and analysed only if it is added to the cache; otherwise, its rate laws
+        are analysed when it is compared, by the workers of diff_in_parallel().
+
+        Parameters
+        ----------
+        model_strings : an iterable, in which each element is an SBML model as a string or file-like object
+
+        Returns
+        -------
+        list of IndexedModel objects, in the same order as model_strings
+
+        """
+        model_strings = list(model_strings)
+        if len(model_strings) < 2:
+            return [read_model(m, self.cache, self.use_sympy, samples=self.samples) for m in model_strings]
+
+        tasks = []
+        for model_string in model_strings:
+            # open files cannot be sent to a worker, so are passed by name (or, if they have none, by value)
+            path = None
+            if not isinstance(model_string, (basestring, IndexedModel)):
+                path = getattr(model_string, "name", None)
+                if path and os.path.isfile(path):
+                    model_string = None
+                else:
+                    path = None
+                    model_string = model_string.read()
+
+            tasks.append((path, model_string, self.cache, self.use_sympy, self.samples))
+
+        jobs = self.get_pool_size(len(tasks), "models")
+        if jobs < 2:
+            return [read_model(m, self.cache, self.use_sympy, samples=self.samples) for m in model_strings]
+
+        # the workers, and the processes in which they determine signs symbolically, inherit sympy once it is imported
+        if self.use_sympy:
+            load_sympy()
+        pool = Pool(jobs)
+        try:
+            models = pool.map(read_model_in_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        return models
+
+    def get_pool_size(self, tasks, task_description):
+        """
+        Return the number of worker processes to divide a number of tasks between: self.jobs, but no more than there
+        are tasks or processors (as more workers than processors only adds the cost of switching between them). If this
+        is fewer than self.jobs, a warning is given on stderr (once for each number of workers and reason).
+
+        Parameters
+        ----------
+        tasks : number of tasks
+        task_description : what the tasks are, for the warning (e.g. "models")
+
+        """
+        processors = cpu_count()
+        jobs = min(self.jobs, tasks, processors)
+        if jobs < self.jobs:
+            if jobs == processors == 1:
+                reason = "there is only 1 processor"
+            elif jobs == processors:
+                reason = "there are only %s processors" % processors
+            else:
+                reason = "there are only %s %s" % (tasks, task_description)
+
+            if jobs < 2:
+                warning = "Warning: using a single process rather than %s, as %s\n" % (self.jobs, reason)
+            else:
+                warning = "Warning: using %s worker processes rather than %s, as %s\n" % (jobs, self.jobs, reason)
+            if warning not in self.pool_size_warnings:
+                self.pool_size_warnings.add(warning)
+                sys.stderr.write(warning)
+        return jobs
+
+    def get_unanalysed_models(self):
+        """
+        Return (model number, model) pairs for the models being compared whose expressions have not all been analysed
+        (by analyse_model(), before they were cached) with the current settings.
+        """
+        settings = (bool(self.use_sympy), self.samples)
+        return [(model_num, model) for model_num, model in self.enumerate_models() if model.analysed_with != settings]
+
+    def diff_in_parallel(self, units):
+        """
+        Compare units of work between the models using a pool of self.jobs worker processes (but no more than there are
+        units or processors; see get_pool_size()), and keep the partial results in self.partial_results, to be merged
+        into the comparison (by diff_reaction(), diff_rule(), diff_compartment() and abstract_model()) in the same order
+        as if they had been found serially, so that the output is the same whatever the number of workers. The converted rate laws and
+        interaction signs found by the workers are recorded in the models (see store_expression_analysis()).
+
+        Each unit is a reaction, rule, compartment or reaction to be abstracted (see get_unit_diff()); the units are
+        divided into chunks that are sent to the workers. Units for which a worker returns no result are compared
+        serially instead.
+
+        The workers compare the units with the same methods as the serial comparison, but read the models from an
+        array-backed copy in shared memory (see SharedModels), built before they are forked, rather than from the lxml
+        trees. This is done only if some model has not already been analysed (see get_unanalysed_models()), as the
+        serial comparison of analysed models merely looks up the results, and never in streaming mode.
+
+        Parameters
+        ----------
+        units : list of tuples identifying units of work
+
+        """
+        global parallel_diff
+
+        self.partial_results = {}
+        if self.jobs < 2 or self.stream or not hasattr(os, "fork") or len(units) < 2:
+            return
+        if not self.get_unanalysed_models():
+            return
+
+        jobs = self.get_pool_size(len(units), "reactions, rules and compartments")
+        if jobs < 2:
+            return
+        chunk_size = max(1, len(units) // (jobs * 4))
+
+        # the workers inherit this object (and so the shared copy of the models) when they are forked
+        self.shared_models = SharedModels(self.models)
+        parallel_diff = self
+        if self.use_sympy:
+            load_sympy()
+        pool = Pool(jobs)
+        try:
+            results = pool.map(diff_unit_in_worker, units, chunk_size)
+        finally:
+            pool.close()
+            pool.join()
+            parallel_diff = None
+            self.shared_models = None
+
+        for unit, (result, analyses) in zip(units, results):
+            for model_num, analysis in analyses:
+                store_expression_analysis(self.models[model_num], analysis, self.use_sympy, self.samples)
+            if result is not None:
+                self.partial_results[unit] = result
+
+    def get_diff_units(self):
+        """
+        List the units of work for diff_in_parallel() when comparing the models: each reaction, each variable set by a
+        rule (unless self.hide_rules is set) and each compartment in any of them, in a fixed order.
+        """
+        units = set()
+        for model_num, model in self.enumerate_models():
+            for reaction_id in model.reactions_by_id:
+                units.add(("reaction", reaction_id))
+            if not self.hide_rules:
+                for variable in model.rules_by_variable:
+                    units.add(("rule", variable))
+            for compartment_id in model.compartments_by_id:
+                units.add(("compartment", compartment_id))
+        return sorted(units)
+
+    def get_model_views(self):
+        """
+        Return (model number, ModelView) pairs for the models being compared in the current pass, through which
+        get_unit_diff() reads them when called in this process.
+        """
+        return [(model_num, ModelView(model, self.use_sympy, self.samples))
+                for model_num, model in self.enumerate_models()]
+
+    def get_unit_diff(self, unit, views):
+        """
+        Compare a unit of work between models, without recording the result in the comparison: this is called either
+        by the method that merges the result into the comparison (diff_reaction(), diff_rule(), diff_compartment() or
+        abstract_model()), or by a worker of diff_in_parallel() (see SharedModels.diff_unit()).
+
+        Parameters
+        ----------
+        unit : a tuple ("reaction", reaction id), ("rule", variable), ("compartment", compartment id) or
+            ("abstract", reaction id)
+
+        views : list of (model number, view) pairs, in which each view is a model_view.ModelView (or, in a worker, a
+            shared_model.SharedModelView)
+
+        Returns
+        -------
+        the result of get_reaction_diff(), get_rule_diff(), get_compartment_diff() or get_abstract_interactions()
 
-            species_list = model.select_one("listOfSpecies")
-            if species_list:
-                for species in species_list.select("species"):
-                    species_id = species.attrs["id"]
-                    compartment = species.attrs["compartment"]
-                    tmp[species_id] = compartment
+        """
+        kind, unit_id = unit
+        if kind == "reaction":
+            return self.get_reaction_diff(unit_id, views)
+        elif kind == "rule":
+            return self.get_rule_diff(unit_id, views)
+        elif kind == "compartment":
+            return self.get_compartment_diff(unit_id, views)
+        return self.get_abstract_interactions(unit_id, views)
+
+    def get_symbolic_timeouts(self):
+        """
+        List the expressions whose arrow directions could not be determined symbolically within the time and memory
+        allowed, and so were determined numerically.
 
-                    if "initialConcentration" in species.attrs:
-                        tmp_concentrations[species_id] = species.attrs["initialConcentration"]
+        Returns
+        -------
+        list of (model name, description of expression) tuples
 
-            self.species_compartment.append(tmp)
-            self.initial_value.append(tmp_concentrations)
+        """
+        if self.stream:
+            return list(self.streamed_timeouts)
 
-        # get initial parameter values
-        self.initial_parameters = []
+        # the aligned copies of the models (see prepare_models()) record their own timeouts, as well as those of the
+        # parsed models
+        timeouts = []
         for model_num, model in enumerate(self.models):
-            for param in model.select("parameter"):
-                if "id" not in param.attrs.keys():
-                    continue
-                param_id = param.attrs["id"]
-                if "value" in param.attrs:
-                    self.initial_value[model_num][param_id] = param.attrs["value"]
+            for description in model.symbolic_timeouts:
+                timeouts.append((self.model_names[model_num], description))
+        return timeouts
 
-        # avoid need to search for reaction name
-        self.reaction_name = []
-        for model in self.models:
-            tmp = {}
-
-            reaction_list = model.select_one("listOfReactions")
-            if reaction_list:
-                for r in reaction_list.select("reaction"):
-                    reaction_id = r.attrs["id"]
-                    if "name" in r.attrs.keys() and r.attrs["name"]:
-                        tmp[reaction_id] = r.attrs["name"]
-                    else:
-                        tmp[reaction_id] = reaction_id
+    def load_models(self, check_supported=True):
+        """
+        Make the models available to enumerate_models(), for each pass of a comparison.
 
-            self.reaction_name.append(tmp)
+        Ordinarily, every model is prepared (see prepare_models()) and there is a single pass, in which all of the models
+        are compared. In streaming mode, there is a pass for each model: it is read, and its functions inlined, when its
+        pass begins, and it is released when the pass ends, so only one model is held at a time. The comparison must
+        therefore accumulate its results (e.g. in self.diff_object) over the passes.
 
-        if self.cartoon:
-            self.elided_list = []
-            self.elided_reactions = []
-            self.downstream_species = []
-            self.find_downstream_species()
+        Releasing a model also releases the parsed, converted and compiled forms of its math (see
+        math_ast.math_expressions), unless another model still being held contains the same expressions; only the
+        strings recorded in the comparison are kept.
 
-        self.modified_params = {}
+        Parameters
+        ----------
+        check_supported : Boolean indicating whether to call check_model_supported() for the models
+
+        Returns
+        -------
+        a generator, yielding the number of models read so far at the start of each pass
+
+        """
+        if not self.stream:
+            if check_supported:
+                self.check_model_supported()
+            self.prepare_models()
+            yield self.model_count
+            return
+
+        if self.model_strings is None:
+            raise RuntimeError("Models that are compared one at a time can only be compared once")
+        model_strings, self.model_strings = self.model_strings, None
+
+        for model_num, model_string in enumerate(model_strings):
+            self.loaded_model = (model_num, read_model(model_string, self.cache, self.use_sympy, samples=self.samples))
+            self.model_count = model_num + 1
+            if check_supported:
+                self.check_model_supported()
+            inline_all_functions(self.loaded_model[1])
+
+            yield self.model_count
+
+            for description in self.loaded_model[1].symbolic_timeouts:
+                self.streamed_timeouts.append((self.model_names[model_num], description))
+            self.loaded_model = None
+
+    def enumerate_models(self):
+        """
+        Return (model number, model) pairs for the models being compared in the current pass (see load_models()).
+        """
+        if self.stream:
+            if self.loaded_model is None:
+                return []
+            return [self.loaded_model]
+        return enumerate(self.models)
+
+    def get_model(self, model_num):
+        """
+        Return a model being compared in the current pass (see load_models()), by its number.
+        """
+        if self.stream:
+            if self.loaded_model is None or self.loaded_model[0] != model_num:
+                raise RuntimeError("Model %s is not loaded" % (model_num + 1))
+            return self.loaded_model[1]
+        return self.models[model_num]
 
     def check_model_supported(self):
         """
         Print an error message and quit if the file cannot be processed (because it contains user-defined functions, or is
         missing a list of species), rather than dumping a stack trace.
         """
-        for model in self.models:
+        for _, model in self.enumerate_models():
 
-            if model.select_one('listOfReactions') and not model.select_one('listOfSpecies'):
+            if "listOfReactions" in model.lists and "listOfSpecies" not in model.lists:
                 raise RuntimeError("Every model that includes a listOfReactions must include a listOfSpecies.")
 
-            if not model.select_one('sbml') or 'xmlns' not in model.select_one('sbml').attrs.keys():
+            if not model.namespace:
                 raise RuntimeError("Every file must be an sbml model")
 
-            if "level1" in model.select_one('sbml').attrs['xmlns']:
+            if "level1" in model.namespace:
                 raise RuntimeError("Every model must be in SBML level 2 or higher, since sbml-diff relies on id attributes")
 
+    def prepare_models(self):
+        """
+        Inline user-defined functions in each model and, if requested, align the models using MIRIAM annotations.
+        This is performed only once however many comparisons are made.
+
+        Alignment does not modify the parsed models (self.parsed_models): self.models is replaced by copies in which
+        species and reactions have been renamed, so the parsed models can still be reused for a comparison without
+        alignment.
+        """
+        if self.models_prepared or self.stream:
+            return
+        self.models_prepared = True
+
+        self.parsed_models = map(inline_all_functions, self.parsed_models)
+        self.models = self.parsed_models
+
+        if self.align:
+            id_maps = align_models(self.parsed_models)
+            self.models = [model.translate_ids(id_map) for model, id_map in zip(self.parsed_models, id_maps)]
+
+    def check_not_streaming(self):
+        """
+        Raise a RuntimeError if the models are compared one at a time, as tables require every model at once.
+        """
+        if self.stream:
+            raise RuntimeError("Tables cannot be produced when models are compared one at a time")
+
     def print_rate_law_table(self, output_format="simple"):
         """
         Print a table of kineticLaws, in which rows correspond to reactions and columns to models.
@@ -130,6 +530,8 @@ class SBMLDiff:
         ----------
         output_format : a table format supported by tabulate (e.g. simple, html)
         """
+        self.check_not_streaming()
+        self.prepare_models()
 
         # get list of all reactions in all models
         reactions = []
@@ -141,21 +543,25 @@ class SBMLDiff:
         rows = []
         for reaction_id in reactions:
             rates = [reaction_id]
+
+            # kineticLaws are compared using their canonical form, so that e.g. k * A * B and k * B * A are the same
+            keys = []
             for model_num, model in enumerate(self.models):
                 found_kinetic_law = False
-                r = model.select_one("listOfReactions").find(id=reaction_id)
-                if r:
-                    kinetic_law = r.select_one("kineticLaw")
-                    if kinetic_law:
-                        math_tag = kinetic_law.select_one("math")
-                        rates.append(convert_rate_law(math_tag))
+                r = model.reactions_by_id.get(reaction_id)
+                if r is not None:
+                    kinetic_law = r.find("kineticLaw")
+                    if kinetic_law is not None:
+                        math_tag = kinetic_law.find("math")
+                        rates.append(get_converted_rate_law(model, math_tag))
+                        keys.append(get_rate_law_key(math_tag, model))
                         found_kinetic_law = True
 
                 if not found_kinetic_law:
                     rates.append("-")
+                    keys.append(None)
 
-                r = rates[1:]
-                if r.count(r[0]) != len(r):
+                if keys.count(keys[0]) != len(keys):
                     self.generate_dot.differences_found = True
 
             rows.append(rates)
@@ -170,11 +576,10 @@ class SBMLDiff:
         ----------
         output_format : a table format supported by tabulate (e.g. simple, html)
         """
-
-        models = map(lambda x: BeautifulSoup(x, 'xml'), self.model_strings)
+        self.check_not_streaming()
 
         param_value = {}
-        for model_num, model in enumerate(models):
+        for model_num, model in enumerate(self.models):
             param_ids, param_values = get_params(model)
 
             for param_id in param_ids:
@@ -186,7 +591,7 @@ class SBMLDiff:
         rows = []
         for param_id in param_value.keys():
             row = [param_id]
-            for model_num, model in enumerate(models):
+            for model_num, model in enumerate(self.models):
                 if model_num in param_value[param_id].keys():
                     row.append(param_value[param_id][model_num])
                 else:
@@ -210,16 +615,13 @@ class SBMLDiff:
         event_status = {}
         event_objects = {}
 
-        for model_num, model in enumerate(self.models):
-            event_list = model.select_one("listOfEvents")
-            if not event_list:
-                continue
-
-            for event in event_list.select('event'):
+        for model_num, model in self.enumerate_models():
+            for event in model.events:
 
-                if 'id' not in event.attrs.keys():
-                    event.attrs["id"] = str(hash(event))
-                event_id = event.attrs["id"]
+                if 'id' not in event.attrib.keys():
+                    event.attrib["id"] = str(hash(event))
+                    model.events_by_id[event.attrib["id"]] = event
+                event_id = event.attrib["id"]
 
                 if event_id not in event_status.keys():
                     event_status[event_id] = []
@@ -232,49 +634,49 @@ class SBMLDiff:
 
     def diff_event_with_id(self, event_id, model_set):
 
-        diff_event = self.diff_object.add_event()
+        # in streaming mode, the event may already have been found in an earlier pass (see load_models())
+        diff_event = self.event_diffs.get(event_id)
+        if diff_event is None:
+            diff_event = self.diff_object.add_event()
+            self.event_diffs[event_id] = diff_event
+        previous_models = diff_event.event.get("model_set", 0)
 
         # process trigger statement
-        event_name = ""
+        event_name = diff_event.event.get("event_name", "")
 
         for model_num in model_set:
-            species_ids = self.species_compartment[model_num].keys()
-            event = self.models[model_num].select_one('#' + event_id)
+            model = self.get_model(model_num)
+            species_ids = model.species_by_id
+            event = model.events_by_id[event_id]
 
             # process model name
-            if not event_name and "name" in event.attrs.keys():
-                event_name = event.attrs["name"]
+            if not event_name and "name" in event.attrib.keys():
+                event_name = event.attrib["name"]
 
             # process trigger statements
-            trigger = event.select_one("trigger")
-            if trigger:
-                for ci in trigger.select("ci"):
+            trigger = event.find("trigger")
+            if trigger is not None:
+                for ci in trigger.iter("ci"):
                     entity = ci.text.strip()
                     if entity in species_ids:
                         diff_event.add_trigger_species(entity, event_id, model_num)
                     else:
                         diff_event.add_param(entity, event_id, model_num)
 
-                trigger_expr = trigger.select_one("math")
-                if not trigger_expr:
-                    trigger_expr = ""
-                trigger_expr = convert_rate_law(trigger_expr)
+                trigger_expr = trigger.find("math")
+                trigger_expr = get_converted_rate_law(model, trigger_expr)
                 diff_event.add_trigger(trigger_expr, model_num)
 
-            event_assignments = event.select("eventAssignment")
+            event_assignments = list(event.iter("eventAssignment"))
             if event_assignments:
                 for event in event_assignments:
-                    if isinstance(event, NavigableString):
-                        continue
 
                     # math
-                    math = event.select_one("math")
-                    if not math:
-                        math = ""
-                    converted_math = convert_rate_law(math)
+                    math = event.find("math")
+                    converted_math = get_converted_rate_law(model, math)
 
                     # arrow to species set
-                    variable_id = event.attrs["variable"]
+                    variable_id = event.attrib["variable"]
                     if variable_id in species_ids:
                         diff_event.add_set_species(variable_id, converted_math, model_num)
 
@@ -282,9 +684,10 @@ class SBMLDiff:
                         diff_event.add_set_species(variable_id, converted_math, model_num)
 
                     # arrow from species affecting expression
-                    for ci in math.select("ci"):
+                    for ci in math.iter("ci"):
                         species = ci.text.strip()
-                        arrow_direction = categorise_interaction(math.parent, species, self.initial_value[model_num], use_sympy=self.use_sympy)
+                        arrow_direction = get_interaction_sign(model, math.getparent(), species,
+                                                               use_sympy=self.use_sympy, samples=self.samples)
 
                         if species in species_ids:
                             diff_event.add_event_affect_value_arrow(variable_id, species, event_id, arrow_direction, model_num)
@@ -292,43 +695,35 @@ class SBMLDiff:
                             diff_event.add_assignment_param_arrow(variable_id, species, event_id, arrow_direction, model_num)
 
         # record event node
-        diff_event.set_event(event_id, event_name, model_set)
+        diff_event.set_event(event_id, event_name, to_mask(model_set) | previous_models)
 
     def diff_algebraic_rules(self):
         """
         Compare all algebraic rules between models.
         """
 
-        rule_diffs = {}
+        rule_diffs = self.algebraic_rule_diffs
 
-        for model_num, model in enumerate(self.models):
+        for model_num, model in self.enumerate_models():
 
-            rule_list = model.select_one("listOfRules")
-            if not rule_list:
-                continue
-
-            for rule in rule_list.select("algebraicRule"):
+            for rule in model.rules:
+                if rule.tag != "algebraicRule":
+                    continue
 
                 # find species occurring in this rule
-                species_ids = []
-                species_list = model.select_one("listOfSpecies")
                 species_in_rule = []
                 params_in_rule = []
 
-                if species_list:
-                    for s in species_list.select("species"):
-                        species_ids.append(s.attrs["id"])
-
-                for ci in rule.select("ci"):
-                    species_id = ci.string.strip()
-                    if species_id in species_ids:
+                for ci in rule.iter("ci"):
+                    species_id = ci.text.strip()
+                    if species_id in model.species_by_id:
                         species_in_rule.append(species_id)
                     else:
                         params_in_rule.append(species_id)
 
                 # Choose an id  to represent this rule
-                if "metaid" in rule.attrs.keys():
-                    rule_id = rule.attrs["metaid"]
+                if "metaid" in rule.attrib.keys():
+                    rule_id = rule.attrib["metaid"]
                 else:
                     rule_id = "assignmentRule" + "_".join(species_in_rule)
                 if rule_id not in rule_diffs.keys():
@@ -340,25 +735,22 @@ class SBMLDiff:
                 for param_id in params_in_rule:
                     rule_diffs[rule_id].add_parameter_rule(model_num, rule_id, param_id, 'none')
 
-                rate_law = rule.select_one("math")
-                if not rate_law:
-                    rate_law = ""
-                converted_rate_law = convert_rate_law(rate_law)
-                rule_diffs[rule_id].add_rate_law(model_num, converted_rate_law)
+                rate_law = rule.find("math")
+                rule_diffs[rule_id].add_rate_law(model_num, get_rate_law_key(rate_law, model))
 
     def diff_rules(self):
         """
         Compare all (rate or assignment) rules between models.
         """
         rule_targets = set()
-        for model_num, model in enumerate(self.models):
+        for model_num, model in self.enumerate_models():
             these_rule_targets = get_variables_set_by_rules(model)
 
             for rule_target in these_rule_targets:
-                species_list = model.select_one('listOfSpecies')
-                if not species_list or rule_target not in self.species_compartment[model_num].keys():
-                    if rule_target not in self.modified_params.keys():
+                if "listOfSpecies" not in model.lists or rule_target not in model.species_by_id:
+                    if rule_target not in self.modified_params:
                         self.modified_params[rule_target] = set()
+                        self.modified_param_names[rule_target] = get_param_name(model, rule_target)
                     self.modified_params[rule_target].add(model_num)
 
                 rule_targets.add(rule_target)
@@ -368,54 +760,78 @@ class SBMLDiff:
 
     def diff_rule(self, target_id):
         """
-        Compare a single rule between models.
+        Compare a single rule between models, merging the partial result found by diff_in_parallel() (or, if there is
+        none, by get_rule_diff()) into the comparison.
 
         Parameters
         ----------
         target_id : id of the species affected by this rule
         """
-        # if a reaction is shared, we need to consider whether its products, reactants and rate law are also shared
-
-        # 'modifiers' appear in the math expression of a rule that sets 'target'
-        # a rule has only one target, whereas reaction may have multiple products
-
         # Rules assigned to different compartments are considered to be distinct, event if they have the same targer
+        instances = self.partial_results.pop(("rule", target_id), None)
+        if instances is None:
+            instances = self.get_unit_diff(("rule", target_id), self.get_model_views())
 
-        diff_rules = {}
-        for model_num, model in enumerate(self.models):
-            _, compartment, rate_law = get_rule_details(model, target_id, self.species_compartment[model_num])
-
+        diff_rules = self.rule_diffs.setdefault(target_id, {})
+        for model_num, compartment, rate_law_key, entities, target_is_species in instances:
             self.diff_object.check_compartment_exists(compartment)
             if compartment not in diff_rules.keys():
                 diff_rules[compartment] = self.diff_object.compartments[compartment].add_rule(target_id)
 
-            if not rate_law:
-                rate_law = ""
+            diff_rules[compartment].add_rate_law(model_num, rate_law_key)
 
-            converted_rate_law = convert_rate_law(rate_law)
-            diff_rules[compartment].add_rate_law(model_num, converted_rate_law)
-
-            entities = rate_law.select("ci")
-            for entity in entities:
-                entity = entity.string.strip()
-                arrow_direction = categorise_interaction(rate_law.parent, entity, self.initial_value[model_num], use_sympy=self.use_sympy)
-
-                if entity in self.species_compartment[model_num].keys():
+            for entity, arrow_direction, is_species in entities:
+                if is_species:
                     diff_rules[compartment].add_modifier_arrow(model_num, target_id, entity, arrow_direction)
                 else:
                     diff_rules[compartment].add_parameter_rule(model_num, target_id, entity, arrow_direction)
 
             # targets
-            if self.show_params or (target_id in self.species_compartment[model_num].keys()):
+            if self.show_params or target_is_species:
                 diff_rules[compartment].add_target_arrow(model_num, target_id)
 
+    def get_rule_diff(self, target_id, views):
+        """
+        Find the details of the rule setting a variable in each model that has one, for diff_rule().
+
+        Parameters
+        ----------
+        target_id : id of the species affected by this rule
+
+        views : list of (model number, view) pairs (see get_unit_diff())
+
+        Returns
+        -------
+        list of (model number, compartment, canonical key of the rule's math, entities, whether the target is a species)
+        tuples, in which entities is a list of (id, arrow direction, whether it is a species) tuples for each identifier
+        in the math
+
+        """
+        # 'modifiers' appear in the math expression of a rule that sets 'target'
+        # a rule has only one target, whereas reaction may have multiple products
+        instances = []
+        for model_num, view in views:
+            rule = view.get_rule(target_id)
+
+            # only perform comparison between models in which this rule actually occurs
+            if rule is None:
+                continue
+
+            entities = []
+            for entity in rule.symbol_occurrences:
+                entities.append((entity, view.get_sign(rule, entity), view.is_species(entity)))
+
+            instances.append((model_num, rule.compartment, view.get_rate_law_key(rule), entities,
+                              view.is_species(target_id)))
+        return instances
+
     def diff_reactions(self):
         """
         Compare all reactions between models.
         """
 
         reaction_list = set()
-        for model_num, model in enumerate(self.models):
+        for model_num, model in self.enumerate_models():
             reactions = get_reactions(model)
             for reaction in reactions:
                 reaction_list.add(reaction)
@@ -425,28 +841,76 @@ class SBMLDiff:
 
     def diff_reaction(self, reaction_id):
         """
-        Compare a single reaction between models.
+        Compare a single reaction between models, merging the partial result found by diff_in_parallel() (or, if there
+        is none, by get_reaction_diff()) into the comparison.
 
         Parameters
         ----------
         reaction_id : id of the reaction
+        """
+        instances = self.partial_results.pop(("reaction", reaction_id), None)
+        if instances is None:
+            instances = self.get_unit_diff(("reaction", reaction_id), self.get_model_views())
+
+        for model_num, compartment, rate_law_key, reaction_name, converted_rate_law, is_fast, is_irreversible, \
+                is_transcription, reactant_arrows, product_arrows, parameter_arrows in instances:
+
+            self.diff_object.check_compartment_exists(compartment)
+            diff_compartment = self.diff_object.compartments[compartment]
+
+            # the canonical form of the kineticLaw is used to compare it between models
+            diff_reaction = diff_compartment.add_reaction(reaction_id, rate_law_key, reaction_name,
+                                                          converted_rate_law, is_fast, is_irreversible,
+                                                          is_transcription, model_num)
+
+            for reactant, stoich in reactant_arrows:
+                diff_reaction.add_reactant_arrow(reaction_id, reactant, stoich, model_num)
+
+            for product, stoich in product_arrows:
+                if is_transcription:
+                    diff_reaction.add_transcription_product_arrow(reaction_id, product, stoich, model_num)
+                else:
+                    diff_reaction.add_product_arrow(reaction_id, product, stoich, model_num)
+
+            for param, arrow_direction in parameter_arrows:
+                diff_reaction.add_parameter_arrow(reaction_id, param, arrow_direction, model_num)
+
+    def get_reaction_diff(self, reaction_id, views):
+        """
+        Find the details of a reaction in each model that should be drawn, for diff_reaction().
+
+        Parameters
+        ----------
+        reaction_id : id of the reaction
+
+        views : list of (model number, view) pairs (see get_unit_diff())
+
+        Returns
+        -------
+        list of (model number, compartment, canonical key of the kineticLaw, name, converted kineticLaw, is_fast,
+        is_irreversible, is_transcription, reactant arrows, product arrows, parameter arrows) tuples, in which the
+        reactant and product arrows are lists of (species id, stoichiometry) tuples, and the parameter arrows a list of
+        (parameter id, arrow direction) tuples
+
         """
 
         # We need to consider whether the reaction's products, reactants and rate law are shared
-        product_stoichiometries = {}
+        instances = []
         is_transcription = False
 
-        for model_num, model in enumerate(self.models):
-            if reaction_id not in self.reactions[model_num].keys():
+        for model_num, view in views:
+            reaction = view.get_reaction(reaction_id)
+            if reaction is None:
                 continue
-            reaction = self.reactions[model_num][reaction_id]
 
-            reactants, products, compartment, rate_law, rs, ps = get_reaction_details(model, reaction, self.species_compartment[model_num])
+            reactants, products, compartment, rate_law = reaction.reactants, reaction.products, reaction.compartment, \
+                reaction.rate_law
+            rs, ps = reaction.reactant_stoichiometries, reaction.product_stoichiometries
 
             # Skip processing reaction if it should not be drawn for this model
             show_reaction = True
             if self.cartoon:
-                if reaction in self.elided_reactions[model_num]:
+                if reaction_id in self.elided_reactions[model_num]:
                     show_reaction = False
 
                 # TODO: FIXME
@@ -462,59 +926,42 @@ class SBMLDiff:
             if not show_reaction:
                 continue
 
-            if self.cartoon and "sboTerm" in reaction.attrs.keys() and \
-                    reaction.attrs['sboTerm'] in ["SBO:0000183", "SBO:0000589"]:
+            if self.cartoon and reaction.sbo_term in ["SBO:0000183", "SBO:0000589"]:
                 is_transcription = True
 
             # only perform comparison between models in which this reaction actually occurs
-            if not reactants and not products and not compartment and not rate_law and not rs and not ps:
+            if not reactants and not products and not compartment and rate_law is None and not rs and not ps:
                 continue
 
-            is_fast = False
-            if "fast" in reaction.attrs.keys() and reaction.attrs["fast"] in ['1', 'true']:
-                is_fast = True
-            is_irreversible = False
-            if "reversible" in reaction.attrs.keys() and reaction.attrs["reversible"] in ['0', 'false']:
-                is_irreversible = True
-
-            converted_rate_law = convert_rate_law(rate_law)
-            reaction_name = self.reaction_name[model_num][reaction_id]
-
-            self.diff_object.check_compartment_exists(compartment)
-            diff_compartment = self.diff_object.compartments[compartment]
-            diff_reaction = diff_compartment.add_reaction(reaction_id, rate_law, reaction_name,
-                                                          converted_rate_law, is_fast, is_irreversible,
-                                                          is_transcription, model_num)
-
             # reactant arrows
+            reactant_arrows = []
             for ind, stoich in enumerate(rs):
-                diff_reaction.add_reactant_arrow(reaction_id, reactants[ind], stoich, model_num)
+                reactant_arrows.append((reactants[ind], stoich))
 
             # product arrows
+            product_arrows = []
             for ind, stoich in enumerate(ps):
 
                 # if producing something that's been elided, adjust arrows to point ot downstream species
                 product = products[ind]
                 if self.cartoon and product in self.elided_list[model_num]:
                     product = self.downstream_species[model_num][product]
-
-                if is_transcription:
-                    diff_reaction.add_transcription_product_arrow(reaction_id, product, stoich, model_num)
-                else:
-                    diff_reaction.add_product_arrow(reaction_id, product, stoich, model_num)
+                product_arrows.append((product, stoich))
 
             # parameter arrows
-            if rate_law:
-                entities = rate_law.select("ci")
-                for entity in entities:
-                    param = entity.string.strip()
+            parameter_arrows = []
+            for param in reaction.symbol_occurrences:
 
-                    # check a param rather than species
-                    if param in self.species_compartment[model_num].keys():
-                        continue
+                # check a param rather than species
+                if view.is_species(param):
+                    continue
+
+                parameter_arrows.append((param, view.get_sign(reaction, param)))
 
-                    arrow_direction = categorise_interaction(rate_law.parent, param, self.initial_value[model_num], use_sympy=self.use_sympy)
-                    diff_reaction.add_parameter_arrow(reaction_id, param, arrow_direction, model_num)
+            instances.append((model_num, compartment, view.get_rate_law_key(reaction), reaction.name,
+                              view.get_converted_law(reaction), reaction.is_fast, reaction.is_irreversible,
+                              is_transcription, reactant_arrows, product_arrows, parameter_arrows))
+        return instances
 
     def find_downstream_species(self):
         """
@@ -537,39 +984,43 @@ class SBMLDiff:
             # first, form a list of species that cannot safely be elided, because they are a reactant or modifier in a
             # reaction other than degredation or translation
             non_intermediates = []
-            for reaction in model.select('reaction'):
+            for reaction in model.reactions:
 
                 # skip degredation or translation reactions
-                if "sboTerm" in reaction.attrs.keys() and reaction.attrs["sboTerm"] in ["SBO:0000184", "SBO:0000179"]:
+                if "sboTerm" in reaction.attrib.keys() and reaction.attrib["sboTerm"] in ["SBO:0000184", "SBO:0000179"]:
                     continue
 
-                reactant_list = reaction.select_one("listOfReactants")
-                if reactant_list:
-                    for reactant in reactant_list.select("speciesReference"):
-                        non_intermediates.append(reactant.attrs["species"])
+                reactant_list = reaction.find("listOfReactants")
+                if reactant_list is not None:
+                    for reactant in reactant_list.iter("speciesReference"):
+                        non_intermediates.append(reactant.attrib["species"])
 
-                modifier_list = reaction.select_one("listOfModifiers")
-                if modifier_list:
-                    for r in modifier_list.select("modifierSpeciesReference"):
-                        non_intermediates.append(r["species"])
+                modifier_list = reaction.find("listOfModifiers")
+                if modifier_list is not None:
+                    for r in modifier_list.iter("modifierSpeciesReference"):
+                        non_intermediates.append(r.attrib["species"])
 
             # Now loop through reactions, identifying those that should be elided
-            for reaction in model.select('reaction'):
+            for reaction in model.reactions:
 
-                if "sboTerm" not in reaction.attrs.keys() or reaction.attrs["sboTerm"] != "SBO:0000184":
+                if "sboTerm" not in reaction.attrib.keys() or reaction.attrib["sboTerm"] != "SBO:0000184":
                     continue
 
                 # if reaction has different kineticLaw in different models, don't elide it
                 rate_laws = ""
                 for m in self.models:
-                    r = m.select_one("listOfReactions").find(id=reaction["id"])
-                    if not r:
+                    r = m.reactions_by_id.get(reaction.attrib["id"])
+                    if r is None:
                         continue
 
-                    rate_law = r.select_one("kineticLaw").select_one("math")
-                    if rate_law and not rate_laws:
+                    rate_law = r.find("kineticLaw").find("math")
+                    if rate_law is None:
+                        continue
+                    rate_law = get_math_source(m, rate_law)
+
+                    if not rate_laws:
                         rate_laws = rate_law
-                    elif rate_laws and rate_law and rate_laws != rate_law:
+                    elif rate_laws != rate_law:
                         rate_laws = "different"
                         break
 
@@ -579,15 +1030,15 @@ class SBMLDiff:
                 reactants_and_modifier_species = []
 
                 # Check exactly one modifier/reactant
-                modifier_list = reaction.select_one("listOfModifiers")
-                if modifier_list:
-                    for r in modifier_list.select("modifierSpeciesReference"):
-                        reactants_and_modifier_species.append(r["species"])
+                modifier_list = reaction.find("listOfModifiers")
+                if modifier_list is not None:
+                    for r in modifier_list.iter("modifierSpeciesReference"):
+                        reactants_and_modifier_species.append(r.attrib["species"])
 
-                reactant_list = reaction.select_one("listOfReactants")
-                if reactant_list:
-                    for r in reactant_list.select("speciesReference"):
-                        reactants_and_modifier_species.append(r["species"])
+                reactant_list = reaction.find("listOfReactants")
+                if reactant_list is not None:
+                    for r in reactant_list.iter("speciesReference"):
+                        reactants_and_modifier_species.append(r.attrib["species"])
 
                 if len(reactants_and_modifier_species) != 1:
                     continue
@@ -599,10 +1050,10 @@ class SBMLDiff:
 
                 # check exactly one product (other than reactant, in case reaction is modelled as mRNA -> mRNA + protein)
                 product_species = []
-                product_list = reaction.select_one("listOfProducts")
-                if product_list:
-                    for p in product_list.select("speciesReference"):
-                        product_id = p["species"]
+                product_list = reaction.find("listOfProducts")
+                if product_list is not None:
+                    for p in product_list.iter("speciesReference"):
+                        product_id = p.attrib["species"]
                         if product_id != species_to_elide:
                             product_species.append(product_id)
 
@@ -610,75 +1061,99 @@ class SBMLDiff:
                     continue
 
                 self.elided_list[model_num].append(species_to_elide)
-                self.elided_reactions[model_num].append(reaction)
+                self.elided_reactions[model_num].append(reaction.attrib["id"])
                 self.downstream_species[model_num][species_to_elide] = product_species[0]
 
     def diff_compartment(self, compartment_id):
         """
-        Print DOT output comparing a single compartment between models
+        Compare a single compartment between models, merging the partial result found by diff_in_parallel() (or, if
+        there is none, by get_compartment_diff()) into the comparison.
 
         Parameters
         ----------
         compartment_id : the id of a compartment
         """
+        result = self.partial_results.pop(("compartment", compartment_id), None)
+        if result is None:
+            result = self.get_unit_diff(("compartment", compartment_id), self.get_model_views())
+        species_list, arrows = result
 
         diff_compartment = self.diff_object.check_compartment_exists(compartment_id)
 
-        # Process all species
-        for model_num, model in enumerate(self.models):
-            for species in get_species(model, compartment_id):
+        for model_num, species, is_boundary, species_name, elided in species_list:
+            diff_compartment.add_species(species, is_boundary, species_name, elided, model_num)
+
+        for model_num, arrow_source, arrow_target, arrow_direction in arrows:
+            diff_compartment.add_regulatory_arrow(arrow_source, arrow_target, arrow_direction, model_num)
+
+    def get_compartment_diff(self, compartment_id, views):
+        """
+        Find the species in a compartment of each model, and the regulatory interactions between them and the
+        reactions, for diff_compartment().
+
+        Parameters
+        ----------
+        compartment_id : the id of a compartment
+
+        views : list of (model number, view) pairs (see get_unit_diff())
+
+        Returns
+        -------
+        species : list of (model number, species id, boundaryCondition, name, whether it is elided) tuples
+
+        arrows : list of (model number, species id, reaction id, arrow direction) tuples
 
-                s = model.select_one("listOfSpecies").find(id=species)
-                is_boundary = ""
-                if "boundaryCondition" in s.attrs.keys():
-                    is_boundary = s.attrs["boundaryCondition"]
+        """
+        # Process all species
+        species_list = []
+        for model_num, view in views:
+            for species in view.get_species(compartment_id):
 
-                species_name = get_species_name(model, species)
+                is_boundary = view.get_boundary_condition(species)
+                species_name = view.get_species_name(species)
 
                 elided = False
                 if self.cartoon and species in self.elided_list[model_num]:
                     elided = True
 
-                diff_compartment.add_species(species, is_boundary, species_name, elided, model_num)
+                species_list.append((model_num, species, is_boundary, species_name, elided))
 
         # Process regulatory interactions
-        for model_num, model in enumerate(self.models):
+        arrows = []
+        for model_num, view in views:
+            elided_reactions = ()
             if self.cartoon:
-                arrows = get_regulatory_arrow(model, compartment_id, self.reactions[model_num], self.species_compartment[model_num], self.initial_value[model_num], elided_reactions=self.elided_reactions[model_num], use_sympy=self.use_sympy)
-            else:
-                arrows = get_regulatory_arrow(model, compartment_id, self.reactions[model_num], self.species_compartment[model_num], self.initial_value[model_num], use_sympy=self.use_sympy)
+                elided_reactions = self.elided_reactions[model_num]
 
-            for arrow in arrows:
-                diff_compartment.add_regulatory_arrow(arrow[0], arrow[1], arrow[2], model_num)
+            for arrow in get_regulatory_arrows(view, compartment_id, elided_reactions):
+                arrows.append((model_num, arrow[0], arrow[1], arrow[2]))
+
+        return species_list, arrows
 
     def diff_models(self):
         """
         Print DOT output comparing SBML models
         """
 
-        self.check_model_supported()
-        self.models = map(lambda x: inline_all_functions(x), self.models)
-
-        if self.align:
-            align_models(self.models)
+        for _ in self.load_models():
+            self.diff_in_parallel(self.get_diff_units())
+            self.diff_reactions()
 
-        self.diff_reactions()
+            if not self.hide_rules:
+                self.diff_rules()
+                self.diff_algebraic_rules()
 
-        if not self.hide_rules:
-            self.diff_rules()
-            self.diff_algebraic_rules()
+            compartment_ids = set()
+            for model_num, model in self.enumerate_models():
+                compartment_ids.update(model.compartments_by_id.keys())
 
-        compartment_ids = set()
-        for model_num, model in enumerate(self.models):
-            for compartment in model.select('compartment'):
-                if "id" in compartment.attrs.keys():
-                    compartment_ids.add(compartment.attrs["id"])
+            self.diff_object.check_compartment_exists("NONE") # Is this necessary?
+            for compartment_id in compartment_ids:
+                self.diff_compartment(compartment_id)
 
-        self.diff_object.check_compartment_exists("NONE") # Is this necessary?
-        for compartment_id in compartment_ids:
-            self.diff_compartment(compartment_id)
+            self.diff_events()
+            self.partial_results = {}
 
-        self.diff_events()
         if self.show_params:
             self.draw_modified_params()
 
@@ -693,66 +1168,63 @@ class SBMLDiff:
 
         Parameters
         ----------
-        model : bs4.BeautifulSoup object produced by parsing an SBML model
+        model : SBMLModel object produced by load_model()
 
         model_num : index of the model being abstracted
 
         Returns
         -------
-        interactions : a 2D list, in which entries interactions[modifier][product] indicate the effect of the species with
-            id modifier on the species with id product - one of "increase-degredation", "decrease-degredation",
-            "increase-production", or "decrease-production"
+        interactions : a sparse 2D dict, in which entries interactions[modifier][product] are sets indicating the effect of
+            the species with id modifier on the species with id product - one of "increase-degredation",
+            "decrease-degredation", "increase-production", or "decrease-production". Only pairs of species that
+            interact are present.
 
         species : id of each species in the model
         """
 
+        view = ModelView(model, self.use_sympy, self.samples)
+
         # Get list of species
-        species = set()
-        for compartment in model.select('compartment'):
-            compartment_id = compartment.attrs["id"]
-            species = species.union(get_species(model, compartment_id))
+        species = view.get_declared_species()
 
         interactions = {}
-        for modifier in species:
-            interactions[modifier] = {}
-            for target in species:
-                interactions[modifier][target] = set()
 
         reactions = get_reactions(model)
         for reaction_id in reactions:
-            reaction = self.reactions[model_num][reaction_id]
-            reactant_list, product_list, compartment, rate_law, _, _ = get_reaction_details(model, reaction, self.species_compartment[model_num])
-
-            # Identify all species that appear in kineticLaw
-            modifiers = []
-            for ci in rate_law.findAll("ci"):
-                name = ci.text.strip()
-                if name in species:
-                    modifiers.append(name)
-            modifiers = set(modifiers)
-
-            for modifier in modifiers:
-                for reactant in reactant_list:
-
-                    # Any species increases the rate of its own degredation, so ignore this
-                    if reactant == modifier:
-                        continue
+            # use the interactions found by diff_in_parallel(), if there are any
+            results = self.partial_results.get(("abstract", reaction_id))
+            if results is None:
+                results = self.get_unit_diff(("abstract", reaction_id), [(model_num, view)])
+            reaction_interactions = results[model_num]
 
-                    effect = categorise_interaction(rate_law.parent, modifier, self.initial_value[model_num], use_sympy=self.use_sympy)
-                    if effect == "monotonic_increasing":
-                        interactions[modifier][reactant].add("increase-degredation")
-                    elif effect == "monotonic_decreasing":
-                        interactions[modifier][reactant].add("decrease-degredation")
-
-                for product in product_list:
-                    effect = categorise_interaction(rate_law.parent, modifier, self.initial_value[model_num], use_sympy=self.use_sympy)
-                    if effect == "monotonic_increasing":
-                        interactions[modifier][product].add("increase-production")
-                    elif effect == "monotonic_decreasing":
-                        interactions[modifier][product].add("decrease-production")
+            for modifier, species_id, effect in reaction_interactions:
+                interactions.setdefault(modifier, {}).setdefault(species_id, set()).add(effect)
 
         return interactions, species
 
+    def get_abstract_interactions(self, reaction_id, views):
+        """
+        Find the interactions between species due to a single reaction in each model that contains it, for
+        abstract_model() (see find_abstract_interactions()).
+
+        Parameters
+        ----------
+        reaction_id : id of the reaction
+
+        views : list of (model number, view) pairs (see get_unit_diff())
+
+        Returns
+        -------
+        dict giving a list of (modifier, species affected, effect type) tuples for each model number
+
+        """
+        interactions = {}
+        for model_num, view in views:
+            reaction = view.get_reaction(reaction_id)
+            if reaction is not None:
+                interactions[model_num] = find_abstract_interactions(view, reaction, view.get_declared_species())
+        return interactions
+
     # TODO: compartments!
     def diff_abstract_models(self, ignored_species, elided_species):
         """
@@ -769,37 +1241,43 @@ class SBMLDiff:
         if not elided_species:
             elided_species = []
 
-        if self.align:
-            align_models(self.models)
-
         effect_types = ["increase-degredation", "decrease-degredation", "increase-production", "decrease-production"]
 
         # Construct abstracted version of each model
-        abstracted_model = [] * len(self.models)
+        abstracted_model = []
         species_list = set()
         models_containing_species = {}
+        species_names = {}
         is_boundary_species = {}
 
-        for model_num, model in enumerate(self.models):
-            abstract, species = self.abstract_model(model, model_num)
+        for _ in self.load_models(check_supported=False):
+            units = set()
+            for model_num, model in self.enumerate_models():
+                units.update(("abstract", reaction_id) for reaction_id in model.reactions_by_id)
+            self.diff_in_parallel(sorted(units))
 
-            abstracted_model.append(abstract)
-            species_list = species_list.union(species)
+            for model_num, model in self.enumerate_models():
+                abstract, species = self.abstract_model(model, model_num)
 
-            for s in species:
-                if s not in models_containing_species.keys():
-                    models_containing_species[s] = set()
-                models_containing_species[s].add(model_num)
+                abstracted_model.append(abstract)
+                species_list = species_list.union(species)
 
-                species_object = model.select_one("listOfSpecies").find(id=s)
-                is_boundary = ""
-                if "boundaryCondition" in species_object.attrs.keys():
-                    is_boundary = species_object.attrs["boundaryCondition"]
+                for s in species:
+                    if s not in models_containing_species:
+                        models_containing_species[s] = set()
+                        species_names[s] = get_species_name(model, s)
+                    models_containing_species[s].add(model_num)
 
-                if s not in is_boundary_species.keys():
-                    is_boundary_species[s] = is_boundary
-                elif is_boundary_species[s] != is_boundary:
-                    is_boundary_species[s] = '?'
+                    species_object = model.species_by_id[s]
+                    is_boundary = ""
+                    if "boundaryCondition" in species_object.attrib.keys():
+                        is_boundary = species_object.attrib["boundaryCondition"]
+
+                    if s not in is_boundary_species.keys():
+                        is_boundary_species[s] = is_boundary
+                    elif is_boundary_species[s] != is_boundary:
+                        is_boundary_species[s] = '?'
+            self.partial_results = {}
 
         species_list = species_list.difference(ignored_species)
         retained_species = species_list.difference(elided_species)
@@ -807,39 +1285,38 @@ class SBMLDiff:
         self.generate_dot.print_header()
 
         for s in retained_species:
-            model_num = list(models_containing_species[s])[0]
-            species_name = get_species_name(self.models[model_num], s)
-            self.generate_dot.print_species_node(models_containing_species[s], is_boundary_species[s], s, species_name)
+            self.generate_dot.print_species_node(models_containing_species[s], is_boundary_species[s], s, species_names[s])
 
-        # Construct interactions[modifier][species][type] = set of model_numbers
+        # Construct interactions[modifier][species][type] = set of model_numbers, for only those interactions that occur
         interactions = {}
-        for s1 in species_list:
-            interactions[s1] = {}
-            for s2 in species_list:
-                interactions[s1][s2] = {}
-                for effect in effect_types:
-                    interactions[s1][s2][effect] = set()
-
-        for model_num, model in enumerate(self.models):
-            for modifier in species_list:
-                if model_num not in models_containing_species[modifier]:
+        for model_num, abstract in enumerate(abstracted_model):
+            for modifier in abstract:
+                if modifier not in species_list:
                     continue
 
-                for species in species_list:
-                    if model_num not in models_containing_species[species]:
+                for species in abstract[modifier]:
+                    if species not in species_list:
                         continue
 
-                    effects = abstracted_model[model_num][modifier][species]
-                    for effect_type in effects:
-                        interactions[modifier][species][effect_type].add(model_num)
+                    effects = interactions.setdefault(modifier, {}).setdefault(species, {})
+                    for effect_type in abstract[modifier][species]:
+                        effects.setdefault(effect_type, set()).add(model_num)
 
         if elided_species:
             interactions = self.elide(species_list, effect_types, interactions, elided_species)
 
+        # draw arrows in the order in which the retained species are listed
+        species_order = {}
+        for position, species in enumerate(retained_species):
+            species_order[species] = position
+
         for modifier in retained_species:
-            for species in retained_species:
+            targets = [species for species in interactions.get(modifier, {}) if species in species_order]
+            targets.sort(key=species_order.get)
+
+            for species in targets:
                 for effect_type in effect_types:
-                    model_list = interactions[modifier][species][effect_type]
+                    model_list = interactions[modifier][species].get(effect_type, set())
                     self.generate_dot.print_abstracted_arrow(model_list, modifier, species, effect_type)
 
         self.generate_dot.print_footer()
@@ -848,12 +1325,13 @@ class SBMLDiff:
         """
         Removes certain species from a model, transfering interactions that target them onto the species that they produce.
         Intended for case of an intermediate that causes production of a downstream species (e.g. mRNA, which causes
-        production of a protein)
+        production of a protein). If an elided species produces another elided species, interactions are transferred
+        along the chain to the first species that is retained.
 
         Parameters
         ----------
         interactions : interactions[modifier][target][effect_type] is set of model numbers for which species with id
-                        modifier has effect effect_type on species with id target
+                        modifier has effect effect_type on species with id target (present only if non-empty)
         elided_species : list containing the ide of each species to elide
         species_list : list containing id of every species
         effect_types : list of the possible effect types
@@ -863,41 +1341,59 @@ class SBMLDiff:
          a modified interactions structure
         """
         elided_species = set(elided_species).intersection(species_list)
-        for model_num, model in enumerate(self.models):
 
-            # For each elided species,
+        # position of each species in species_list: if an elided species produces several species, the last is used
+        species_order = {}
+        for position, species in enumerate(species_list):
+            species_order[species] = position
+
+        # reverse-adjacency index: incoming[target][regulator] is interactions[regulator][target]
+        incoming = {}
+        for regulator in interactions:
+            for target in interactions[regulator]:
+                incoming.setdefault(target, {})[regulator] = interactions[regulator][target]
+
+        for model_num in range(self.model_count):
+
+            # find the 'downstream' species of each elided species (eg. the protein produced from mRNA)
+            downstream = {}
+            for s in elided_species:
+                products = [s2 for s2, effects in interactions.get(s, {}).items()
+                            if model_num in effects.get("increase-production", set())]
+                if products:
+                    downstream[s] = max(products, key=species_order.get)
+
             for s in elided_species:
 
-                # find the 'downstream' species (eg. the protein produced from mRNA)
-                downstream = False
-                for s2 in species_list:
-                    if model_num in interactions[s][s2]["increase-production"]:
-                        downstream = s2
+                # follow chains of elided species (e.g. mRNA -> pre-protein -> protein) to a retained species
+                target = downstream.get(s)
+                visited = set([s])
+                while target in elided_species and target not in visited:
+                    visited.add(target)
+                    target = downstream.get(target)
 
-                if not downstream:
+                if target is None or target in visited:
                     continue
 
                 # Transfer interactions targeting the elided species to the downstream species
-                for regulator in species_list:
+                for regulator, effects in incoming.get(s, {}).items():
                     for effect_type in effect_types:
-                        if model_num in interactions[regulator][s][effect_type]:
-                            interactions[regulator][downstream][effect_type].add(model_num)
+                        if model_num in effects.get(effect_type, set()):
+                            target_effects = interactions[regulator].setdefault(target, {})
+                            target_effects.setdefault(effect_type, set()).add(model_num)
 
         # Then remove the elided species
         for s in elided_species:
-            interactions.pop(s)
+            interactions.pop(s, None)
 
-            for s2 in species_list:
-                if s2 in interactions.keys():
-                    interactions[s2].pop(s)
+            for regulator in incoming.get(s, {}):
+                if regulator in interactions:
+                    interactions[regulator].pop(s, None)
 
         return interactions
 
     def draw_modified_params(self):
         for param_id in self.modified_params.keys():
             model_set = list(self.modified_params[param_id])
-            name = param_id
-            param = self.models[model_set[0]].find(id=param_id)
-            if "name" in param.attrs.keys():
-                name = param.attrs["name"]
+            name = self.modified_param_names[param_id]
             self.diff_object.add_param_node(param_id, name, model_set)
@@ -0,0 +1,580 @@
+import mmap
+import numpy
+from accessor_functions import get_reaction_details, get_model_expression, get_symbol_occurrences
+from effect_direction import categorise_expression, DEFAULT_SAMPLES, SIGN_ERRORS
+from rate_laws import convert_rate_law
+from math_ast import MathExpression, make_node, intern_name
+from model_view import ReactionDetails, RuleDetails
+
+# The arrays of a SharedModels object, and the type of each. Arrays whose names end in "_ptr" are CSR-style index
+# arrays, with one more entry than the rows they index: the entries for row i are at [ptr[i], ptr[i + 1]). Entries that
+# refer to strings are indexes into the string table (-1 for None).
+SHARED_ARRAYS = [
+    # the string table: string i is string_data[string_offsets[i]:string_offsets[i + 1]], encoded as UTF-8
+    ("string_offsets", numpy.int64), ("string_data", numpy.uint8),
+
+    # for each model, its rows in the tables of compartments, species, reactions, rules and initial values
+    ("model_compartment_ptr", numpy.int64), ("model_species_ptr", numpy.int64), ("model_reaction_ptr", numpy.int64),
+    ("model_rule_ptr", numpy.int64), ("model_value_ptr", numpy.int64),
+
+    # the ids of the compartments declared by each model
+    ("compartment_id", numpy.int64),
+
+    # species, in document order: id, compartment, name (or id, if it has none) and boundaryCondition ("" if not set)
+    ("species_id", numpy.int64), ("species_compartment", numpy.int64), ("species_name", numpy.int64),
+    ("species_boundary", numpy.int64),
+
+    # reactions, in the order of model.reactions_by_id: id, name (or id), compartment (as found by
+    # get_reaction_details()), flags (REACTION_FAST, REACTION_IRREVERSIBLE), sboTerm, the row of the rate law in the
+    # table of laws (-1 if there is none), and the reactants and products (each a species id and stoichiometry),
+    # indexed by reactant_ptr and product_ptr
+    ("reaction_id", numpy.int64), ("reaction_name", numpy.int64), ("reaction_compartment", numpy.int64),
+    ("reaction_flags", numpy.int8), ("reaction_sbo_term", numpy.int64), ("reaction_law", numpy.int64),
+    ("reactant_ptr", numpy.int64), ("reactant_species", numpy.int64), ("reactant_stoich", numpy.int64),
+    ("product_ptr", numpy.int64), ("product_species", numpy.int64), ("product_stoich", numpy.int64),
+
+    # rules that set a variable (the first for each variable, as in model.rules_by_variable): tag, variable, and the
+    # row of their math in the table of laws (-1 if there is none)
+    ("rule_tag", numpy.int64), ("rule_variable", numpy.int64), ("rule_law", numpy.int64),
+
+    # initial values of species and parameters
+    ("value_name", numpy.int64), ("value_string", numpy.int64),
+
+    # laws, one for each distinct serialised math element in any of the models: the serialised math (which identifies
+    # the law in the caches of the models, and is what the symbolic worker receives; see effect_direction), the row of
+    # the root of its tree in the table of nodes, whether it contains a piecewise element, and the id in each of its ci
+    # elements (see get_symbol_occurrences()), indexed by law_symbol_ptr
+    ("law_source", numpy.int64), ("law_root", numpy.int64), ("law_piecewise", numpy.int8),
+    ("law_symbol_ptr", numpy.int64), ("law_symbol", numpy.int64),
+
+    # the MathNode trees of the laws, one row for each distinct node (so subexpressions shared between laws are stored
+    # once); every node comes after its arguments. For apply nodes, the arguments are rows of this table; for cn and
+    # unsupported nodes, they are strings (see math_ast.MathNode)
+    ("node_tag", numpy.int64), ("node_value", numpy.int64), ("node_arg_ptr", numpy.int64), ("node_arg", numpy.int64)]
+
+# Bits of reaction_flags
+REACTION_FAST = 1
+REACTION_IRREVERSIBLE = 2
+
+
+class SharedModels:
+    """
+    A compact, array-backed copy of the models being compared, holding everything that the workers of
+    SBMLDiff.diff_in_parallel() read to compare reactions, rules and compartments (through a SharedModelView of each
+    model): tables of compartments, species, reactions (with CSR-style lists of reactants and products and their
+    stoichiometries), rules and initial values, and the rate laws as hash-consed MathNode trees (see math_ast), stored
+    as a table of nodes.
+
+    Every array is a NumPy view of a single block of anonymous shared memory, so that processes forked once it has been
+    built read it without copying it, and without touching the lxml trees or Python objects of the original models.
+    Each process rebuilds the MathNode trees it needs from the table of nodes (see get_expression()), without parsing
+    any XML.
+
+    Building the copy walks each rate law once in this process, to turn it into MathNode trees (see
+    math_ast.parse_math()), as these are what the table of nodes holds. Everything else is left to the workers:
+    computing the canonical keys of the laws, converting them, and determining the signs of their interactions.
+    """
+
+    def __init__(self, models):
+        """
+
+        Parameters
+        ----------
+        models : list of IndexedModel objects, in which functions have been inlined
+
+        """
+        data = {}
+        for name, _ in SHARED_ARRAYS:
+            data[name] = []
+
+        strings = {}
+        string_parts = []
+
+        def add_string(value):
+            if value is None:
+                return -1
+            if value not in strings:
+                if isinstance(value, unicode):
+                    encoded = value.encode("utf-8")
+                else:
+                    encoded = value
+                strings[value] = len(string_parts)
+                string_parts.append(encoded)
+            return strings[value]
+
+        laws = {}
+        node_rows = {}
+
+        def add_node(tree):
+            # each node is added after its arguments, without recursion
+            stack = [tree]
+            while stack:
+                node = stack[-1]
+                if node in node_rows:
+                    stack.pop()
+                    continue
+
+                if node.tag == "apply":
+                    missing = [arg for arg in node.args if arg not in node_rows]
+                    if missing:
+                        stack.extend(missing)
+                        continue
+                    args = [node_rows[arg] for arg in node.args]
+                else:
+                    args = [add_string(arg) for arg in node.args]
+
+                node_rows[node] = len(data["node_tag"])
+                data["node_tag"].append(add_string(node.tag))
+                data["node_value"].append(add_string(node.value))
+                data["node_arg_ptr"].append(len(data["node_arg"]))
+                data["node_arg"].extend(args)
+                stack.pop()
+            return node_rows[tree]
+
+        def add_law(model, math):
+            if math is None:
+                return -1
+            source, expression = get_model_expression(model, math)
+            if source not in laws:
+                laws[source] = len(data["law_source"])
+                data["law_source"].append(add_string(source))
+                data["law_root"].append(add_node(expression.tree))
+                data["law_piecewise"].append(int(expression.piecewise))
+                data["law_symbol_ptr"].append(len(data["law_symbol"]))
+                data["law_symbol"].extend(add_string(symbol) for symbol in get_symbol_occurrences(math))
+            return laws[source]
+
+        for model in models:
+            data["model_compartment_ptr"].append(len(data["compartment_id"]))
+            for compartment_id in model.compartments_by_id:
+                data["compartment_id"].append(add_string(compartment_id))
+
+            data["model_species_ptr"].append(len(data["species_id"]))
+            for species in model.species:
+                data["species_id"].append(add_string(species.attrib["id"]))
+                data["species_compartment"].append(add_string(species.attrib["compartment"]))
+                data["species_name"].append(add_string(species.attrib.get("name") or species.attrib["id"]))
+                data["species_boundary"].append(add_string(species.attrib.get("boundaryCondition", "")))
+
+            data["model_reaction_ptr"].append(len(data["reaction_id"]))
+            for reaction_id, reaction in model.reactions_by_id.items():
+                reactants, products, compartment, rate_law, reactant_stoichiometries, product_stoichiometries = \
+                    get_reaction_details(model, reaction)
+
+                flags = 0
+                if reaction.attrib.get("fast") in ['1', 'true']:
+                    flags |= REACTION_FAST
+                if reaction.attrib.get("reversible") in ['0', 'false']:
+                    flags |= REACTION_IRREVERSIBLE
+
+                data["reaction_id"].append(add_string(reaction_id))
+                data["reaction_name"].append(add_string(model.reaction_names[reaction_id]))
+                data["reaction_compartment"].append(add_string(compartment))
+                data["reaction_flags"].append(flags)
+                data["reaction_sbo_term"].append(add_string(reaction.attrib.get("sboTerm")))
+                data["reaction_law"].append(add_law(model, rate_law))
+
+                data["reactant_ptr"].append(len(data["reactant_species"]))
+                data["reactant_species"].extend(add_string(species) for species in reactants)
+                data["reactant_stoich"].extend(add_string(stoich) for stoich in reactant_stoichiometries)
+
+                data["product_ptr"].append(len(data["product_species"]))
+                data["product_species"].extend(add_string(species) for species in products)
+                data["product_stoich"].extend(add_string(stoich) for stoich in product_stoichiometries)
+
+            data["model_rule_ptr"].append(len(data["rule_variable"]))
+            for variable, rule in model.rules_by_variable.items():
+                data["rule_tag"].append(add_string(rule.tag))
+                data["rule_variable"].append(add_string(variable))
+                data["rule_law"].append(add_law(model, rule.find("math")))
+
+            data["model_value_ptr"].append(len(data["value_name"]))
+            for name in sorted(model.initial_values):
+                data["value_name"].append(add_string(name))
+                data["value_string"].append(add_string(model.initial_values[name]))
+
+        # close each CSR index array
+        for ptr, rows in [("model_compartment_ptr", "compartment_id"), ("model_species_ptr", "species_id"),
+                          ("model_reaction_ptr", "reaction_id"), ("model_rule_ptr", "rule_variable"),
+                          ("model_value_ptr", "value_name"), ("reactant_ptr", "reactant_species"),
+                          ("product_ptr", "product_species"), ("law_symbol_ptr", "law_symbol"),
+                          ("node_arg_ptr", "node_arg")]:
+            data[ptr].append(len(data[rows]))
+
+        offset = 0
+        for part in string_parts:
+            data["string_offsets"].append(offset)
+            offset += len(part)
+        data["string_offsets"].append(offset)
+        data["string_data"] = numpy.frombuffer("".join(string_parts), numpy.uint8)
+
+        self.num_models = len(models)
+        self.size = self.allocate(data)
+
+        # caches of the strings, nodes, expressions and indexes read so far (by each process)
+        self.strings = {}
+        self.nodes = {}
+        self.expressions = {}
+        self.conversions = {}
+        self.model_indexes = {}
+
+    def allocate(self, data):
+        """
+        Create the shared memory block, and copy the contents of each array into it.
+
+        Parameters
+        ----------
+        data : dict giving the contents of each array in SHARED_ARRAYS
+
+        Returns
+        -------
+        size of the block, in bytes
+
+        """
+        layout = []
+        size = 0
+        for name, dtype in SHARED_ARRAYS:
+            itemsize = numpy.dtype(dtype).itemsize
+            size += -size % itemsize
+            layout.append((name, dtype, size))
+            size += len(data[name]) * itemsize
+
+        # an anonymous mapping is shared with any process forked after it is created
+        self.buffer = mmap.mmap(-1, max(size, 1))
+        for name, dtype, offset in layout:
+            count = len(data[name])
+            if count:
+                array = numpy.frombuffer(self.buffer, dtype, count, offset)
+                array[:] = data[name]
+            else:
+                array = numpy.zeros(0, dtype)
+            setattr(self, name, array)
+        return size
+
+    def get_string(self, index):
+        """
+        Return a string from the string table (or None, for index -1). As with lxml, ASCII strings are returned as str,
+        and others as unicode.
+        """
+        index = int(index)
+        if index < 0:
+            return None
+        if index not in self.strings:
+            value = self.string_data[self.string_offsets[index]:self.string_offsets[index + 1]].tostring()
+            try:
+                value.decode("ascii")
+            except UnicodeDecodeError:
+                value = value.decode("utf-8")
+            self.strings[index] = value
+        return self.strings[index]
+
+    def get_strings(self, array, start, end):
+        return [self.get_string(index) for index in array[start:end]]
+
+    def get_node(self, row):
+        """
+        Return the MathNode stored in a row of the table of nodes, rebuilding it (and any of its arguments not yet
+        rebuilt by this process) without recursion.
+        """
+        stack = [int(row)]
+        while stack:
+            row = stack[-1]
+            if row in self.nodes:
+                stack.pop()
+                continue
+
+            tag = self.get_string(self.node_tag[row])
+            value = self.get_string(self.node_value[row])
+            arg_rows = [int(arg) for arg in self.node_arg[self.node_arg_ptr[row]:self.node_arg_ptr[row + 1]]]
+
+            if tag == "apply":
+                missing = [arg for arg in arg_rows if arg not in self.nodes]
+                if missing:
+                    stack.extend(missing)
+                    continue
+                args = tuple(self.nodes[arg] for arg in arg_rows)
+            else:
+                args = tuple(self.get_string(arg) for arg in arg_rows)
+            if tag == "ci":
+                value = intern_name(value)
+
+            self.nodes[row] = make_node(tag, value, args)
+            stack.pop()
+        return self.nodes[row]
+
+    def get_expression(self, law):
+        """
+        Return the MathExpression for a row of the table of laws, built from its tree the first time it is requested by
+        this process.
+
+        The expression is kept only in this object, so that the results of converting and analysing it are never taken
+        from (or added to) those of the models that were copied (see math_ast.math_expressions).
+        """
+        if law not in self.expressions:
+            self.expressions[law] = MathExpression(None, self.get_string(self.law_source[law]),
+                                                   self.get_node(self.law_root[law]), bool(self.law_piecewise[law]))
+        return self.expressions[law]
+
+    def get_converted_law(self, law):
+        """
+        Return the human-readable form of a law, as get_converted_rate_law() does for a math element.
+        """
+        if law not in self.conversions:
+            self.conversions[law] = convert_rate_law(self.get_expression(law))
+        return self.conversions[law]
+
+    def get_symbol_occurrences(self, law):
+        if law is None:
+            return []
+        return self.get_strings(self.law_symbol, self.law_symbol_ptr[law], self.law_symbol_ptr[law + 1])
+
+    def get_model_index(self, model_num):
+        """
+        Return a ModelIndex giving the contents of a model, built the first time it is requested by this process.
+        """
+        if model_num not in self.model_indexes:
+            self.model_indexes[model_num] = ModelIndex(self, model_num)
+        return self.model_indexes[model_num]
+
+    def diff_unit(self, unit, diff):
+        """
+        Compare a unit of work of SBMLDiff.diff_in_parallel() between the models, by calling diff.get_unit_diff() with a
+        SharedModelView of each model.
+
+        Parameters
+        ----------
+        unit : tuple identifying the unit of work (see SBMLDiff.get_unit_diff())
+
+        diff : the SBMLDiff object comparing the models
+
+        Returns
+        -------
+        a tuple (partial result, analyses): the partial result is that returned by diff.get_unit_diff(), or None if the
+        sign of an interaction could not be determined (so that the unit is compared serially instead, and the error
+        reported there). Each analysis is a tuple (model number, analysis), which can be passed to
+        store_expression_analysis()
+
+        """
+        analyses = Analyses(self, diff.use_sympy, diff.samples)
+        views = [(model_num, SharedModelView(self, model_num, analyses)) for model_num in range(self.num_models)]
+        try:
+            result = diff.get_unit_diff(unit, views)
+        except SIGN_ERRORS:
+            result = None
+        return result, analyses.get_results()
+
+
+class ModelIndex:
+    """
+    Indexes of the rows of a SharedModels object that belong to one model, and the details of its reactions and rules,
+    built by each process that reads them.
+    """
+
+    def __init__(self, shared, model_num):
+        self.shared = shared
+        self.model_num = model_num
+
+        self.reaction_ids = []
+        self.reaction_rows = {}
+        for row in self.get_rows(shared.model_reaction_ptr):
+            reaction_id = shared.get_string(shared.reaction_id[row])
+            self.reaction_ids.append(reaction_id)
+            self.reaction_rows[reaction_id] = row
+
+        self.rule_rows = {}
+        for row in self.get_rows(shared.model_rule_ptr):
+            self.rule_rows[shared.get_string(shared.rule_variable[row])] = row
+
+        self.species_compartment = {}
+        self.species_names = {}
+        self.species_boundary = {}
+        self.species_by_compartment = {}
+        for row in self.get_rows(shared.model_species_ptr):
+            species_id = shared.get_string(shared.species_id[row])
+            compartment = shared.get_string(shared.species_compartment[row])
+            self.species_compartment[species_id] = compartment
+            self.species_names[species_id] = shared.get_string(shared.species_name[row])
+            self.species_boundary[species_id] = shared.get_string(shared.species_boundary[row])
+            self.species_by_compartment.setdefault(compartment, []).append(species_id)
+
+        # the species in the compartments declared by the model (see SBMLDiff.abstract_model())
+        self.declared_species = set()
+        for row in self.get_rows(shared.model_compartment_ptr):
+            compartment_id = shared.get_string(shared.compartment_id[row])
+            self.declared_species.update(self.species_by_compartment.get(compartment_id, []))
+
+        self.initial_values = {}
+        for row in self.get_rows(shared.model_value_ptr):
+            self.initial_values[shared.get_string(shared.value_name[row])] = \
+                shared.get_string(shared.value_string[row])
+
+        # ReactionDetails and RuleDetails, added by get_reaction() and get_rule()
+        self.reactions = {}
+        self.rules = {}
+
+    def get_rows(self, ptr):
+        return range(ptr[self.model_num], ptr[self.model_num + 1])
+
+    def get_law(self, array, row):
+        law = int(array[row])
+        if law < 0:
+            return None
+        return law
+
+    def get_reaction(self, reaction_id):
+        """
+        Return the ReactionDetails of a reaction (or None, if the model has no reaction with this id).
+        """
+        row = self.reaction_rows.get(reaction_id)
+        if row is None:
+            return None
+        if reaction_id not in self.reactions:
+            shared = self.shared
+            law = self.get_law(shared.reaction_law, row)
+            reactant_range = shared.reactant_ptr[row], shared.reactant_ptr[row + 1]
+            product_range = shared.product_ptr[row], shared.product_ptr[row + 1]
+            flags = shared.reaction_flags[row]
+
+            self.reactions[reaction_id] = ReactionDetails(
+                reaction_id, shared.get_string(shared.reaction_name[row]),
+                shared.get_string(shared.reaction_compartment[row]),
+                shared.get_strings(shared.reactant_species, *reactant_range),
+                shared.get_strings(shared.product_species, *product_range),
+                shared.get_strings(shared.reactant_stoich, *reactant_range),
+                shared.get_strings(shared.product_stoich, *product_range),
+                law, shared.get_symbol_occurrences(law), bool(flags & REACTION_FAST),
+                bool(flags & REACTION_IRREVERSIBLE), shared.get_string(shared.reaction_sbo_term[row]))
+        return self.reactions[reaction_id]
+
+    def get_rule(self, variable):
+        """
+        Return the RuleDetails of the rule setting a variable (or None, if the model has no such rule).
+        """
+        row = self.rule_rows.get(variable)
+        if row is None:
+            return None
+        if variable not in self.rules:
+            shared = self.shared
+            law = self.get_law(shared.rule_law, row)
+            compartment = self.species_compartment.get(variable, "NONE").strip()
+            self.rules[variable] = RuleDetails(shared.get_string(shared.rule_tag[row]), variable, compartment, law,
+                                               shared.get_symbol_occurrences(law))
+        return self.rules[variable]
+
+
+class SharedModelView:
+    """
+    A view of one model of a SharedModels object, with the same methods as model_view.ModelView, through which
+    SBMLDiff.get_unit_diff() compares a unit of work in a worker. The signs and conversions it finds are recorded in an
+    Analyses object, rather than in the model.
+    """
+
+    def __init__(self, shared, model_num, analyses):
+        self.shared = shared
+        self.model_num = model_num
+        self.index = shared.get_model_index(model_num)
+        self.analyses = analyses
+
+    def get_reaction_ids(self):
+        return self.index.reaction_ids
+
+    def get_reaction(self, reaction_id):
+        return self.index.get_reaction(reaction_id)
+
+    def get_rule(self, variable):
+        return self.index.get_rule(variable)
+
+    def get_species(self, compartment_id):
+        return self.index.species_by_compartment.get(compartment_id, [])
+
+    def get_declared_species(self):
+        return self.index.declared_species
+
+    def is_species(self, species_id):
+        return species_id in self.index.species_compartment
+
+    def get_species_name(self, species_id):
+        return self.index.species_names[species_id]
+
+    def get_boundary_condition(self, species_id):
+        return self.index.species_boundary[species_id]
+
+    def get_sign(self, details, symbol):
+        return self.analyses.get_sign(self.model_num, details.rate_law, symbol, details.description)
+
+    def get_converted_law(self, details):
+        if details.rate_law is None:
+            return ""
+        return self.analyses.get_converted_law(self.model_num, details.rate_law)
+
+    def get_rate_law_key(self, details):
+        if details.rate_law is None:
+            return ""
+        return self.shared.get_expression(details.rate_law).get_canonical_key()
+
+
+class Analyses:
+    """
+    The laws converted, and the signs determined, for each model while comparing a unit of work of
+    SharedModels.diff_unit(), so that they can be recorded in the original models (as store_expression_analysis()
+    does for the results of analyse_expression()).
+    """
+
+    def __init__(self, shared, use_sympy, samples):
+        self.shared = shared
+        self.use_sympy = use_sympy
+        self.samples = samples
+
+        # for each (model number, law): [converted law (or None), dict giving the sign for each symbol, list of timeouts]
+        self.results = {}
+
+    def get_entry(self, model_num, law):
+        key = (model_num, law)
+        if key not in self.results:
+            self.results[key] = [None, {}, []]
+        return self.results[key]
+
+    def get_converted_law(self, model_num, law):
+        entry = self.get_entry(model_num, law)
+        if entry[0] is None:
+            entry[0] = self.shared.get_converted_law(law)
+        return entry[0]
+
+    def get_sign(self, model_num, law, symbol, description):
+        """
+        Return the sign of the interaction between a law and a symbol in a model, as get_interaction_sign() does.
+
+        Raises
+        ------
+        one of SIGN_ERRORS, if the sign cannot be determined
+
+        """
+        entry = self.get_entry(model_num, law)
+        if symbol in entry[1]:
+            return entry[1][symbol]
+
+        expression = self.shared.get_expression(law)
+
+        # an empty math element has no sign
+        sign = None
+        timed_out = []
+        if expression.tree.tag != "unsupported" or expression.tree.value != "math":
+            initial_values = self.shared.get_model_index(model_num).initial_values
+            sign = categorise_expression(expression, symbol, initial_values, use_sympy=self.use_sympy,
+                                         samples=self.samples, timed_out_laws=timed_out)
+        entry[1][symbol] = sign
+
+        if timed_out and description not in entry[2]:
+            entry[2].append(description)
+        return sign
+
+    def get_results(self):
+        """
+        Return a list of (model number, analysis) tuples, in which each analysis can be passed to
+        store_expression_analysis().
+        """
+        results = []
+        for (model_num, law), (converted_law, signs, timeouts) in sorted(self.results.items()):
+            results.append((model_num, (self.shared.get_string(self.shared.law_source[law]), converted_law,
+                                        sorted(signs.items()), timeouts)))
+        return results
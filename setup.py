@@ -10,5 +10,6 @@ setup(name='sbml-diff',
       url='',
       packages=['sbml_diff'],
       scripts=['sbml-diff.py'],
-      install_requires=['BeautifulSoup', 'tabulate']
+      install_requires=['lxml', 'tabulate', 'numpy'],
+      extras_require={'xz': ['backports.lzma']}
       )
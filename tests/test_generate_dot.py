@@ -0,0 +1,71 @@
+import sys
+import unittest
+from StringIO import StringIO
+
+from sbml_diff.generate_dot import GenerateDot
+from sbml_diff.sbml_diff import SBMLDiff
+
+# a reaction whose rate, k * A * S * (K - S), increases with S for S < K / 2 and decreases for S > K / 2
+MODEL = """<?xml version="1.0" encoding="UTF-8"?>
+<sbml xmlns="http://www.sbml.org/sbml/level2/version4" level="2" version="4">
+  <model id="mixed">
+    <listOfCompartments><compartment id="cell" size="1"/></listOfCompartments>
+    <listOfSpecies>
+      <species id="A" compartment="cell" initialConcentration="1"/>
+      <species id="B" compartment="cell" initialConcentration="1"/>
+      <species id="S" compartment="cell" initialConcentration="1"/>
+    </listOfSpecies>
+    <listOfParameters><parameter id="k" value="1"/><parameter id="K" value="1"/></listOfParameters>
+    <listOfReactions>
+      <reaction id="r1" reversible="false">
+        <listOfReactants><speciesReference species="A"/></listOfReactants>
+        <listOfProducts><speciesReference species="B"/></listOfProducts>
+        <kineticLaw>
+          <math xmlns="http://www.w3.org/1998/Math/MathML">
+            <apply><times/><ci>k</ci><ci>A</ci><ci>S</ci><apply><minus/><ci>K</ci><ci>S</ci></apply></apply>
+          </math>
+        </kineticLaw>
+      </reaction>
+    </listOfReactions>
+  </model>
+</sbml>
+"""
+
+MONOTONIC_LAW = "<apply><times/><ci>k</ci><ci>A</ci><ci>S</ci></apply>"
+
+
+class TestMixedArrows(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def draw(self, models, heat_scale=False):
+        generate_dot = GenerateDot(["red", "blue"][:len(models)], len(models), heat_scale=heat_scale)
+        SBMLDiff(models, ["model%s" % i for i in range(len(models))], generate_dot).diff_models()
+        return sys.stdout.getvalue()
+
+    def test_mixed_arrowhead(self):
+        output = self.draw([MODEL])
+        self.assertTrue('"S" -> "r1" [color="black", arrowhead="odiamond"' in output)
+        self.assertTrue("<br/>Open diamond arrowheads: mixed interactions" in output)
+
+    def test_key_only_when_drawn(self):
+        monotonic = MODEL.replace(MODEL[MODEL.index("<apply>"):MODEL.rindex("</apply>") + len("</apply>")],
+                                  MONOTONIC_LAW)
+        output = self.draw([monotonic])
+        self.assertTrue('"S" -> "r1" [color="black", arrowhead="vee"' in output)
+        self.assertFalse("odiamond" in output)
+        self.assertFalse("Open diamond" in output)
+
+    def test_key_with_heat_scale(self):
+        output = self.draw([MODEL, MODEL], heat_scale=True)
+        self.assertTrue('arrowhead="odiamond"' in output)
+        self.assertTrue("<br/>Open diamond arrowheads: mixed interactions" in output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+from lxml import etree
+
+from sbml_diff.math_ast import get_math_expression
+
+
+def apply(operator, *args):
+    return "<apply><%s/>%s</apply>" % (operator, "".join(args))
+
+
+def ci(name):
+    return "<ci> %s </ci>" % name
+
+
+def cn(value):
+    return "<cn> %s </cn>" % value
+
+
+def get_key(body):
+    """
+    Return the canonical key of a math element (given without the enclosing math tags).
+    """
+    return get_math_expression(etree.fromstring("<math>%s</math>" % body)).get_canonical_key()
+
+
+class TestCanonicalKey(unittest.TestCase):
+
+    def test_plus_and_times_reordered(self):
+        self.assertEqual(get_key(apply("plus", ci("A"), ci("B"))), get_key(apply("plus", ci("B"), ci("A"))))
+        self.assertEqual(get_key(apply("times", ci("k"), ci("A"), ci("B"))),
+                         get_key(apply("times", ci("B"), ci("k"), ci("A"))))
+
+    def test_nested_operators_flattened(self):
+        flat = get_key(apply("times", ci("k"), ci("A"), ci("B")))
+        self.assertEqual(get_key(apply("times", apply("times", ci("k"), ci("A")), ci("B"))), flat)
+        self.assertEqual(get_key(apply("times", ci("B"), apply("times", ci("A"), ci("k")))), flat)
+        self.assertEqual(get_key(apply("plus", ci("A"), apply("plus", ci("C"), ci("B")))),
+                         get_key(apply("plus", apply("plus", ci("B"), ci("A")), ci("C"))))
+
+    def test_different_operators_not_flattened(self):
+        self.assertNotEqual(get_key(apply("times", apply("plus", ci("A"), ci("B")), ci("C"))),
+                            get_key(apply("plus", ci("A"), ci("B"), ci("C"))))
+
+    def test_numbers_compared_by_value(self):
+        self.assertEqual(get_key(cn("1")), get_key(cn("1.0")))
+        self.assertEqual(get_key(apply("times", cn("2"), ci("A"))), get_key(apply("times", ci("A"), cn("2.0"))))
+        self.assertEqual(get_key('<cn type="e-notation"> 1 <sep/> 2 </cn>'), get_key(cn("100")))
+        self.assertNotEqual(get_key(cn("1")), get_key(cn("2")))
+
+    def test_minus_divide_and_power_not_reordered(self):
+        for operator in ["minus", "divide", "power"]:
+            self.assertNotEqual(get_key(apply(operator, ci("A"), ci("B"))), get_key(apply(operator, ci("B"), ci("A"))))
+
+    def test_minus_divide_and_power_not_flattened(self):
+        for operator in ["minus", "divide", "power"]:
+            self.assertNotEqual(get_key(apply(operator, apply(operator, ci("A"), ci("B")), ci("C"))),
+                                get_key(apply(operator, ci("A"), apply(operator, ci("B"), ci("C")))))
+
+    def test_piecewise_identified_by_mathml(self):
+        piecewise = "<piecewise><piece>%s%s</piece><otherwise>%s</otherwise></piecewise>" % (
+            ci("A"), apply("gt", ci("t"), cn("1")), ci("B"))
+        self.assertTrue(get_key(piecewise).startswith("mathml "))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sbml_diff.model_cache import ModelCache, CACHE_SUFFIX
+from sbml_diff.sbml_diff import read_model
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "examples")
+
+
+class TestModelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_entries(self):
+        return sorted(file_name[:-len(CACHE_SUFFIX)] for file_name in os.listdir(self.directory)
+                      if file_name.endswith(CACHE_SUFFIX))
+
+    def store(self, cache, key, size, mtime):
+        """
+        Store an entry of roughly a given size, and set the time it was last used.
+        """
+        cache.store(key, "x" * size)
+        os.utime(cache.get_path(key), (mtime, mtime))
+
+    def test_hit(self):
+        cache = ModelCache(self.directory)
+        with open(os.path.join(EXAMPLES, "repressilator", "BIOMD0000000012.xml"), "rb") as model_file:
+            model = read_model(model_file, cache)
+        self.assertEqual(len(self.get_entries()), 1)
+        self.assertTrue(model.analysed_with is not None)
+
+        with open(os.path.join(EXAMPLES, "repressilator", "BIOMD0000000012.xml"), "rb") as model_file:
+            cached = read_model(model_file, cache)
+        self.assertTrue(cached is not model)
+        self.assertEqual(list(cached.reactions_by_id), list(model.reactions_by_id))
+        self.assertEqual(cached.converted_rate_laws, model.converted_rate_laws)
+        self.assertEqual(cached.interaction_signs, model.interaction_signs)
+        self.assertEqual(cached.rate_law_keys, model.rate_law_keys)
+
+    def test_key_depends_on_settings(self):
+        cache = ModelCache(self.directory)
+        key = cache.get_key("<sbml/>")
+        self.assertEqual(cache.get_key("<sbml/>"), key)
+        self.assertNotEqual(cache.get_key("<sbml />"), key)
+        self.assertNotEqual(cache.get_key("<sbml/>", samples=7), key)
+
+    def test_miss(self):
+        cache = ModelCache(self.directory)
+        self.assertEqual(cache.load("missing"), None)
+
+    def test_eviction_order(self):
+        cache = ModelCache(self.directory, max_size=2500)
+        self.store(cache, "a", 1000, 100)
+        self.store(cache, "b", 1000, 200)
+        self.assertEqual(self.get_entries(), ["a", "b"])
+
+        # loading "a" makes "b" the least recently used entry
+        self.assertEqual(cache.load("a"), "x" * 1000)
+        self.store(cache, "c", 1000, 300)
+        self.assertEqual(self.get_entries(), ["a", "c"])
+
+    def test_new_entry_kept(self):
+        cache = ModelCache(self.directory, max_size=500)
+        self.store(cache, "a", 100, 100)
+        cache.store("b", "x" * 1000)
+        self.assertEqual(self.get_entries(), ["b"])
+        self.assertEqual(cache.load("b"), "x" * 1000)
+
+    def test_corrupted_entry_removed(self):
+        cache = ModelCache(self.directory)
+        self.store(cache, "a", 1000, 100)
+        with open(cache.get_path("a"), "r+b") as cache_file:
+            cache_file.truncate(100)
+
+        self.assertEqual(cache.load("a"), None)
+        self.assertEqual(self.get_entries(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import bz2
+import gzip
+import os
+import unittest
+import zipfile
+from io import BytesIO
+
+from sbml_diff.model_files import open_model, get_model_name, StreamReader, CHUNK_SIZE, FEED_SIZE, XZ_MAGIC
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "examples")
+
+MANIFEST = """<?xml version="1.0" encoding="UTF-8"?>
+<omexManifest xmlns="http://identifiers.org/combine.specifications/omex-manifest">
+  <content location="." format="http://identifiers.org/combine.specifications/omex"/>
+  <content location="./first.xml" format="http://identifiers.org/combine.specifications/sbml"/>
+  <content location="./second.xml" format="http://identifiers.org/combine.specifications/sbml" master="true"/>
+</omexManifest>
+"""
+
+
+def make_zip(members):
+    data = BytesIO()
+    archive = zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED)
+    for name, contents in members:
+        archive.writestr(name, contents)
+    archive.close()
+    return data.getvalue()
+
+
+class RecordingDecompressor:
+    """
+    Wraps a decompressor that cannot limit its output (such as bz2.BZ2Decompressor), recording the size of the input
+    given to each call.
+    """
+
+    def __init__(self, decompressor):
+        self.decompressor = decompressor
+        self.input_sizes = []
+
+    def decompress(self, data):
+        self.input_sizes.append(len(data))
+        return self.decompressor.decompress(data)
+
+
+class TestOpenModel(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(EXAMPLES, "SIR", "SIRModel1.xml"), "rb") as model_file:
+            self.model = model_file.read()
+
+    def test_uncompressed(self):
+        self.assertEqual(open_model(self.model).read(), self.model)
+        self.assertEqual(open_model(BytesIO(self.model)).read(), self.model)
+
+    def test_gzip(self):
+        data = BytesIO()
+        gzip_file = gzip.GzipFile(fileobj=data, mode="wb")
+        gzip_file.write(self.model)
+        gzip_file.close()
+        self.assertEqual(open_model(data.getvalue()).read(), self.model)
+
+    def test_bz2(self):
+        self.assertEqual(open_model(bz2.compress(self.model)).read(), self.model)
+
+    def test_xz(self):
+        if lzma is None:
+            self.assertRaises(RuntimeError, open_model, XZ_MAGIC + "\0" * 100)
+        else:
+            self.assertEqual(open_model(lzma.compress(self.model)).read(), self.model)
+
+    def test_zip(self):
+        archive = make_zip([("README.txt", "not a model"), ("model.xml", self.model)])
+        self.assertEqual(open_model(archive).read(), self.model)
+
+    def test_zip_with_several_models(self):
+        archive = make_zip([("first.xml", self.model), ("second.xml", self.model)])
+        self.assertRaises(RuntimeError, open_model, archive)
+
+    def test_combine_archive(self):
+        archive = make_zip([("manifest.xml", MANIFEST), ("first.xml", "<sbml/>"), ("second.xml", self.model)])
+        self.assertEqual(open_model(archive).read(), self.model)
+
+    def test_read_in_pieces(self):
+        reader = open_model(bz2.compress(self.model))
+        pieces = []
+        for piece in iter(lambda: reader.read(100), ""):
+            self.assertTrue(len(piece) <= 100)
+            pieces.append(piece)
+        self.assertEqual("".join(pieces), self.model)
+
+
+class TestDecompressionBound(unittest.TestCase):
+    """
+    Check that each call to a decompressor produces a bounded amount of output, however compressible the input is.
+    """
+
+    def setUp(self):
+        self.data = "\0" * (20 * CHUNK_SIZE)
+
+    def test_gzip_output_limited(self):
+        data = BytesIO()
+        gzip_file = gzip.GzipFile(fileobj=data, mode="wb")
+        gzip_file.write(self.data)
+        gzip_file.close()
+
+        reader = open_model(data.getvalue())
+        chunks = list(iter(reader.read_chunk, ""))
+        self.assertTrue(len(chunks) >= 20)
+        self.assertTrue(max(len(chunk) for chunk in chunks) <= CHUNK_SIZE)
+        self.assertEqual("".join(chunks), self.data)
+
+    def test_bz2_input_limited(self):
+        compressed = bz2.compress(self.data * 10)
+        decompressor = RecordingDecompressor(bz2.BZ2Decompressor())
+        reader = StreamReader(BytesIO(compressed), decompressor=decompressor)
+
+        self.assertEqual(reader.read(), self.data * 10)
+        self.assertTrue(max(decompressor.input_sizes) <= FEED_SIZE)
+        self.assertEqual(sum(decompressor.input_sizes), len(compressed))
+
+
+class TestModelName(unittest.TestCase):
+
+    def test_model_name(self):
+        self.assertEqual(get_model_name("model.xml"), "model")
+        self.assertEqual(get_model_name("model.sbml.gz"), "model")
+        self.assertEqual(get_model_name("model.xml.BZ2"), "model")
+        self.assertEqual(get_model_name("model.v2.xml"), "model.v2")
+        self.assertEqual(get_model_name("model"), "model")
+
+    def test_archive_named_after_archive(self):
+        self.assertEqual(get_model_name("archive.zip"), "archive")
+        self.assertEqual(get_model_name("archive.omex"), "archive")
+
+
+if __name__ == '__main__':
+    unittest.main()
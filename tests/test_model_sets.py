@@ -0,0 +1,62 @@
+import unittest
+
+from sbml_diff.model_sets import to_mask, from_mask, full_mask, popcount, lowest_model, contains_model, classify, \
+    NO_MODELS, ONE_MODEL, SOME_MODELS, ALL_MODELS
+
+
+class TestModelSets(unittest.TestCase):
+
+    def test_to_mask(self):
+        self.assertEqual(to_mask([]), 0)
+        self.assertEqual(to_mask([0]), 1)
+        self.assertEqual(to_mask([0, 2]), 5)
+        self.assertEqual(to_mask(set([1, 2, 1])), 6)
+        self.assertEqual(to_mask(range(3)), full_mask(3))
+        self.assertEqual(to_mask([70]), 1 << 70)
+
+    def test_to_mask_unchanged(self):
+        self.assertEqual(to_mask(0), 0)
+        self.assertEqual(to_mask(5), 5)
+        self.assertEqual(to_mask(1 << 70), 1 << 70)
+
+    def test_from_mask(self):
+        self.assertEqual(from_mask(0), [])
+        self.assertEqual(from_mask(1), [0])
+        self.assertEqual(from_mask(6), [1, 2])
+        self.assertEqual(from_mask(full_mask(4)), [0, 1, 2, 3])
+        self.assertEqual(from_mask(to_mask([3, 0, 70])), [0, 3, 70])
+
+    def test_popcount(self):
+        self.assertEqual(popcount(0), 0)
+        self.assertEqual(popcount(4), 1)
+        self.assertEqual(popcount(5), 2)
+        self.assertEqual(popcount(full_mask(100)), 100)
+
+    def test_lowest_model(self):
+        self.assertEqual(lowest_model(0), -1)
+        self.assertEqual(lowest_model(1), 0)
+        self.assertEqual(lowest_model(12), 2)
+        self.assertEqual(lowest_model(full_mask(5)), 0)
+        self.assertEqual(lowest_model(1 << 70), 70)
+
+    def test_contains_model(self):
+        self.assertFalse(contains_model(0, 0))
+        self.assertTrue(contains_model(5, 2))
+        self.assertFalse(contains_model(5, 1))
+        self.assertTrue(contains_model(full_mask(3), 2))
+        self.assertFalse(contains_model(full_mask(3), 3))
+
+    def test_classify(self):
+        self.assertEqual(classify(0, 3), NO_MODELS)
+        self.assertEqual(classify(2, 3), ONE_MODEL)
+        self.assertEqual(classify(5, 3), SOME_MODELS)
+        self.assertEqual(classify(full_mask(3), 3), ALL_MODELS)
+
+    def test_classify_single_model(self):
+        # a feature of the only model is in all of them, rather than in one
+        self.assertEqual(classify(0, 1), NO_MODELS)
+        self.assertEqual(classify(1, 1), ALL_MODELS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+from sbml_diff import sbml_diff
+from sbml_diff.generate_dot import GenerateDot
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "examples")
+
+
+def read_example(*path):
+    with open(os.path.join(EXAMPLES, *path)) as f:
+        return f.read()
+
+
+class TestDiffInParallel(unittest.TestCase):
+    """
+    Check that comparing models in worker processes (SBMLDiff.diff_in_parallel()) gives the same output as comparing
+    them serially. The number of processors is patched, so that the workers are used even on a single-processor host.
+    """
+
+    def setUp(self):
+        self.cpu_count = sbml_diff.cpu_count
+        sbml_diff.cpu_count = lambda: 4
+
+        # count the units compared in this process; those compared by the workers are counted in their own copy
+        self.get_unit_diff = sbml_diff.SBMLDiff.get_unit_diff
+        self.serial_units = []
+
+        def get_unit_diff(sd, unit, views):
+            self.serial_units.append(unit)
+            return self.get_unit_diff(sd, unit, views)
+        sbml_diff.SBMLDiff.get_unit_diff = get_unit_diff
+
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sbml_diff.cpu_count = self.cpu_count
+        sbml_diff.SBMLDiff.get_unit_diff = self.get_unit_diff
+        sys.stdout = self.stdout
+        sys.stderr = self.stderr
+
+    def compare(self, models, jobs, abstract=False, **kwargs):
+        """
+        Return the DOT output comparing a list of models (as strings).
+        """
+        sys.stdout = StringIO()
+        generate_dot = GenerateDot(["red", "blue"][:len(models)], len(models))
+        sd = sbml_diff.SBMLDiff(models, ["model%s" % i for i in range(len(models))], generate_dot, jobs=jobs, **kwargs)
+        if abstract:
+            sd.diff_abstract_models([], [])
+        else:
+            sd.diff_models()
+        output = sys.stdout.getvalue()
+        sys.stdout = self.stdout
+        return output
+
+    def assert_same_output(self, models, abstract=False, **kwargs):
+        serial = self.compare(models, 1, abstract, **kwargs)
+        self.assertTrue(self.serial_units)
+
+        del self.serial_units[:]
+        parallel = self.compare(models, 3, abstract, **kwargs)
+        self.assertEqual(self.serial_units, [])
+        self.assertEqual(parallel, serial)
+
+    def test_diff_models(self):
+        self.assert_same_output([read_example("repressilator", "BIOMD0000000012.xml")])
+
+    def test_diff_models_cartoon(self):
+        self.assert_same_output([read_example("repressilator", "BIOMD0000000012.xml")], cartoon=True)
+
+    def test_diff_abstract_models(self):
+        self.assert_same_output([read_example("repressilator", "BIOMD0000000012.xml")], abstract=True)
+
+    def test_rules(self):
+        self.assert_same_output([read_example("comparisons", "assignmentRuleModel.xml")])
+
+    def test_pool_size_warning(self):
+        sbml_diff.cpu_count = lambda: 1
+        serial = self.compare([read_example("repressilator", "BIOMD0000000012.xml")], 1)
+        self.assertEqual(sys.stderr.getvalue(), "")
+
+        single = self.compare([read_example("repressilator", "BIOMD0000000012.xml")], 4)
+        self.assertEqual(single, serial)
+        self.assertEqual(sys.stderr.getvalue(),
+                         "Warning: using a single process rather than 4, as there is only 1 processor\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
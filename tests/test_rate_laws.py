@@ -0,0 +1,69 @@
+import math
+import unittest
+
+from lxml import etree
+
+from sbml_diff.rate_laws import MAX_COMPILE_DEPTH, SPLIT_DEPTH, CompiledRateLaw, compile_code, get_nesting_depth, \
+    split_nested_code
+
+# deeper than MAX_COMPILE_DEPTH, and than Python's parser can handle
+DEPTH = 3 * MAX_COMPILE_DEPTH
+
+
+def get_nested_code(depth):
+    """
+    Return code nested depth deep, alternating between parenthesised sums and calls with two arguments, together with
+    the value of the code for v = [2.0].
+    """
+    code = "v[0]"
+    value = 2.0
+    for i in range(depth):
+        if i % 2:
+            code = "math.pow(%s, 1)" % code
+        else:
+            code = "(%s + %s)" % (code, i)
+            value += i
+    return code, value
+
+
+class TestCompileCode(unittest.TestCase):
+
+    def test_split_nested_code(self):
+        code, value = get_nested_code(DEPTH)
+        self.assertEqual(get_nesting_depth(code), DEPTH)
+
+        assignments, expression = split_nested_code(code)
+        self.assertTrue(assignments)
+        for statement in assignments + [expression]:
+            self.assertTrue(get_nesting_depth(statement) <= SPLIT_DEPTH)
+
+    def test_compile_deeply_nested_code(self):
+        code, value = get_nested_code(DEPTH)
+        function = compile_code(code, {"math": math})
+        self.assertEqual(function([2.0]), value)
+
+    def test_compile_shallow_code(self):
+        code, value = get_nested_code(MAX_COMPILE_DEPTH)
+        function = compile_code(code, {"math": math})
+        self.assertEqual(function([2.0]), value)
+        self.assertEqual(function([2.0]), eval(code, {"math": math, "v": [2.0]}))
+
+    def test_compile_deeply_nested_rate_law(self):
+        # ((A * 2) + 1) * 2 ..., evaluated in the same order as the unsplit expression
+        body = "<ci> A </ci>"
+        value = 3.0
+        for i in range(DEPTH):
+            if i % 2:
+                body = "<apply><plus/>%s<cn> 1 </cn></apply>" % body
+                value = value + 1.0
+            else:
+                body = "<apply><times/>%s<cn> 2 </cn></apply>" % body
+                value = value * 2.0
+
+        rate_law = CompiledRateLaw(etree.fromstring("<math>%s</math>" % body))
+        self.assertEqual(rate_law.symbols, ["A"])
+        self.assertEqual(rate_law.function([3.0]), value)
+
+
+if __name__ == '__main__':
+    unittest.main()